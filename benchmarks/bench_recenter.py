@@ -0,0 +1,79 @@
+"""Benchmark centroid algorithms used by :func:`wss_tools.utils.recenter`.
+
+Speed and centroid agreement of each method are compared against
+the original algorithm (``method='median'``) and the true PSF center on
+synthetic NIRCam-sized PSF images with noise. The test is run on flat
+background and again on a tilted background, where center of mass
+methods are known to be fragile.
+
+Run from command line::
+
+    python benchmarks/bench_recenter.py [n_images]
+
+"""
+# STDLIB
+import sys
+import time
+import warnings
+
+# THIRD-PARTY
+import numpy as np
+
+# LOCAL
+from wss_tools.utils.recenter import _centroid_methods, find_psf_center
+
+
+def synthetic_psf(yc, xc, imsize=2048, sigma=20, tilt=0, rng=None):
+    """Gaussian core with a faint ring on a noisy background."""
+    if rng is None:
+        rng = np.random.default_rng()
+    y, x = np.mgrid[:imsize, :imsize]
+    r = np.hypot(y - yc, x - xc)
+    psf = (1000 * np.exp(-0.5 * (r / sigma) ** 2) +
+           50 * np.exp(-0.5 * ((r - 4 * sigma) / sigma) ** 2))
+    bkg = 10 + tilt * (x + y) / imsize
+    noise = rng.normal(0, 2, (imsize, imsize))
+    return (psf + bkg + noise).astype(np.float32)
+
+
+def _max_abs_diff(a, b):
+    d = np.abs(a - b)
+    return np.nanmax(d) if np.isfinite(d).any() else np.nan
+
+
+def run(n_images=10, tilt=0, seed=1234):
+    rng = np.random.default_rng(seed)
+    truths = rng.uniform(300, 1748, size=(n_images, 2))
+    images = [synthetic_psf(yc, xc, tilt=tilt, rng=rng) for yc, xc in truths]
+
+    results = {}
+    for method in _centroid_methods:
+        centers = []
+        t1 = time.perf_counter()
+        for im in images:
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    centers.append(find_psf_center(im, method=method))
+            except Exception:
+                centers.append((np.nan, np.nan))
+        t2 = time.perf_counter()
+        results[method] = (np.array(centers), (t2 - t1) / n_images)
+
+    ref = results['median'][0]
+
+    print(f'{n_images} images of {images[0].shape}, background tilt={tilt}')
+    print(f"{'method':>10} {'ms/image':>10} {'failed':>7} "
+          f"{'max |d| ref':>12} {'max |d| truth':>14}")
+    for method, (centers, t) in results.items():
+        n_failed = (~np.isfinite(centers).all(axis=1)).sum()
+        print(f'{method:>10} {t * 1000:10.2f} {n_failed:7d} '
+              f'{_max_abs_diff(centers, ref):12.3f} '
+              f'{_max_abs_diff(centers, truths):14.3f}')
+    print()
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    run(n_images=n)
+    run(n_images=n, tilt=5)
@@ -0,0 +1,65 @@
+"""Benchmark resampling algorithms in :mod:`wss_tools.utils.resample`.
+
+Timing and flux conservation are compared for shrinking a NIRCam-sized
+detector to the sizes used for mosaics and thumbnails. The test image is
+a noisy sky with many point sources, where interpolation that does not
+average over the input pixels loses or gains flux.
+
+Run from command line::
+
+    python benchmarks/bench_resample.py [n_repeat]
+
+"""
+# STDLIB
+import sys
+import time
+
+# THIRD-PARTY
+import numpy as np
+
+# LOCAL
+from wss_tools.utils.mosaic import NircamMosaic
+from wss_tools.utils.resample import _area_operator, resample
+
+
+def synthetic_image(size=2048, n_sources=2000, seed=1234):
+    """Sky background with point sources, like a NIRCam detector."""
+    rng = np.random.default_rng(seed)
+    data = rng.normal(100, 5, (size, size))
+    iy, ix = rng.integers(0, size, (2, n_sources))
+    data[iy, ix] += rng.uniform(1e3, 1e5, n_sources)
+    return data.astype(np.float32)
+
+
+def run(n_repeat=3):
+    data = synthetic_image()
+    flux_in = data.sum(dtype=np.float64)
+
+    # Zoom factors used in the mosaic for given sw_sca_size,
+    # and for 500-pixel wide thumbnails.
+    cases = [('thumbnail 500', 500 / data.shape[1])]
+    for sw_sca_size in (100, 256):
+        m = NircamMosaic(sw_sca_size=sw_sca_size)
+        cases += [(f'SW {sw_sca_size}', m.sw_zoom_factor),
+                  (f'LW {sw_sca_size}', m.lw_zoom_factor)]
+
+    print(f'Input {data.shape}, best of {n_repeat}')
+    print(f"{'case':>14} {'method':>7} {'shape':>11} {'ms':>9} "
+          f"{'flux ratio':>11}")
+    for label, zoom_factor in cases:
+        for method in ('area', 'spline'):
+            _area_operator.cache_clear()
+            times = []
+            for _ in range(n_repeat):
+                t1 = time.perf_counter()
+                out = resample(data, zoom_factor, method=method)
+                times.append(time.perf_counter() - t1)
+            scale = np.divide(data.shape, out.shape).prod()
+            flux_ratio = out.sum(dtype=np.float64) * scale / flux_in
+            shape = 'x'.join(map(str, out.shape))
+            print(f'{label:>14} {method:>7} {shape:>11} '
+                  f'{min(times) * 1000:9.2f} {flux_ratio:11.6f}')
+
+
+if __name__ == '__main__':
+    run(*map(int, sys.argv[1:2]))
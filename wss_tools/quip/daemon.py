@@ -0,0 +1,303 @@
+"""QUIP daemon.
+
+It watches a spool directory for QUIP Operation XML files, e.g., as written
+by :meth:`~wss_tools.quip.qio.QUIPOpFile.write_xml`, and runs the part of
+each operation that does not need Ginga, as ``quip --headless`` would.
+Worker processes and caches stay warm across operations.
+For more information, see :ref:`quip-example-daemon-1`.
+
+"""
+# STDLIB
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# LOCAL
+from . import main as quip_main
+from . import qio
+from ..utils.cache import _mkstemp
+from ..utils.io import output_xml
+
+__all__ = ['QUIPDaemon', 'status_filename']
+
+_status_suffix = '.status.json'
+
+
+def status_filename(opfile):
+    """Status file of the given QUIP Operation XML file in spool directory.
+
+    Parameters
+    ----------
+    opfile : str
+        QUIP Operation XML file.
+
+    Returns
+    -------
+    filename : str
+        Status file, next to the XML file.
+
+    """
+    return os.path.splitext(opfile)[0] + _status_suffix
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+class QUIPDaemon:
+    """Long-running service that processes QUIP Operation XML files
+    dropped into a spool directory.
+
+    Each file is validated and run as ``quip --headless`` would,
+    with at most ``max_jobs`` at a time, and a QUIP Out XML is written
+    to the output location given in the file. Progress is recorded in
+    a JSON status file next to it (see :func:`status_filename`) with
+    ``state`` being ``'running'``, ``'done'``, or ``'failed'``, and also
+    ``error`` if failed. A file that already has a status file is never
+    processed again; Delete the status file to run it again.
+    Status file is created exclusively, so several daemons can share
+    a spool directory.
+
+    Intermediate products are stored in ``quipcache`` sub-directory of
+    the spool directory, so they are shared by all operations.
+
+    Parameters
+    ----------
+    spooldir : str
+        Spool directory to watch.
+
+    max_jobs : int
+        Maximum number of operations to run at the same time.
+
+    n_cores : int or `None`
+        Number of CPU cores for each operation. Worker processes for
+        ``THUMBNAIL`` are started once and shared by all operations.
+        Those for other operations are started for each operation
+        with ``forkserver`` (or ``spawn``) method, as forking from
+        a thread is not safe. If not given, all available cores
+        will be used.
+
+    poll_interval : float
+        Seconds between checks of the spool directory.
+
+    settle_time : float
+        Seconds since last modification before a file is picked up,
+        so that files that are still being written are left alone.
+
+    options : dict
+        Other QUIP options, ``thumb_width`` and ``thumb_cache_size``,
+        which are ``--mosaic-thumb-size`` and ``--thumb-cache-size``
+        in :func:`~wss_tools.quip.main.main`, respectively.
+
+    Examples
+    --------
+    >>> from wss_tools.quip.daemon import QUIPDaemon
+    >>> daemon = QUIPDaemon('/my/path/spool', max_jobs=2)  # doctest: +SKIP
+    >>> daemon.serve_forever()  # doctest: +SKIP
+
+    """
+    def __init__(self, spooldir, max_jobs=1, n_cores=None, poll_interval=2,
+                 settle_time=1, **options):
+        if max_jobs < 1:
+            raise ValueError(f'Invalid max_jobs={max_jobs}')
+
+        if n_cores is None:
+            n_cores = multiprocessing.cpu_count()
+
+        self.spooldir = os.path.abspath(spooldir)
+        self.max_jobs = max_jobs
+        self.n_cores = n_cores
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.options = options
+        self._executor = None
+        self._jobs = {}  # Future: XML file
+        self._stop = threading.Event()
+
+        # Operations run in threads, where forking is not safe,
+        # so worker processes they need are started from a clean process.
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            self._mp_context = multiprocessing.get_context('forkserver')
+        else:
+            self._mp_context = multiprocessing.get_context('spawn')
+
+    def pending(self):
+        """QUIP Operation XML files waiting to be processed,
+        oldest first.
+
+        """
+        now = time.time()
+        files = []
+        for filename in glob.iglob(os.path.join(self.spooldir, '*.xml')):
+            try:
+                mtime = os.stat(filename).st_mtime
+            except OSError:  # Removed meanwhile
+                continue
+            if (now - mtime >= self.settle_time and
+                    not os.path.exists(status_filename(filename))):
+                files.append((mtime, filename))
+        return [f for _, f in sorted(files)]
+
+    def _claim(self, opfile):
+        """Create status file for the given operation, unless another
+        daemon already did.
+
+        """
+        try:
+            fd = os.open(status_filename(opfile),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+        except FileExistsError:
+            return False
+        os.close(fd)
+        return True
+
+    def _write_status(self, opfile, status):
+        """Replace status file atomically, so it can be read any time."""
+        fd, tmpname = _mkstemp(self.spooldir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fout:
+                json.dump(status, fout, indent=1)
+            os.replace(tmpname, status_filename(opfile))
+        except BaseException:
+            os.remove(tmpname)
+            raise
+
+    def run_job(self, opfile):
+        """Process the given QUIP Operation XML file now, in this thread.
+        It must be claimed already, i.e., its status file exists.
+
+        Returns
+        -------
+        status : dict
+            Final content of the status file.
+
+        """
+        status = {'opfile': opfile, 'state': 'running', 'started': _now()}
+        self._write_status(opfile, status)
+
+        try:
+            quip_main._validate_opfile(opfile)
+            quip_directive = qio.input_xml(opfile)
+            op_type = quip_directive['OPERATION_TYPE']
+            status['operation_type'] = op_type
+            if op_type.lower() not in quip_main._headless_op_types:
+                raise ValueError(f'{op_type} cannot run headless')
+
+            images = quip_main._preprocess(
+                opfile, quip_directive, n_cores=self.n_cores,
+                mp_context=self._mp_context, **self.options)
+            quipout = quip_directive['OUTPUT']['OUT_FILE_PATH']
+            output_xml(qio.quip_out_dict(images), quipout)
+        except Exception as e:
+            status.update(state='failed', error=repr(e),
+                          traceback=traceback.format_exc())
+        else:
+            status.update(state='done', out_file=quipout, images=images)
+
+        status['finished'] = _now()
+        self._write_status(opfile, status)
+        return status
+
+    def _warm_up(self):
+        """Start worker processes and build what is shared by all
+        operations, so the first one does not have to.
+
+        """
+        quip_main._ignore_fits_fixed_warnings()
+        quip_main._stginga_gt_1_2()
+        quip_main._jwst_dq_parser()
+        if self.n_cores > 1:
+            quip_main._get_shrink_pool(self.n_cores, create=True)
+
+    def poll(self):
+        """Start pending operations, as long as fewer than ``max_jobs``
+        are running.
+
+        Returns
+        -------
+        started : list
+            QUIP Operation XML files that were started.
+
+        """
+        if self._executor is None:
+            self._warm_up()
+            self._executor = ThreadPoolExecutor(self.max_jobs)
+
+        for future in [f for f in self._jobs if f.done()]:
+            del self._jobs[future]
+
+        started = []
+        for opfile in self.pending():
+            if len(self._jobs) >= self.max_jobs:
+                break
+            if not self._claim(opfile):
+                continue
+            self._jobs[self._executor.submit(self.run_job, opfile)] = opfile
+            started.append(opfile)
+
+        return started
+
+    def wait(self):
+        """Wait for running operations to finish."""
+        for future in list(self._jobs):
+            future.result()
+        self._jobs.clear()
+
+    def serve_forever(self):
+        """Process operations as they arrive, until :meth:`stop` is called
+        or interrupted. Running operations are finished before returning.
+
+        """
+        try:
+            while not self._stop.is_set():
+                self.poll()
+                self._stop.wait(self.poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.wait()
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            self._stop.clear()
+
+    def stop(self):
+        """Ask :meth:`serve_forever` to return. Thread-safe."""
+        self._stop.set()
+
+
+def run_daemon(spooldir, args):
+    """Run QUIP daemon from command line, until interrupted or terminated.
+
+    Parameters
+    ----------
+    spooldir : str
+        Spool directory to watch.
+
+    args : list of str
+        Other command line arguments. ``--max-jobs`` is the number of
+        operations to run at the same time (default is 1).
+        Also see :func:`~wss_tools.quip.main.main`.
+
+    """
+    options = quip_main._pop_options(args)
+    max_jobs = 1
+    for a in args:
+        if a.startswith('--max-jobs='):
+            try:
+                max_jobs = int(a.split('=')[1])
+            except Exception:
+                pass  # Use default
+
+    daemon = QUIPDaemon(spooldir, max_jobs=max_jobs, **options)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    print(f'{quip_main.__taskname__} daemon watching {daemon.spooldir} '
+          f'with up to {max_jobs} job(s)')
+    daemon.serve_forever()
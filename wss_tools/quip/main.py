@@ -6,29 +6,31 @@ For more information, see :ref:`running-quip-doc`.
 
 """
 # STDLIB
+import atexit
 import glob
 import multiprocessing
 import os
 import platform
 import shutil
 import sys
+import threading
 import warnings
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 
 # THIRD-PARTY
+import numpy as np
 from astropy.io import fits
 from astropy.utils.data import get_pkg_data_filename, get_pkg_data_filenames
 from astropy.utils.introspection import minversion
-from astropy.wcs import FITSFixedWarning
-
-# GINGA and STGINGA
-from ginga.rv import main as gmain
-from ginga.misc.Bunch import Bunch
 
 # LOCAL
 from . import qio
+from ..utils.cache import FileCache, file_signature
 from ..utils.recenter import recenter
-from ..utils.io import output_xml
+from ..utils.io import convert_image_file, make_image_hdu, output_xml
+from ..utils.mosaic import NircamMosaic
+from ..utils.quicklook import quicklook_filename, write_quicklook
 
 # Suppress logging "no handlers" message from Ginga
 import logging
@@ -38,21 +40,22 @@ try:
 except AttributeError:
     pass
 
-# Supress warning from astropy.wcs
-warnings.filterwarnings('ignore', category=FITSFixedWarning)
-
 __all__ = ['main', 'get_ginga_plugins', 'copy_ginga_files', 'set_ginga_config',
            'shrink_input_images']
 __taskname__ = 'QUIP'
 _operational = 'false'  # 'true' or 'false'
 _tempdirname = 'quipcache'  # Sub-dir to store temporary intermediate files
+_headless_op_types = ('thumbnail', 'segment_id', 'wavefront_maintenance')
+_thumbcachedirname = 'thumbnails'  # Sub-dir of quipcache for thumbnails
+_thumb_cache_size = 1024  # Default thumbnail cache size in MB
+# Defaults for stginga.utils.scale_image_with_dq
+_dq_defaults = {'dq_ext': ('DQ', 1), 'kernel_width': 99, 'bad_flag': 1,
+                'ignore_edge_pixels': 4}
 _iswin = platform.system() == 'Windows'
 _home = None
 QUIP_DIRECTIVE = None  # Store info from input XML
 QUIP_LOG = None  # Store info for output log XML
 
-STGINGA_GT_1_2 = minversion('stginga', '1.2.1')
-
 # Set HOME directory
 if 'HOME' in os.environ:
     _home = os.environ['HOME']
@@ -62,6 +65,28 @@ else:
     raise ValueError('Cannot find HOME directory')
 
 
+# NOTE: Ginga, stginga, and astropy.wcs are slow to import, so they are
+#       only imported when needed, e.g., when the viewer is launched.
+def __getattr__(name):
+    # For backward compatibility
+    if name == 'STGINGA_GT_1_2':
+        return _stginga_gt_1_2()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+@lru_cache(maxsize=1)
+def _stginga_gt_1_2():
+    """Whether installed stginga is newer than 1.2."""
+    return minversion('stginga', '1.2.1')
+
+
+@lru_cache(maxsize=1)
+def _ignore_fits_fixed_warnings():
+    """Supress warning from astropy.wcs."""
+    from astropy.wcs import FITSFixedWarning
+    warnings.filterwarnings('ignore', category=FITSFixedWarning)
+
+
 def main(args):
     """Driver for command line script.
 
@@ -71,12 +96,26 @@ def main(args):
     * ``--mosaic-thumb-size`` can be used to specify desired width in pixels
       for individual images to be mosaicked in ``THUMBNAIL`` mode.
       If not given, the default width is 500 pixels. For Segment ID,
-      the value is 256 regardless of this setting.
+      the mosaic uses 256 pixels per short-wavelength detector regardless
+      of this setting, but thumbnails of this width are also written
+      to ``quipcache`` from the same read of each detector, for later
+      ``THUMBNAIL`` operations on the same exposures.
+    * ``--thumb-cache-size`` can be used to specify the maximum size in MB
+      of the thumbnail cache in ``quipcache``, which can be shared by
+      several QUIP sessions. When exceeded, least recently used thumbnails
+      are removed. If not given, the default is 1024 MB.
     * ``--n-cores`` can be used to specify the number of CPU cores used when
-      rescaling images in ``THUMBNAIL`` mode. If not given, all available
+      rescaling images in ``THUMBNAIL`` mode, building mosaics in
+      ``SEGMENT_ID`` mode, or recentering images in
+      ``WAVEFRONT_MAINTENANCE`` mode. If not given, all available
       cores will be used.
     * ``--nocopy`` can be used with QUIP to instruct
       it to *not* copy its Ginga files to user's HOME directory.
+    * ``--headless`` can be used with ``THUMBNAIL`` or ``SEGMENT_ID``
+      to only make the thumbnails or mosaics in ``quipcache``, write the
+      QUIP Out XML listing them, and exit without starting Ginga
+      (which also implies ``--nocopy``). A later interactive session with
+      the same QUIP Operation XML reuses them.
     * ``--log=filename``, if given in command line, will be ignored
       because QUIP always writes Ginga's log to ``ginga.log`` in the
       output directory provided by QUIP Operation XML file.
@@ -94,9 +133,9 @@ def main(args):
     ValueError
         Input XML fails to validate built-in schema.
         Validation is skipped for Windows.
+        Or, ``--headless`` is given for an operation type that needs Ginga.
 
     """
-    from stginga.gingawrapper import _locate_plugin
     global QUIP_DIRECTIVE, QUIP_LOG
 
     inputxml = args.pop(0)
@@ -104,12 +143,7 @@ def main(args):
     if not os.path.exists(inputxml):
         raise OSError(f'{inputxml} does not exist')
 
-    # Validate input XML (compare return code and display stderr if fails).
-    # Skipped for Windows because no xmllint.
-    if not _iswin:
-        schema_v = qio.validate_input_xml(inputxml)
-        if schema_v[0] != 0:
-            raise ValueError(schema_v[2])
+    _validate_opfile(inputxml)
 
     if '--nocopy' in args:
         nocopy = True
@@ -117,45 +151,29 @@ def main(args):
     else:
         nocopy = False
 
+    if '--headless' in args:
+        headless = True
+        nocopy = True  # No Ginga
+        args.pop(args.index('--headless'))
+    else:
+        headless = False
+
     # Copy Ginga files to HOME directory
     if not nocopy:
         copy_ginga_files()
 
-    thumb_width = 500
-    n_cores = None
-
-    for i, a in enumerate(args):
-        # Ignore any custom log file provided by user
-        if a.startswith('--log='):
-            args.pop(i)
-        # Custom width for THUMBNAIL mode
-        elif a.startswith('--mosaic-thumb-size='):
-            args.pop(i)
-            try:
-                thumb_width = int(a.split('=')[1])
-            except Exception:
-                pass  # Use default
-        # Num cores for THUMBNAIL mode
-        elif a.startswith('--n-cores='):
-            args.pop(i)
-            try:
-                n_cores = int(a.split('=')[1])
-            except Exception:
-                pass  # Use default
+    options = _pop_options(args)
 
     # Extract info from input XML
     QUIP_DIRECTIVE = qio.input_xml(inputxml)
     gingalog = os.path.join(
         QUIP_DIRECTIVE['OUTPUT']['OUTPUT_DIRECTORY'], 'ginga.log')
-    images = QUIP_DIRECTIVE['IMAGES']['IMAGE_PATH']
     op_type = QUIP_DIRECTIVE['OPERATION_TYPE'].lower()
+    quipout = QUIP_DIRECTIVE['OUTPUT']['OUT_FILE_PATH']
 
-    # Create hidden temporary directory, in case we need it later.
-    # This is NOT automatically deleted.
-    tempdir = os.path.join(
-        os.path.dirname(os.path.abspath(inputxml)), _tempdirname)
-    if not os.path.exists(tempdir):
-        os.mkdir(tempdir)
+    if headless and op_type not in _headless_op_types:
+        raise ValueError(f'{op_type.upper()} cannot run headless, must be '
+                         f'one of {[t.upper() for t in _headless_op_types]}')
 
     # Initialize info for log XML.
     # Do this here for time stamp and avoid circular import.
@@ -165,49 +183,24 @@ def main(args):
     if os.path.exists(gingalog):
         os.remove(gingalog)
 
-    # Wavefront Maintenance will trigger QUIP Automatic Mode run a utility to
-    # recenter the images if needed and not launch ginga
-    if op_type == 'wavefront_maintenance':
-        output_images = recenter(images,
-                                 QUIP_DIRECTIVE['OUTPUT']['OUTPUT_DIRECTORY'],
-                                 doplot=False)
-        quipout = QUIP_DIRECTIVE['OUTPUT']['OUT_FILE_PATH']
-        output_xml(qio.quip_out_dict(output_images), quipout)
-        return
-    elif op_type == 'thumbnail':
-        cfgmode = 'mosaicmode'
-        ginga_config_py_sfx = op_type
-        sci_ext = ('SCI', 1)
-
-        # Science array can have different EXTNAME values:
-        #   SCI (JWST/HST) or IMAGE (test)
-        # Assume first image is representative of all the rest.
-        with fits.open(images[0]) as pf:
-            if sci_ext not in pf:
-                sci_ext = ('IMAGE', 1)
-
-        # Auto guess the number of CPU cores needed.
-        if n_cores is None:
-            n_cores = min(multiprocessing.cpu_count(), len(images))
-
-        if STGINGA_GT_1_2:
-            shrink_extra_kwargs = {'sci_ext': sci_ext, 'use_dq': True}
-        else:
-            shrink_extra_kwargs = {'ext': sci_ext}
+    images = _preprocess(inputxml, QUIP_DIRECTIVE, **options)
 
-        images = shrink_input_images(
-            images, new_width=thumb_width, n_cores=n_cores,
-            outpath=tempdir, **shrink_extra_kwargs)
-
-    elif op_type == 'segment_id':
+    if op_type in ('thumbnail', 'segment_id'):
         cfgmode = 'mosaicmode'
         ginga_config_py_sfx = op_type
-        images = _segid_mosaics(images, outpath=tempdir, sw_sca_size=256)
-
     else:  # different kinds of analysis
         cfgmode = 'normalmode'
         ginga_config_py_sfx = cfgmode
 
+    # Products are ready; Viewer can pick them up from quipcache later.
+    if headless or op_type == 'wavefront_maintenance':
+        output_xml(qio.quip_out_dict(images), quipout)
+        return
+
+    # Only now that the viewer is launched
+    from ginga.rv import main as gmain
+    from stginga.gingawrapper import _locate_plugin
+
     # Add custom plugins.
     # NOTE: There was a bug with setting this in ginga_config.py,
     #       so we do this here instead.
@@ -228,6 +221,134 @@ def main(args):
     gmain.reference_viewer(sys_args)
 
 
+def _validate_opfile(inputxml):
+    """Validate QUIP Operation XML against built-in schema.
+    Skipped for Windows because no xmllint.
+
+    Raises
+    ------
+    ValueError
+        Validation failed, with error from ``xmllint``.
+
+    """
+    # Compare return code and display stderr if fails.
+    if not _iswin:
+        schema_v = qio.validate_input_xml(inputxml)
+        if schema_v[0] != 0:
+            raise ValueError(schema_v[2])
+
+
+def _pop_options(args):
+    """Remove QUIP options for pre-processing from the given command line
+    arguments and return their values, as keywords for :func:`_preprocess`.
+    Invalid values are ignored. See :func:`main` for details.
+
+    """
+    options = {}
+
+    for a in list(args):
+        # Ignore any custom log file provided by user
+        if a.startswith('--log='):
+            args.remove(a)
+            continue
+
+        # Custom width for THUMBNAIL mode
+        if a.startswith('--mosaic-thumb-size='):
+            key = 'thumb_width'
+        # Size limit of thumbnail cache for THUMBNAIL and SEGMENT_ID
+        elif a.startswith('--thumb-cache-size='):
+            key = 'thumb_cache_size'
+        # Num cores for THUMBNAIL, SEGMENT_ID, and WAVEFRONT_MAINTENANCE
+        elif a.startswith('--n-cores='):
+            key = 'n_cores'
+        else:
+            continue
+
+        args.remove(a)
+        try:
+            options[key] = int(a.split('=')[1])
+        except Exception:
+            pass  # Use default
+
+    return options
+
+
+def _preprocess(inputxml, quip_directive, thumb_width=500,
+                thumb_cache_size=_thumb_cache_size, n_cores=None,
+                mp_context=None):
+    """Run the part of a QUIP operation that does not need Ginga.
+
+    Parameters
+    ----------
+    inputxml : str
+        QUIP Operation XML file. Intermediate products are stored in
+        ``quipcache`` sub-directory next to it.
+
+    quip_directive : dict
+        Content of ``inputxml``, as returned by
+        :func:`~wss_tools.quip.qio.input_xml`.
+
+    thumb_width, thumb_cache_size, n_cores
+        See :func:`main`.
+
+    mp_context : `multiprocessing` context or `None`
+        Context to start new worker processes with for
+        ``WAVEFRONT_MAINTENANCE`` and ``SEGMENT_ID``, e.g., when called
+        from a thread. If not given, the default context is used.
+
+    Returns
+    -------
+    images : list
+        Images to display, or to list in QUIP Out XML.
+
+    """
+    images = quip_directive['IMAGES']['IMAGE_PATH']
+    op_type = quip_directive['OPERATION_TYPE'].lower()
+
+    # Create hidden temporary directory, in case we need it later.
+    # This is NOT automatically deleted.
+    tempdir = os.path.join(
+        os.path.dirname(os.path.abspath(inputxml)), _tempdirname)
+    os.makedirs(tempdir, exist_ok=True)
+    thumb_cache_kwargs = {
+        'cachedir': os.path.join(tempdir, _thumbcachedirname),
+        'cache_size': thumb_cache_size * 1024 * 1024}
+
+    # Wavefront Maintenance will trigger QUIP Automatic Mode run a utility to
+    # recenter the images if needed and not launch ginga
+    if op_type == 'wavefront_maintenance':
+        return recenter(images, quip_directive['OUTPUT']['OUTPUT_DIRECTORY'],
+                        n_workers=n_cores, saveplot=True,
+                        plot_in_background=True, cachedir=tempdir,
+                        mp_context=mp_context)
+
+    _ignore_fits_fixed_warnings()
+
+    if op_type == 'thumbnail':
+        # Auto guess the number of CPU cores needed.
+        if n_cores is None:
+            n_cores = min(multiprocessing.cpu_count(), len(images))
+
+        # Science array can have different EXTNAME values:
+        #   SCI (JWST/HST) or IMAGE (test)
+        # This is found from the headers of each image when shrinking.
+        shrink_extra_kwargs = {'use_dq': _stginga_gt_1_2()}
+
+        images = shrink_input_images(
+            images, new_width=thumb_width, n_cores=n_cores,
+            outpath=tempdir, **thumb_cache_kwargs, **shrink_extra_kwargs)
+
+    elif op_type == 'segment_id':
+        images = _segid_mosaics(
+            images, outpath=tempdir, sw_sca_size=256,
+            thumb_width=thumb_width, cachedir=tempdir,
+            thumb_cachedir=thumb_cache_kwargs['cachedir'],
+            thumb_cache_size=thumb_cache_kwargs['cache_size'],
+            n_workers=n_cores, mp_context=mp_context)
+
+    return images
+
+
 def get_ginga_plugins(op_type):
     """Obtain relevant custom plugins from ``stginga`` and ``wss_tools``
     for the given QUIP operation type.
@@ -247,6 +368,8 @@ def get_ginga_plugins(op_type):
         List of custom Ginga local plugins to load.
 
     """
+    from ginga.misc.Bunch import Bunch
+
     stg_pfx = 'stginga.plugins'
     wss_pfx = 'wss_tools.quip.plugins'
     global_plugins = [
@@ -357,74 +480,151 @@ def set_ginga_config(mode='normalmode', gcfg_suffix='normalmode',
         _do_copy(src, src.replace(sfx, ''), verbose=verbose)
 
 
-# Iterable (infile) must be last argument.
-def _shrink_one(outpath, ext, new_width, debug, kwargs, infile):
+# Iterable (task) must be last argument.
+def _shrink_one(out_kwargs, kwargs, task):
+    """Shrink image, given as ``(infile, outfile, zoom_factor, ext)``."""
     from stginga.utils import scale_image
 
-    with fits.open(infile) as pf:
-        old_width = pf[ext].data.shape[1]  # (ny, nx)
+    infile, outfile, zoom_factor, ext = task
+    scale_image(infile, outfile, zoom_factor, ext=ext, **kwargs)
+    _finish_shrunk(outfile, **out_kwargs)
+    return outfile
 
-    # Shrink it.
-    if old_width > new_width:
-        path, fname = os.path.split(infile)
 
-        # Skipping instead of just returning the input image
-        # because want to avoid mosaicking large images.
-        if os.path.abspath(path) == outpath:
-            print('Input and output directories are the same: '
-                  f'{outpath}; Skipping {fname}')
-            outfile = ''
-        else:
-            outfile = os.path.join(outpath, fname)
-            zoom_factor = new_width / old_width
-            scale_image(infile, outfile, zoom_factor, **kwargs)
+# Iterable (task) must be last argument.
+def _shrink_one_with_dq(dq_parser, out_kwargs, kwargs, task):
+    """Same as :func:`_shrink_one` but taking DQ into account."""
+    from stginga.utils import scale_image_with_dq  # noqa
 
-    # Input already small enough.
-    else:
-        outfile = infile
-        if debug:
-            print(f'{infile} has width {old_width} <= {new_width}; '
-                  'Using input file')
+    if dq_parser is None:
+        dq_parser = _jwst_dq_parser()
 
+    infile, outfile, zoom_factor, ext = task
+    scale_image_with_dq(infile, outfile, zoom_factor, dq_parser,
+                        sci_ext=ext, **kwargs)
+    _finish_shrunk(outfile, **out_kwargs)
     return outfile
 
 
-# Iterable (infile) must be last argument.
-def _shrink_one_with_dq(outpath, sci_ext, new_width, dq_parser, debug, kwargs,
-                        infile):
-    from stginga.utils import scale_image_with_dq  # noqa
+def _read_image_meta(filename):
+    """Read metadata needed to shrink an image from its headers only.
 
-    with fits.open(infile) as pf:
-        old_width = pf[sci_ext].data.shape[1]  # (ny, nx)
+    Returns
+    -------
+    meta : dict
+        INSTRUME, DETECTOR, and ``(EXTNAME, EXTVER, shape)`` of each
+        extension, in order.
 
-    # Shrink it.
-    if old_width > new_width:
-        path, fname = os.path.split(infile)
+    """
+    with fits.open(filename) as pf:
+        hdus = [(hdu.name.upper(), hdu.ver, tuple(
+            hdu.header.get(f'NAXIS{i}', 0)
+            for i in range(hdu.header.get('NAXIS', 0), 0, -1)))
+            for hdu in pf]
+        prihdr = pf[0].header
+        return {'instrume': prihdr.get('INSTRUME', ''),
+                'detector': prihdr.get('DETECTOR', ''),
+                'hdus': hdus}
 
-        # Skipping instead of just returning the input image
-        # because want to avoid mosaicking large images.
-        if os.path.abspath(path) == outpath:
-            print('Input and output directories are the same: '
-                  f'{outpath}; Skipping {fname}')
-            outfile = ''
-        else:
-            outfile = os.path.join(outpath, fname)
-            zoom_factor = new_width / old_width
-            scale_image_with_dq(infile, outfile, zoom_factor, dq_parser,
-                                **kwargs)
 
-    # Input already small enough.
-    else:
-        outfile = infile
-        if debug:
-            print(f'{infile} has width {old_width} <= {new_width}; '
-                  'Using input file')
+def _find_ext_shape(meta, ext):
+    """Shape of the given extension from :func:`_read_image_meta`,
+    or `None` if it does not exist.
+
+    """
+    if isinstance(ext, int):
+        if ext < len(meta['hdus']):
+            return meta['hdus'][ext][2]
+        return None
+
+    if isinstance(ext, str):
+        ext = (ext, 1)
+    name, ver = ext[0].upper(), ext[1]
+    for hduname, hduver, shape in meta['hdus']:
+        if hduname == name and hduver == ver:
+            return shape
+    return None
+
+
+def _finish_shrunk(outfile, dtype=np.float32, quantize=None, quicklook=None,
+                   quicklook_kwargs=None):
+    """Convert shrunken image to requested data type and write its
+    quicklook image, if requested.
+
+    """
+    convert_image_file(outfile, dtype=dtype, quantize=quantize)
+
+    if quicklook:
+        write_quicklook(fits.getdata(outfile),
+                        quicklook_filename(outfile, fmt=quicklook),
+                        **(quicklook_kwargs or {}))
+
+
+# Persistent pool for shrink_input_images, as (n_cores, pool),
+# only started by long-running processes, i.e., QUIP daemon.
+_shrink_pool = None
+_shrink_pool_lock = threading.Lock()  # For concurrent QUIP daemon jobs
+
+
+def _init_shrink_worker():
+    """Warm up a worker: import stginga and build default DQ parser."""
+    import stginga.utils  # noqa: F401
+    _ignore_fits_fixed_warnings()
+    _jwst_dq_parser()
+
+
+def _new_shrink_pool(n_cores):
+    """New worker pool for shrinking images."""
+    return multiprocessing.Pool(n_cores, initializer=_init_shrink_worker)
+
+
+def _get_shrink_pool(n_cores, create=False):
+    """Persistent worker pool for shrinking images with the given number
+    of cores, or `None` if there is none. If ``create=True`` and there is
+    none, it is started and kept until :func:`_close_shrink_pool`.
+    A pool with a different number of cores is never replaced,
+    because it may be in use by another thread.
+
+    """
+    global _shrink_pool
+
+    with _shrink_pool_lock:
+        if _shrink_pool is None:
+            if not create:
+                return None
+            _shrink_pool = (n_cores, _new_shrink_pool(n_cores))
+        if _shrink_pool[0] != n_cores:
+            return None
+        return _shrink_pool[1]
 
-    return outfile
+
+def _close_shrink_pool():
+    """Shut down persistent worker pool, if any."""
+    global _shrink_pool
+
+    if _shrink_pool is not None:
+        _shrink_pool[1].terminate()
+        _shrink_pool[1].join()
+        _shrink_pool = None
+
+
+atexit.register(_close_shrink_pool)
+
+
+# Iterable (task) must be last argument.
+def _shrink_indexed(func, task):
+    """Run shrinking function on ``(index, task)`` and return
+    ``(index, outfile)``.
+
+    """
+    i, task = task
+    return i, func(task)
 
 
 def shrink_input_images(images, outpath='', new_width=500, n_cores=1,
-                        use_dq=False, **kwargs):
+                        use_dq=False, dtype=np.float32, quantize=None,
+                        quicklook=None, quicklook_kwargs=None, cachedir=None,
+                        cache_size=None, **kwargs):
     """Shrink input images for mosaic, if necessary.
 
     The shrunken images are not deleted on exit;
@@ -446,12 +646,43 @@ def shrink_input_images(images, outpath='', new_width=500, n_cores=1,
         be the exact one that you get but should be close.
 
     n_cores : int
-        Number of CPU cores to use.
+        Number of CPU cores to use. Worker processes are stopped before
+        returning, unless they belong to the persistent pool of
+        a long-running process with the same number of cores,
+        e.g., QUIP daemon.
 
     use_dq : bool
         Use :func:`~stginga.utils.scale_image_with_dq` instead of
         :func:`~stginga.utils.scale_image`.
 
+    dtype : data-type
+        Floating point data type of the shrunken images.
+
+    quantize : {`None`, 'uint8', 'int16', 'int32'}
+        If given, shrunken images are written as scaled integers of this
+        type instead, which is lossy but smaller.
+        See :func:`~wss_tools.utils.io.make_image_hdu`.
+
+    quicklook : {`None`, 'png', 'jpg', 'jpeg'}
+        If given, also write a quicklook image of each shrunken image
+        next to it, in this format.
+
+    quicklook_kwargs : dict or `None`
+        Optional keywords for
+        :func:`~wss_tools.utils.quicklook.write_quicklook`.
+
+    cachedir : str or `None`
+        If given, shrunken images are stored in this content-addressed
+        cache instead of ``outpath``, keyed on the input file and all
+        the settings above, and reused by subsequent calls.
+        It can be shared by several processes.
+        See :class:`~wss_tools.utils.cache.FileCache`.
+
+    cache_size : int or `None`
+        Maximum size of ``cachedir`` in bytes. When exceeded, least
+        recently used images are removed, except those returned here.
+        If `None`, cache grows without limit.
+
     kwargs : dict
         Optional keywords for the ``stginga`` function chosen using
         ``use_dq`` keyword.
@@ -460,51 +691,126 @@ def shrink_input_images(images, outpath='', new_width=500, n_cores=1,
     -------
     outlist : list
         List of images to use. If shrunken, the list will include
-        the new image in the ``outpath`` (same filename).
+        the new image in the ``outpath`` or a sub-directory of
+        ``cachedir`` (same filename).
         If the input is already small enough, shrinking process is
         skipped and the list will contain the input image instead.
 
     """
+    _ignore_fits_fixed_warnings()
     outpath = os.path.abspath(outpath)
     debug = kwargs.get('debug', False)
+    out_kwargs = {'dtype': dtype, 'quantize': quantize,
+                  'quicklook': quicklook,
+                  'quicklook_kwargs': quicklook_kwargs}
+
+    # Extension given for the stginga function applies to all images.
+    # Otherwise, it is SCI (JWST/HST) or IMAGE (test), whichever exists.
+    ext = kwargs.pop('sci_ext' if use_dq else 'ext', None)
+    if ext is None:
+        exts = (('SCI', 1), ('IMAGE', 1))
+    else:
+        exts = (ext, )
 
     if use_dq:
-        from stginga.utils import DQParser
-
-        # Use same extension as scale_image_with_dq
-        if 'sci_ext' in kwargs:
-            ext = kwargs['sci_ext']
-        else:
-            ext = ('SCI', 1)
-            kwargs['sci_ext'] = ext
+        # Default DQ parser is built once per process, not sent to workers.
+        func = partial(_shrink_one_with_dq, None, out_kwargs, kwargs)
+    else:
+        func = partial(_shrink_one, out_kwargs, kwargs)
 
-        # Use default JWST DQ definition
-        dq_parser = DQParser(get_pkg_data_filename(
-            os.path.join('data', 'dqflags_jwst.txt'), package='stginga'))
+    if debug:
+        import time
+        t1 = time.time()
 
-        func = partial(_shrink_one_with_dq, outpath, ext, new_width, dq_parser,
-                       debug, kwargs)
+    # Decide what to do with each image from headers alone.
+    if n_cores > 1 and len(images) > 1:
+        with ThreadPoolExecutor(n_cores) as executor:
+            metas = list(executor.map(_read_image_meta, images))
+    else:
+        metas = list(map(_read_image_meta, images))
 
+    if cachedir is None:
+        cache = None
     else:
-        # Use same extension as scale_image
-        if 'ext' in kwargs:
-            ext = kwargs['ext']
+        cache = FileCache(cachedir, max_size=cache_size)
+    keys = []
+    staged = {}  # Index: (key, staging dir)
+
+    result = [''] * len(images)
+    tasks = []
+    for i, (infile, meta) in enumerate(zip(images, metas)):
+        for ext in exts:
+            shape = _find_ext_shape(meta, ext)
+            if shape is not None:
+                break
         else:
-            ext = ('SCI', 1)
-            kwargs['ext'] = ext
+            warnings.warn(f'{infile} has no {exts[0]} extension; Skipping')
+            continue
 
-        func = partial(_shrink_one, outpath, ext, new_width, debug, kwargs)
+        old_width = shape[-1]  # (ny, nx)
 
-    if debug:
-        import time
-        t1 = time.time()
+        # Input already small enough.
+        if old_width <= new_width:
+            result[i] = infile
+            if debug:
+                print(f'{infile} has width {old_width} <= {new_width}; '
+                      'Using input file')
+            continue
 
-    if n_cores < 2:  # No multiprocessing
-        outlist = [s for s in map(func, images) if s]
-    else:
-        with multiprocessing.Pool(n_cores) as p:
-            result = p.map(func, images)
-        outlist = [s for s in result if s]
+        path, fname = os.path.split(infile)
+
+        if cache is not None:
+            key = _thumbnail_key(infile, new_width, use_dq, ext, out_kwargs,
+                                 kwargs)
+            keys.append(key)
+            entry = cache.get(key)
+            if entry is not None:
+                result[i] = os.path.join(entry, fname)
+                continue
+            staged[i] = (key, cache.stage())
+            outfile = os.path.join(staged[i][1], fname)
+
+        # Skipping instead of just returning the input image
+        # because want to avoid mosaicking large images.
+        elif os.path.abspath(path) == outpath:
+            print('Input and output directories are the same: '
+                  f'{outpath}; Skipping {fname}')
+            continue
+
+        else:
+            outfile = os.path.join(outpath, fname)
+
+        tasks.append((i, (infile, outfile, new_width / old_width, ext)))
+
+    own_pool = None
+    try:
+        if n_cores < 2 or len(tasks) < 2:  # No multiprocessing
+            done = ((i, func(task)) for i, task in tasks)
+        else:
+            # Reuse warm workers, if any; results come back in any order,
+            # so put them back in input order.
+            p = _get_shrink_pool(n_cores)
+            if p is None:
+                p = own_pool = _new_shrink_pool(n_cores)
+            chunksize = max(1, len(tasks) // (n_cores * 4))
+            done = p.imap_unordered(partial(_shrink_indexed, func), tasks,
+                                    chunksize=chunksize)
+        for i, s in done:
+            if i in staged:
+                key, stagedir = staged.pop(i)
+                s = os.path.join(cache.put(key, stagedir),
+                                 os.path.basename(s))
+            result[i] = s
+    finally:
+        if own_pool is not None:
+            own_pool.terminate()
+            own_pool.join()
+        for key, stagedir in staged.values():  # Failed or unfinished
+            shutil.rmtree(stagedir, ignore_errors=True)
+        if cache is not None:
+            cache.evict(keep=keys)
+
+    outlist = [s for s in result if s]
 
     if debug:
         t2 = time.time()
@@ -514,7 +820,144 @@ def shrink_input_images(images, outpath='', new_width=500, n_cores=1,
     return outlist
 
 
-def _segid_mosaics(images, sw_sca_size=256, **kwargs):
+def _thumbnail_key(infile, new_width, use_dq, ext, out_kwargs, kwargs):
+    """Key of shrunken image in thumbnail cache, from input file identity
+    and everything that affects the output.
+
+    """
+    stginga_kwargs = {**_dq_defaults} if use_dq else {}
+    stginga_kwargs.update(kwargs)
+    stginga_kwargs.pop('debug', None)
+    return FileCache.make_key({
+        'input': file_signature(infile), 'new_width': new_width,
+        'use_dq': use_dq, 'ext': ext,
+        'out': {**out_kwargs, 'dtype': np.dtype(out_kwargs['dtype']).str},
+        'kwargs': stginga_kwargs})
+
+
+@lru_cache(maxsize=1)
+def _jwst_dq_parser():
+    """DQ parser with default JWST DQ definition, built once per process."""
+    from stginga.utils import DQParser
+    return DQParser(get_pkg_data_filename(
+        os.path.join('data', 'dqflags_jwst.txt'), package='stginga'))
+
+
+def _shrink_hdul_with_dq(pf, outfile, zoom_factor, dq_parser,
+                         sci_ext=('SCI', 1), dq_ext=('DQ', 1), kernel_width=99,
+                         bad_flag=1, ignore_edge_pixels=4, dtype=np.float32):
+    """Same as :func:`~stginga.utils.scale_image_with_dq` but for an
+    already open HDU list, so that its data can be used for other products.
+    Input data are not modified.
+
+    This mirrors ``scale_image_with_dq`` of stginga 1.6, which only takes
+    filenames, step by step (including the dtype zoom is done in), so the
+    thumbnails are the same as those of :func:`shrink_input_images`.
+
+    """
+    from astropy.convolution import Box2DKernel, convolve_fft
+    from scipy.ndimage import zoom
+    from stginga.utils import scale_wcs
+
+    prihdr = pf['PRIMARY'].header
+    hdr = pf[sci_ext].header.copy()
+    data = np.array(pf[sci_ext].data)  # Copy to fix bad pixels
+    dq = pf[dq_ext].data
+
+    if data.ndim != 2:
+        raise ValueError(f'Unsupported ndim={data.ndim}')
+
+    # Inherit some keywords from primary header
+    for key in ('ROOTNAME', 'TARGNAME', 'INSTRUME', 'DETECTOR',
+                'FILTER', 'PUPIL', 'DATE-OBS', 'TIME-OBS'):
+        if (key in hdr) or (key not in prihdr):
+            continue
+        hdr[key] = prihdr[key]
+
+    # Bad pixels, except along the edges
+    badpix_mask = np.zeros(dq.shape, dtype=bool)
+    badpix_mask[dq_parser.interpret_array(dq)[bad_flag]] = True
+    iy_max = data.shape[0] - ignore_edge_pixels
+    ix_max = data.shape[1] - ignore_edge_pixels
+    edge_mask = np.ones(dq.shape, dtype=bool)
+    edge_mask[ignore_edge_pixels:iy_max, ignore_edge_pixels:ix_max] = False
+    badpix_mask[edge_mask] = False
+
+    # Fix bad pixels with convolution
+    if np.any(badpix_mask):
+        smoothed_data = convolve_fft(data, Box2DKernel(kernel_width),
+                                     mask=badpix_mask)
+        data[badpix_mask] = smoothed_data[badpix_mask]
+
+    if not np.all(np.isfinite(data)):
+        raise ValueError('Fixed image has NaN(s)')
+
+    data = zoom(data, zoom_factor)
+    make_image_hdu(data, header=scale_wcs(hdr, zoom_factor),
+                   dtype=dtype).writeto(outfile)
+
+
+class _SegmentIDMosaic(NircamMosaic):
+    """NIRCam mosaic that also writes a DQ-aware thumbnail of each detector
+    it reads, as :func:`shrink_input_images` would in THUMBNAIL mode,
+    so that the full frame is read only once.
+
+    """
+    # Same as shrink_input_images defaults, for same thumbnail cache keys.
+    _thumb_out_kwargs = {'dtype': np.float32, 'quantize': None,
+                         'quicklook': None, 'quicklook_kwargs': None}
+
+    def __init__(self, thumb_outpath, thumb_width, thumb_cache=None,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.thumb_outpath = os.path.abspath(thumb_outpath)
+        self.thumb_width = thumb_width
+        self.thumb_cache = thumb_cache
+        self._dq_parser = _jwst_dq_parser()
+
+    def thumb_key(self, filename):
+        """Key of thumbnail of the given file in thumbnail cache."""
+        return _thumbnail_key(filename, self.thumb_width, True, self.data_ext,
+                              self._thumb_out_kwargs, {})
+
+    def _read_data(self, info):
+        path, fname = os.path.split(info['filename'])
+        make_thumb = info['shape'][-1] > self.thumb_width
+        stagedir = None
+
+        if not make_thumb:
+            pass
+        elif self.thumb_cache is not None:
+            key = self.thumb_key(info['filename'])
+            make_thumb = self.thumb_cache.get(key) is None
+            if make_thumb:
+                stagedir = self.thumb_cache.stage()
+                outfile = os.path.join(stagedir, fname)
+        else:
+            outfile = os.path.join(self.thumb_outpath, fname)
+            make_thumb = (os.path.abspath(path) != self.thumb_outpath and
+                          not os.path.exists(outfile))
+
+        with fits.open(info['filename']) as pf:
+            data = pf[self.data_ext].data
+            if make_thumb:
+                try:
+                    _shrink_hdul_with_dq(
+                        pf, outfile, self.thumb_width / data.shape[1],
+                        self._dq_parser, sci_ext=self.data_ext)
+                    if stagedir is not None:
+                        self.thumb_cache.put(key, stagedir)
+                except Exception as e:  # Mosaic is still useful without it
+                    warnings.warn(f'No thumbnail for {fname}: {repr(e)}')
+                    if stagedir is not None:
+                        shutil.rmtree(stagedir, ignore_errors=True)
+
+        return data
+
+
+def _segid_mosaics(images, sw_sca_size=256, pyramid=None, thumb_width=None,
+                   cachedir=None, thumb_cachedir=None, thumb_cache_size=None,
+                   **kwargs):
     """Generate a scaled-down NIRCam mosaic for each exposure.
 
     The mosaics are not deleted on exit;
@@ -525,6 +968,20 @@ def _segid_mosaics(images, sw_sca_size=256, **kwargs):
     images : list
         List of input image files.
 
+    sw_sca_size, pyramid, cachedir
+        See :class:`~wss_tools.utils.mosaic.NircamMosaic`.
+
+    thumb_width : int or `None`
+        If given, also write DQ-aware thumbnails of this width to the
+        output directory from the same read of each detector, as
+        :func:`shrink_input_images` would for THUMBNAIL mode,
+        so that later operations can reuse them.
+
+    thumb_cachedir, thumb_cache_size
+        If given, thumbnails are written to this thumbnail cache instead
+        of the output directory. See ``cachedir`` and ``cache_size`` in
+        :func:`shrink_input_images`.
+
     kwargs
         See :meth:`~wss_tools.utils.mosaic.NircamMosaic.make_mosaic`.
 
@@ -534,16 +991,41 @@ def _segid_mosaics(images, sw_sca_size=256, **kwargs):
         List of scaled-down mosaics in output directory.
 
     """
-    from ..utils.mosaic import NircamMosaic
-    m = NircamMosaic(sw_sca_size=sw_sca_size)
-    return m.make_mosaic(images, **kwargs)
+    mos_kwargs = {'sw_sca_size': sw_sca_size, 'pyramid': pyramid,
+                  'cachedir': cachedir}
+    if thumb_width is None:
+        return NircamMosaic(**mos_kwargs).make_mosaic(images, **kwargs)
+
+    if thumb_cachedir is None:
+        thumb_cache = None
+    else:
+        thumb_cache = FileCache(thumb_cachedir, max_size=thumb_cache_size)
+    m = _SegmentIDMosaic(kwargs.get('outpath', ''), thumb_width,
+                         thumb_cache=thumb_cache, **mos_kwargs)
+    try:
+        return m.make_mosaic(images, **kwargs)
+    finally:
+        # Thumbnails are made in worker processes, so their keys are
+        # found here instead.
+        if thumb_cache is not None:
+            keep = []
+            for filename in images:
+                try:
+                    keep.append(m.thumb_key(filename))
+                except OSError:  # Input removed meanwhile
+                    pass
+            thumb_cache.evict(keep=keep)
 
 
 def _main():
     """Run from command line."""
     if len(sys.argv) <= 1:
         print('USAGE: quip operation_file.xml [--mosaic-thumb-size=500] '
-              '[--n-cores=8] [--nocopy] [--help]')
+              '[--thumb-cache-size=1024] [--n-cores=8] [--nocopy] '
+              '[--headless] [--help]')
+        print('       quip --daemon=spool_dir [--max-jobs=1] '
+              '[--mosaic-thumb-size=500] [--thumb-cache-size=1024] '
+              '[--n-cores=8]')
     elif '--help' in sys.argv:
         from ginga.rv.main import reference_viewer
         reference_viewer(['ginga', '--help'])
@@ -553,5 +1035,8 @@ def _main():
         except ImportError:
             version = 'unknown'
         print(f'{__taskname__} v{version}')
+    elif sys.argv[1].startswith('--daemon='):
+        from .daemon import run_daemon
+        run_daemon(sys.argv[1].split('=', 1)[1], sys.argv[2:])
     else:
         main(sys.argv[1:])
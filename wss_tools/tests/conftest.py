@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+
+@pytest.fixture
+def umask():
+    """Process umask, to check permissions of files created by tests."""
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def _make_nircam_image(filename, detector, value=None, shape=(256, 256),
+                       dq=False):
+    prihdr = fits.Header({'INSTRUME': 'NIRCAM', 'DETECTOR': detector,
+                          'TARGNAME': 'FOO', 'FILTER': 'F212N'})
+    if value is None:
+        rng = np.random.default_rng(len(detector))
+        data = rng.random(shape, dtype=np.float32)
+    else:
+        data = np.full(shape, value, dtype=np.float32)
+    hdul = fits.HDUList([fits.PrimaryHDU(header=prihdr),
+                         fits.ImageHDU(data, name='SCI')])
+    if dq:
+        dqdata = np.zeros(shape, dtype=np.uint32)
+        dqdata[100, 100] = 1  # DO_NOT_USE
+        hdul.append(fits.ImageHDU(dqdata, name='DQ'))
+    hdul.writeto(filename)
+    return filename
+
+
+@pytest.fixture
+def make_nircam_image():
+    """Function to write a NIRCam image, as
+    ``make_nircam_image(filename, detector, value=None, shape=(256, 256),
+    dq=False)``, which returns the filename. SCI data are filled with
+    ``value`` if given, otherwise with random values that are the same
+    for each detector. If ``dq=True``, DQ extension is added with one
+    bad pixel at ``(100, 100)``.
+
+    """
+    return _make_nircam_image
@@ -0,0 +1,469 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from wss_tools.utils.mosaic import NircamMosaic
+
+# Detector values used to identify where each detector lands in the mosaic
+DETECTORS = {'NRCA1': 1, 'NRCA2': 2, 'NRCA3': 3, 'NRCA4': 4, 'NRCALONG': 5,
+             'NRCB1': 6, 'NRCB2': 7, 'NRCB3': 8, 'NRCB4': 9, 'NRCBLONG': 10}
+
+# Small SCA so tests run fast. With sw_sca_size=512, zoom factor is 1/4.
+SCA_SIZE = 256
+SW_SCA_SIZE = 512
+
+
+def _make_dataset(make_image, path, rootname, detectors=DETECTORS):
+    return [make_image(
+        os.path.join(path, f'{rootname}_{det.lower()}_cal.fits'), det,
+        DETECTORS[det]) for det in detectors]
+
+
+@pytest.fixture
+def datasets(tmpdir, make_nircam_image):
+    path = tmpdir.mkdir('inputs').strpath
+    return (_make_dataset(make_nircam_image, path,
+                          'jw00001001001_01101_00002') +
+            _make_dataset(make_nircam_image, path,
+                          'jw00001001001_01101_00001'))
+
+
+def _check_full_mosaic(mosaic):
+    # SW SCA = 64, SCA gap = 46, LW SCA = 134, module gap = 312
+    assert mosaic.shape == (620, 660)
+
+    # Module A (left), then Module B (right) at x offset 174 + 312
+    for x0, dets in ((0, ('NRCA1', 'NRCA2', 'NRCA3', 'NRCA4', 'NRCALONG')),
+                     (486, ('NRCB4', 'NRCB3', 'NRCB2', 'NRCB1', 'NRCBLONG'))):
+        lower_left, upper_left, lower_right, upper_right, lw = [
+            DETECTORS[d] for d in dets]
+        np.testing.assert_allclose(mosaic[32, x0 + 32], lower_left)
+        np.testing.assert_allclose(mosaic[142, x0 + 32], upper_left)
+        np.testing.assert_allclose(mosaic[32, x0 + 142], lower_right)
+        np.testing.assert_allclose(mosaic[142, x0 + 142], upper_right)
+        np.testing.assert_allclose(mosaic[553, x0 + 67], lw)
+
+        # Gaps
+        assert mosaic[32, x0 + 87] == 0
+        assert mosaic[200, x0 + 32] == 0
+
+    # Gap between modules
+    assert mosaic[300, 300] == 0
+
+
+@pytest.mark.parametrize('resample_method', ['area', 'spline'])
+def test_single_mosaic_array(datasets, resample_method):
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE, resample_method=resample_method)
+    _check_full_mosaic(m.get_single_mosaic_array(datasets[:10]))
+
+
+@pytest.mark.parametrize('n_threads', [2, 3])
+def test_single_mosaic_array_threaded(tmpdir, datasets, n_threads):
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE, n_threads=n_threads)
+    _check_full_mosaic(m.get_single_mosaic_array(datasets[:10]))
+
+    # Pipeline also works with tile cache
+    m.cachedir = tmpdir.mkdir('quipcache').strpath
+    for _ in range(2):
+        _check_full_mosaic(m.get_single_mosaic_array(datasets[:10]))
+    assert len(os.listdir(os.path.join(m.cachedir, 'mosaic_tiles'))) == 10
+
+
+def test_single_mosaic_array_threaded_error(datasets):
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE, n_threads=2)
+    header_index = m.build_header_index(datasets[:10])
+    os.remove(datasets[3])
+    with pytest.raises(FileNotFoundError):
+        m.get_single_mosaic_array(datasets[:10], header_index=header_index)
+
+
+def test_single_mosaic_array_dtype(datasets):
+    assert NircamMosaic(sw_sca_size=SW_SCA_SIZE).get_single_mosaic_array(
+        datasets[:10]).dtype == np.float32
+    mosaic = NircamMosaic(
+        sw_sca_size=SW_SCA_SIZE, dtype=np.float64).get_single_mosaic_array(
+            datasets[:10])
+    assert mosaic.dtype == np.float64
+    _check_full_mosaic(mosaic)
+
+
+def test_single_mosaic_array_one_module(datasets):
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE)
+    mosaic = m.get_single_mosaic_array(datasets[:4])
+    assert mosaic.shape == (174, 174)
+    np.testing.assert_allclose(mosaic[32, 142], DETECTORS['NRCA3'])
+
+
+def test_get_layout(datasets):
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE)
+    index = m.build_header_index(datasets[:10])
+    shape, tiles = m.get_layout(list(index.values()))
+    assert shape == (620, 660)
+
+    origins = {info['detector']: (y1, x1) for info, _, (y1, x1) in tiles}
+    assert origins == {
+        'NRCA1': (0, 0), 'NRCA2': (110, 0), 'NRCA3': (0, 110),
+        'NRCA4': (110, 110), 'NRCALONG': (486, 0),
+        'NRCB4': (0, 486), 'NRCB3': (110, 486), 'NRCB2': (0, 596),
+        'NRCB1': (110, 596), 'NRCBLONG': (486, 486)}
+
+    assert m.get_layout([]) == (None, [])
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_make_mosaic(tmpdir, datasets, n_workers):
+    outpath = tmpdir.mkdir('out').strpath
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE)
+    mosaiclist = m.make_mosaic(datasets, outpath=outpath, n_workers=n_workers)
+
+    assert mosaiclist == [
+        os.path.join(outpath, 'jw00001001001_01101_00001_mosaic.fits'),
+        os.path.join(outpath, 'jw00001001001_01101_00002_mosaic.fits')]
+
+    for outname in mosaiclist:
+        with fits.open(outname) as pf:
+            assert pf[0].header['TARGNAME'] == 'FOO'
+            assert pf[0].header['FILTER'] == 'F212N'
+            assert pf[0].header['BITPIX'] == -32
+            _check_full_mosaic(pf[0].data)
+
+
+def test_make_mosaic_mp_context(tmpdir, datasets):
+    outpath = tmpdir.mkdir('out').strpath
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE)
+    mosaiclist = m.make_mosaic(
+        datasets, outpath=outpath, n_workers=2,
+        mp_context=multiprocessing.get_context('spawn'))
+    assert len(mosaiclist) == 2
+    for outname in mosaiclist:
+        _check_full_mosaic(fits.getdata(outname))
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_make_mosaic_out_of_core(tmpdir, datasets, dtype, umask):
+    outpath = tmpdir.mkdir('out').strpath
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE, dtype=dtype, out_of_core=True)
+    mosaiclist = m.make_mosaic(datasets, outpath=outpath, clobber=True)
+    assert len(mosaiclist) == 2
+    assert sorted(os.listdir(outpath)) == [os.path.basename(f)
+                                           for f in mosaiclist]
+
+    for outname in mosaiclist:
+        with fits.open(outname, checksum=True) as pf:
+            assert pf[0].header['TARGNAME'] == 'FOO'
+            assert pf[0].data.dtype == np.dtype(dtype).newbyteorder('>')
+            _check_full_mosaic(pf[0].data)
+
+        # Same permissions as a mosaic written directly
+        assert os.stat(outname).st_mode & 0o777 == 0o666 & ~umask
+
+
+@pytest.mark.parametrize('kwargs', [{'quantize': 'int16'},
+                                    {'pyramid': [128]}])
+def test_out_of_core_unsupported(kwargs):
+    with pytest.raises(ValueError, match='not supported'):
+        NircamMosaic(out_of_core=True, **kwargs)
+
+
+@pytest.mark.parametrize('n_threads', [1, 2])
+def test_make_mosaic_pyramid(tmpdir, datasets, n_threads):
+    outpath = tmpdir.mkdir('out').strpath
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE, pyramid=[1024, 128],
+                     n_threads=n_threads)
+    outname = m.make_mosaic(datasets[:10], outpath=outpath)[0]
+
+    with fits.open(outname) as pf:
+        assert len(pf) == 3
+        assert pf[0].header['TARGNAME'] == 'FOO'
+        _check_full_mosaic(pf[0].data)
+
+        for ver, size in ((1, 128), (2, 1024)):
+            hdu = pf['PYRAMID', ver]
+            assert hdu.header['SCASIZE'] == size
+            expected = NircamMosaic(sw_sca_size=size).get_single_mosaic_array(
+                datasets[:10])
+            np.testing.assert_allclose(hdu.data, expected, rtol=1e-6)
+
+    pyramid = m.get_mosaic_pyramid(datasets[:10])
+    assert list(pyramid) == [1024, SW_SCA_SIZE, 128]
+    _check_full_mosaic(pyramid[SW_SCA_SIZE])
+
+
+def test_make_mosaic_pyramid_non_square(tmpdir, make_nircam_image):
+    # Rounded shapes differ in aspect ratio, e.g., (64, 31) and (16, 8)
+    path = tmpdir.mkdir('inputs').strpath
+    images = [make_nircam_image(
+        os.path.join(path, f'jw00001001001_01101_00001_{det.lower()}.fits'),
+        det, DETECTORS[det], shape=(SCA_SIZE, 125))
+        for det in ('NRCA1', 'NRCA3')]
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE, pyramid=[128])
+
+    pyramid = m.get_mosaic_pyramid(images)
+    for size, mosaic in pyramid.items():
+        expected = NircamMosaic(sw_sca_size=size).get_single_mosaic_array(
+            images)
+        np.testing.assert_allclose(mosaic, expected, rtol=1e-6)
+
+    # Spline edges differ, but not the shapes
+    m.resample_method = 'spline'
+    pyramid = m.get_mosaic_pyramid(images)
+    assert pyramid[128].shape == expected.shape
+
+
+def test_make_mosaic_quicklook(tmpdir, datasets):
+    from PIL import Image
+
+    outpath = tmpdir.mkdir('out').strpath
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE, quicklook='png',
+                     quicklook_kwargs={'autocut_method': 'minmax'})
+    outname = m.make_mosaic(datasets[:10], outpath=outpath)[0]
+
+    with Image.open(outname.replace('.fits', '.png')) as im:
+        assert im.size == (660, 620)
+        outdata = np.asarray(im)[::-1]
+
+    # NRCBLONG is the brightest
+    assert outdata[553, 486 + 67] == 255
+    assert outdata[32, 32] == 25  # NRCA1
+    assert outdata[200, 32] == 0  # Gap
+
+    # Out-of-core quicklook is decimated to fit LW SCA (134), so memory
+    # use is bounded by a detector.
+    outpath = tmpdir.mkdir('out_of_core').strpath
+    m.out_of_core = True
+    outname = m.make_mosaic(datasets[:10], outpath=outpath)[0]
+    with Image.open(outname.replace('.fits', '.png')) as im:
+        assert im.size == (132, 124)
+        np.testing.assert_array_equal(np.asarray(im)[::-1],
+                                      outdata[::5, ::5])
+
+
+def test_make_mosaic_quantize(tmpdir, datasets):
+    outpath = tmpdir.mkdir('out').strpath
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE, quantize='int16')
+    outname = m.make_mosaic(datasets[:10], outpath=outpath)[0]
+
+    with fits.open(outname) as pf:
+        assert pf[0].header['BITPIX'] == 16
+        assert pf[0].header['TARGNAME'] == 'FOO'
+        # Quantization error is tiny compared to detector values
+        np.testing.assert_allclose(
+            pf[0].data, m.get_single_mosaic_array(datasets[:10]), atol=1e-3)
+
+
+@pytest.mark.parametrize(('n_workers', 'ordered'),
+                         [(1, True), (2, True), (2, False)])
+def test_iter_mosaics(tmpdir, make_nircam_image, datasets, n_workers,
+                      ordered):
+    outpath = tmpdir.mkdir('out').strpath
+    images = datasets + [str(tmpdir.join('jw00001001001_01101_00003_nrcc1_cal.fits'))]  # noqa: E501
+    make_nircam_image(images[-1], 'NRCC1', 0)
+
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE)
+    results = m.iter_mosaics(images, outpath=outpath, n_workers=n_workers,
+                             ordered=ordered)
+    expected = [
+        ('jw00001001001_01101_00002',
+         os.path.join(outpath, 'jw00001001001_01101_00002_mosaic.fits')),
+        ('jw00001001001_01101_00001',
+         os.path.join(outpath, 'jw00001001001_01101_00001_mosaic.fits')),
+        ('jw00001001001_01101_00003', '')]
+
+    # Each mosaic is done by the time it is yielded
+    for rootname, outname in results:
+        if outname:
+            _check_full_mosaic(fits.getdata(outname))
+
+    results = list(m.iter_mosaics(images, outpath=outpath, clobber=True,
+                                  n_workers=n_workers, ordered=ordered))
+    if ordered:
+        assert results == expected
+    else:
+        assert sorted(results) == sorted(expected)
+
+
+def test_iter_mosaics_failure(tmpdir, datasets):
+    outpath = tmpdir.mkdir('out').strpath
+    cachedir = tmpdir.mkdir('quipcache').strpath
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE, cachedir=cachedir)
+    results = m.iter_mosaics(datasets, outpath=outpath)
+
+    rootname, outname = next(results)
+    assert rootname == 'jw00001001001_01101_00002'
+    os.remove(datasets[10])  # Second dataset fails
+    with pytest.raises(FileNotFoundError):
+        next(results)
+
+    # First mosaic is kept in cache
+    assert list(m.iter_mosaics(datasets[:10], outpath=outpath)) == [
+        (rootname, outname)]
+    with open(os.path.join(cachedir, 'mosaic_cache.json')) as fin:
+        assert os.path.abspath(outname) in fin.read()
+
+
+def test_make_mosaic_cache(tmpdir, make_nircam_image, datasets, umask):
+    outpath = tmpdir.mkdir('out').strpath
+    cachedir = tmpdir.mkdir('quipcache').strpath
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE, cachedir=cachedir)
+    mosaiclist = m.make_mosaic(datasets, outpath=outpath)
+    tiledir = os.path.join(cachedir, 'mosaic_tiles')
+    assert len(os.listdir(tiledir)) == 20
+    assert all(os.stat(os.path.join(tiledir, f)).st_mode & 0o777 ==
+               0o666 & ~umask for f in os.listdir(tiledir))
+    mtimes = [os.stat(f).st_mtime_ns for f in mosaiclist]
+
+    # Nothing changed, so nothing is rebuilt, even with clobber
+    assert m.make_mosaic(datasets, outpath=outpath, clobber=True) == mosaiclist
+    assert [os.stat(f).st_mtime_ns for f in mosaiclist] == mtimes
+
+    # Changed input is rebuilt even without clobber, reusing cached tiles
+    # for other detectors
+    changed = datasets[10]  # NRCA1 of the second mosaic in the list
+    os.remove(changed)
+    make_nircam_image(changed, 'NRCA1', 100)
+    for tile in os.listdir(tiledir):
+        if tile.endswith('.npy'):
+            os.utime(os.path.join(tiledir, tile), ns=(0, 0))
+    assert m.make_mosaic(datasets, outpath=outpath) == mosaiclist
+    assert os.stat(mosaiclist[0]).st_mtime_ns != mtimes[0]
+    assert os.stat(mosaiclist[1]).st_mtime_ns == mtimes[1]
+    assert sum(os.stat(os.path.join(tiledir, tile)).st_mtime_ns != 0
+               for tile in os.listdir(tiledir)) == 1
+    np.testing.assert_allclose(fits.getdata(mosaiclist[0])[32, 32], 100)
+    assert len(os.listdir(tiledir)) == 20  # Old tile is removed
+
+    # Changed settings rebuild all, replacing their tiles
+    m.resample_method = 'spline'
+    assert m.make_mosaic(datasets, outpath=outpath) == mosaiclist
+    assert os.stat(mosaiclist[1]).st_mtime_ns != mtimes[1]
+    assert len(os.listdir(tiledir)) == 20
+
+
+def test_make_mosaic_cache_shared_tiles(tmpdir, make_nircam_image, datasets):
+    # Two mosaics from the same inputs share cached tiles.
+    cachedir = tmpdir.mkdir('quipcache').strpath
+    tiledir = os.path.join(cachedir, 'mosaic_tiles')
+    outpaths = [tmpdir.mkdir(d).strpath for d in ('out1', 'out2')]
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE, cachedir=cachedir)
+    for outpath in outpaths:
+        m.make_mosaic(datasets[:10], outpath=outpath)
+    assert len(os.listdir(tiledir)) == 10
+
+    # Old tile is kept while the other mosaic still uses it
+    os.remove(datasets[0])
+    make_nircam_image(datasets[0], 'NRCA1', 100)
+    m.make_mosaic(datasets[:10], outpath=outpaths[0])
+    assert len(os.listdir(tiledir)) == 11
+
+    m.make_mosaic(datasets[:10], outpath=outpaths[1])
+    assert len(os.listdir(tiledir)) == 10
+
+
+def test_make_mosaic_cache_existing(tmpdir, make_nircam_image, datasets):
+    # Mosaic built without cache is not trusted when cache is enabled.
+    outpath = tmpdir.mkdir('out').strpath
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE)
+    mosaiclist = m.make_mosaic(datasets[:10], outpath=outpath)
+    changed = datasets[0]
+    detector = fits.getval(changed, 'DETECTOR')
+    os.remove(changed)
+    make_nircam_image(changed, detector, 100)
+
+    m.cachedir = tmpdir.mkdir('quipcache').strpath
+    for _ in range(2):
+        assert m.make_mosaic(datasets[:10], outpath=outpath) == mosaiclist
+        assert fits.getdata(mosaiclist[0]).max() == 100
+
+
+@pytest.mark.parametrize('n_threads', [1, 2])
+def test_get_mosaic_from_data(datasets, n_threads):
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE, n_threads=n_threads)
+    records = [(det, {'TARGNAME': 'FOO'}, np.full((SCA_SIZE, SCA_SIZE), val))
+               for det, val in DETECTORS.items()]
+    mosaic, header = m.get_mosaic_from_data(records)
+    _check_full_mosaic(mosaic)
+    assert header['TARGNAME'] == 'FOO'
+    assert 'NRCA1,NRCA2' in str(header['HISTORY'])
+
+    # Same as from files, also given as HDU lists
+    hduls = [fits.open(f) for f in datasets[:10]]
+    try:
+        mosaic, header = m.get_mosaic_from_data(hduls)
+    finally:
+        for pf in hduls:
+            pf.close()
+    np.testing.assert_array_equal(
+        mosaic, m.get_single_mosaic_array(datasets[:10]))
+    assert header['INSTRUME'] == 'NIRCAM'
+    assert 'nrca1_cal.fits' in ''.join(header['HISTORY']).replace('\n', '')
+
+    assert m.get_mosaic_from_data([('NRCC1', None, np.ones((4, 4)))]) == (
+        None, None)
+
+
+def test_get_mosaic_from_data_cache(tmpdir, datasets):
+    # Modified in-memory data do not end up in tile cache for the file.
+    cachedir = tmpdir.mkdir('quipcache').strpath
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE, cachedir=cachedir)
+    with fits.open(datasets[0]) as pf:
+        pf['SCI'].data *= 100
+        mosaic, _ = m.get_mosaic_from_data([pf])
+    assert mosaic.max() == 100
+    assert not os.path.exists(os.path.join(cachedir, 'mosaic_tiles'))
+
+    outpath = tmpdir.mkdir('out').strpath
+    mosaiclist = m.make_mosaic(datasets[:10], outpath=outpath)
+    assert fits.getdata(mosaiclist[0]).max() == 10
+
+
+def test_build_header_index(tmpdir, datasets):
+    other = str(tmpdir.join('jw00001001001_01101_00001_nis_cal.fits'))
+    prihdr = fits.Header({'INSTRUME': 'NIRISS'})
+    fits.HDUList([fits.PrimaryHDU(header=prihdr),
+                  fits.ImageHDU(np.zeros((10, 20)), name='SCI')]).writeto(
+                      other)
+    images = datasets[:10] + [other]
+
+    index = NircamMosaic(n_threads=4).build_header_index(images)
+    assert index == NircamMosaic().build_header_index(images)
+    assert list(index) == images
+
+    info = index[datasets[4]]
+    assert info['detector'] == 'NRCALONG'
+    assert info['module'] == 'A'
+    assert info['channel'] == 'LONG'
+    assert info['shape'] == (SCA_SIZE, SCA_SIZE)
+    assert info['inherit'] == {'TARGNAME': 'FOO', 'INSTRUME': 'NIRCAM',
+                               'FILTER': 'F212N'}
+
+    assert index[other]['module'] is None
+    assert index[other]['shape'] is None
+
+    # Non-NIRCam image is left out of the mosaic
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE)
+    _check_full_mosaic(m.get_single_mosaic_array(images, header_index=index))
+
+
+def test_make_mosaic_no_sci(tmpdir, datasets):
+    # Neither a non-NIRCam image without SCI nor a NIRCam one breaks it
+    path = tmpdir.join('inputs')
+    others = []
+    for name, prihdr in (('nis', {'INSTRUME': 'NIRISS'}),
+                         ('nrca1', {'INSTRUME': 'NIRCAM',
+                                    'DETECTOR': 'NRCA1'})):
+        filename = path.join(f'jw00001001001_01101_00003_{name}_cal.fits')
+        fits.HDUList([fits.PrimaryHDU(header=fits.Header(prihdr)),
+                      fits.ImageHDU(np.zeros((10, 20)), name='IMAGE')]
+                     ).writeto(filename.strpath)
+        others.append(filename.strpath)
+
+    m = NircamMosaic(sw_sca_size=SW_SCA_SIZE)
+    index = m.build_header_index(others)
+    assert [info['module'] for info in index.values()] == [None, None]
+
+    outpath = tmpdir.mkdir('out').strpath
+    assert m.make_mosaic(datasets[:10] + others, outpath=outpath) == [
+        os.path.join(outpath, 'jw00001001001_01101_00002_mosaic.fits')]
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from wss_tools.utils.quicklook import quicklook_filename, write_quicklook
+
+
+@pytest.mark.parametrize(('filename', 'fmt', 'expected'),
+                         [('a/b_mosaic.fits', 'png', 'a/b_mosaic.png'),
+                          ('b.FITS', 'jpg', 'b.jpg'),
+                          ('c.dat', 'png', 'c.dat.png')])
+def test_quicklook_filename(filename, fmt, expected):
+    assert quicklook_filename(filename, fmt=fmt) == expected
+
+
+@pytest.mark.parametrize('ext', ['png', 'jpg'])
+def test_write_quicklook(tmpdir, ext):
+    outfile = str(tmpdir.join(f'ql.{ext}'))
+    data = np.tile(np.linspace(0, 1, 1200, dtype=np.float32), (700, 1))
+    data[:350] = 0  # Bottom half is dark
+    data[0, 0] = np.nan
+
+    loval, hival = write_quicklook(data, outfile,
+                                   autocut_params={'sample': 'full'})
+    assert loval < hival
+
+    with Image.open(outfile) as im:
+        assert im.mode == 'L'
+        assert im.size == (1200, 700)
+        outdata = np.asarray(im)
+
+    # Origin at lower left, as in Ginga
+    assert outdata[-1].max() <= 1
+    assert outdata[0, -1] >= 250
+
+
+def test_write_quicklook_max_size(tmpdir):
+    outfile = str(tmpdir.join('ql.png'))
+    data = np.arange(700 * 1200, dtype=np.float32).reshape(700, 1200)
+    write_quicklook(data, outfile, autocut_method='minmax', max_size=500)
+    with Image.open(outfile) as im:
+        assert im.size == (400, 234)  # Every 3rd pixel
+
+    write_quicklook(data, outfile, autocut_method='minmax', max_size=1200)
+    with Image.open(outfile) as im:
+        assert im.size == (1200, 700)
+
+
+def test_write_quicklook_constant(tmpdir):
+    outfile = str(tmpdir.join('ql.png'))
+    write_quicklook(np.ones((10, 10)), outfile, autocut_method='minmax')
+    with Image.open(outfile) as im:
+        assert np.all(np.asarray(im) == 0)
+
+
+def test_write_quicklook_invalid(tmpdir):
+    with pytest.raises(ValueError, match='Unsupported quicklook format'):
+        write_quicklook(np.ones((10, 10)), str(tmpdir.join('ql.gif')))
+    with pytest.raises(ValueError, match='ndim'):
+        write_quicklook(np.ones(10), str(tmpdir.join('ql.png')))
@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+from astropy.io import fits
+
+from wss_tools.quip import main, qio
+from wss_tools.quip.daemon import QUIPDaemon, status_filename
+from wss_tools.tests.test_quip_main import DETECTORS, _read_quip_out
+
+
+@pytest.fixture
+def images(tmpdir, make_nircam_image):
+    path = tmpdir.mkdir('inputs')
+    return [make_nircam_image(
+        str(path.join(f'jw00001001001_01101_00001_{det.lower()}_cal.fits')),
+        det, dq=True) for det in DETECTORS[:2]]
+
+
+def _spool_opfile(spooldir, name, op_type, images, outdir):
+    opfile = qio.QUIPOpFile(op_type, outdir, correction_id=name)
+    opfile.input_files = images
+    xmlfile = os.path.join(spooldir, f'{name}.xml')
+    opfile.write_xml(xmlfile)
+    return xmlfile, os.path.join(outdir, f'{name}_quip_out.xml')
+
+
+def _read_status(xmlfile):
+    with open(status_filename(xmlfile)) as f:
+        return json.load(f)
+
+
+def test_daemon(tmpdir, images, umask):
+    spooldir = tmpdir.mkdir('spool').strpath
+    outdir = tmpdir.join('out').strpath
+    jobs = [_spool_opfile(spooldir, f'R{i}', op_type, images, outdir)
+            for i, op_type in enumerate(['THUMBNAIL', 'SEGMENT_ID', 'MIMF'])]
+    badfile = os.path.join(spooldir, 'bad.xml')
+    with open(badfile, 'w') as f:
+        f.write('<QUIP_OPERATION_FILE/>')
+
+    # Worker processes started from job threads, and shared ones
+    daemon = QUIPDaemon(spooldir, max_jobs=2, n_cores=2, settle_time=0,
+                        thumb_width=100)
+    assert sorted(daemon.pending()) == sorted(
+        [badfile] + [xmlfile for xmlfile, _ in jobs])
+
+    # Bounded concurrency
+    try:
+        started = daemon.poll()
+        assert len(started) == 2
+        daemon.wait()
+        assert len(daemon.poll()) == 2
+        daemon.wait()
+    finally:
+        main._close_shrink_pool()
+    assert daemon.pending() == []
+    assert daemon.poll() == []
+
+    assert (os.stat(status_filename(jobs[0][0])).st_mode & 0o777 ==
+            0o666 & ~umask)
+    status = _read_status(jobs[0][0])
+    assert status['state'] == 'done'
+    assert status['operation_type'] == 'THUMBNAIL'
+    assert status['out_file'] == jobs[0][1]
+    assert _read_quip_out(jobs[0][1]) == status['images']
+    for outfile in status['images']:
+        assert outfile.startswith(os.path.join(spooldir, 'quipcache'))
+        assert fits.getdata(outfile).shape == (100, 100)
+
+    status = _read_status(jobs[1][0])
+    assert status['state'] == 'done'
+    assert _read_quip_out(jobs[1][1]) == [os.path.join(
+        spooldir, 'quipcache', 'jw00001001001_01101_00001_mosaic.fits')]
+
+    status = _read_status(jobs[2][0])
+    assert status['state'] == 'failed'
+    assert 'MIMF cannot run headless' in status['error']
+    assert not os.path.exists(jobs[2][1])
+
+    assert _read_status(badfile)['state'] == 'failed'
+
+
+def test_daemon_serve_forever(tmpdir, images):
+    spooldir = tmpdir.mkdir('spool').strpath
+    outdir = tmpdir.join('out').strpath
+    daemon = QUIPDaemon(spooldir, n_cores=2, poll_interval=0.1,
+                        settle_time=0, thumb_width=100)
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+
+    try:
+        # Jobs dropped in while running, sharing warm workers and cache
+        pool = None
+        for name in ('R1', 'R2'):
+            xmlfile, quipout = _spool_opfile(
+                spooldir, name, 'THUMBNAIL', images, outdir)
+            deadline = time.monotonic() + 60
+            while (not os.path.exists(status_filename(xmlfile)) or
+                   _read_status(xmlfile)['state'] == 'running'):
+                assert thread.is_alive()
+                assert time.monotonic() < deadline, 'Timed out'
+                thread.join(0.1)
+            assert _read_status(xmlfile)['state'] == 'done'
+            assert os.path.isfile(quipout)
+            if pool is None:
+                pool = main._shrink_pool
+            assert pool is not None
+            assert main._shrink_pool is pool
+    finally:
+        daemon.stop()
+        thread.join()
+        main._close_shrink_pool()
+
+    assert (_read_status(os.path.join(spooldir, 'R1.xml'))['images'] ==
+            _read_status(os.path.join(spooldir, 'R2.xml'))['images'])
+
+
+def test_daemon_claimed(tmpdir, images):
+    spooldir = tmpdir.mkdir('spool').strpath
+    xmlfile, quipout = _spool_opfile(spooldir, 'R1', 'THUMBNAIL', images,
+                                     tmpdir.join('out').strpath)
+
+    # Another daemon got it first
+    daemon = QUIPDaemon(spooldir, n_cores=1, settle_time=0)
+    assert daemon._claim(xmlfile)
+    assert not daemon._claim(xmlfile)
+    assert daemon.poll() == []
+    assert not os.path.exists(quipout)
+
+    # Not picked up before it settles
+    os.remove(status_filename(xmlfile))
+    assert QUIPDaemon(spooldir, settle_time=60).pending() == []
+
+    with pytest.raises(ValueError, match='Invalid max_jobs'):
+        QUIPDaemon(spooldir, max_jobs=0)
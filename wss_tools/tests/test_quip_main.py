@@ -0,0 +1,318 @@
+import json
+import os
+import subprocess
+import sys
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from wss_tools.quip import main, qio
+from wss_tools.quip.main import _segid_mosaics, shrink_input_images
+
+DETECTORS = ('NRCA1', 'NRCA2', 'NRCA3', 'NRCA4', 'NRCALONG')
+
+# Seconds allowed to import QUIP in a fresh interpreter, which was about
+# 0.75 s (1.3 s with Ginga) when measured. Generous for slow machines.
+IMPORT_TIME_BUDGET = 2.5
+
+# Slow to import and only needed by the viewer, or some of the processing.
+SLOW_MODULES = ('ginga', 'stginga', 'astropy.wcs')
+
+_import_script = """
+import json, sys, time
+t0 = time.perf_counter()
+from wss_tools.quip import main
+t = time.perf_counter() - t0
+{run}
+print(json.dumps({{'time': t, 'modules': sorted(
+    m for m in {slow_modules!r} if m in sys.modules)}}))
+"""
+
+
+@pytest.fixture
+def images(tmpdir, make_nircam_image):
+    path = tmpdir.mkdir('inputs')
+    return [make_nircam_image(
+        str(path.join(f'jw00001001001_01101_00001_{det.lower()}_cal.fits')),
+        det, dq=True) for det in DETECTORS]
+
+
+def test_segid_mosaics_thumbnails(tmpdir, images):
+    outpath = tmpdir.mkdir('quipcache').strpath
+    mosaiclist = _segid_mosaics(images, outpath=outpath, sw_sca_size=128,
+                                thumb_width=100, cachedir=outpath)
+    assert mosaiclist == [
+        os.path.join(outpath, 'jw00001001001_01101_00001_mosaic.fits')]
+
+    # Same thumbnails as THUMBNAIL mode
+    refpath = tmpdir.mkdir('ref').strpath
+    reflist = shrink_input_images(images, outpath=refpath, new_width=100,
+                                  use_dq=True)
+    for reffile in reflist:
+        outfile = os.path.join(outpath, os.path.basename(reffile))
+        with fits.open(outfile) as pf, fits.open(reffile) as pfref:
+            assert pf[0].header['DETECTOR'] == pfref[0].header['DETECTOR']
+            np.testing.assert_allclose(pf[0].data, pfref[0].data, rtol=1e-6)
+
+    # Which THUMBNAIL mode then reuses
+    mtime = os.stat(outfile).st_mtime_ns
+    assert shrink_input_images(images, outpath=outpath, new_width=100,
+                               use_dq=True) == [
+        os.path.join(outpath, os.path.basename(f)) for f in images]
+    assert os.stat(outfile).st_mtime_ns == mtime
+
+
+def test_shrink_input_images_quicklook(tmpdir, images):
+    outpath = tmpdir.mkdir('quipcache').strpath
+    outlist = shrink_input_images(images[:2], outpath=outpath, new_width=100,
+                                  quicklook='jpg')
+    for outfile in outlist:
+        assert os.path.isfile(outfile.replace('.fits', '.jpg'))
+
+
+@pytest.mark.parametrize('use_dq', [False, True])
+def test_shrink_input_images_pool(tmpdir, images, use_dq):
+    small = str(tmpdir.join('small_cal.fits'))
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(
+        np.zeros((50, 50)), name='SCI')]).writeto(small)
+    inputs = [images[0], small] + images[1:]
+    outpath = tmpdir.mkdir('out').strpath
+    expected = [os.path.join(outpath, os.path.basename(f)) for f in inputs]
+    expected[1] = small  # Already small enough
+
+    # Workers do not outlive the call, unless asked to
+    assert shrink_input_images(inputs, outpath=outpath, new_width=100,
+                               n_cores=2, use_dq=use_dq) == expected
+    assert main._shrink_pool is None
+
+    try:
+        pool = main._get_shrink_pool(2, create=True)
+
+        # Same warm workers are reused, and order is kept.
+        assert shrink_input_images(inputs[::-1], outpath=outpath,
+                                   new_width=100, n_cores=2,
+                                   use_dq=use_dq) == expected[::-1]
+        assert main._shrink_pool[1] is pool
+
+        # Pool that may be in use elsewhere is not replaced
+        assert main._get_shrink_pool(3, create=True) is None
+        assert shrink_input_images(inputs, outpath=outpath, new_width=100,
+                                   n_cores=3, use_dq=use_dq) == expected
+        assert main._shrink_pool[1] is pool
+    finally:
+        main._close_shrink_pool()
+    assert main._shrink_pool is None
+
+
+def test_shrink_hdul_with_dq(tmpdir, images):
+    # Must not drift apart from stginga
+    from stginga.utils import scale_image_with_dq
+
+    dq_parser = main._jwst_dq_parser()
+    expected = str(tmpdir.join('expected.fits'))
+    scale_image_with_dq(images[0], expected, 0.39, dq_parser)
+    outfile = str(tmpdir.join('out.fits'))
+    with fits.open(images[0]) as pf:
+        orig = pf['SCI'].data.copy()
+        main._shrink_hdul_with_dq(pf, outfile, 0.39, dq_parser)
+        np.testing.assert_array_equal(pf['SCI'].data, orig)
+
+    with fits.open(expected) as pf_exp, fits.open(outfile) as pf:
+        assert pf[0].data.shape == (100, 100)
+        np.testing.assert_array_equal(pf[0].data, pf_exp[0].data)
+        for key in ('TARGNAME', 'DETECTOR'):
+            assert pf[0].header[key] == pf_exp[0].header[key]
+
+
+def test_read_image_meta(images):
+    meta = main._read_image_meta(images[0])
+    assert meta == {'instrume': 'NIRCAM', 'detector': 'NRCA1',
+                    'hdus': [('PRIMARY', 1, ()), ('SCI', 1, (256, 256)),
+                             ('DQ', 1, (256, 256))]}
+    assert main._find_ext_shape(meta, ('sci', 1)) == (256, 256)
+    assert main._find_ext_shape(meta, 'DQ') == (256, 256)
+    assert main._find_ext_shape(meta, 1) == (256, 256)
+    assert main._find_ext_shape(meta, ('IMAGE', 1)) is None
+    assert main._find_ext_shape(meta, 3) is None
+
+
+@pytest.mark.parametrize('n_cores', [1, 2])
+def test_shrink_input_images_mixed_ext(tmpdir, images, n_cores):
+    # Science extension is found for each image, not just the first one.
+    other = str(tmpdir.join('image_cal.fits'))
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(
+        np.ones((200, 200)), name='IMAGE')]).writeto(other)
+    bad = str(tmpdir.join('bad_cal.fits'))
+    fits.PrimaryHDU(np.ones((200, 200))).writeto(bad)
+    outpath = tmpdir.mkdir('out').strpath
+
+    try:
+        with pytest.warns(UserWarning, match='bad_cal.fits has no'):
+            outlist = shrink_input_images(
+                [images[0], other, bad], outpath=outpath, new_width=100,
+                n_cores=n_cores)
+    finally:
+        main._close_shrink_pool()
+
+    assert outlist == [os.path.join(outpath, os.path.basename(f))
+                       for f in (images[0], other)]
+    for outfile in outlist:
+        assert fits.getdata(outfile).shape == (100, 100)
+    np.testing.assert_allclose(fits.getdata(outlist[1]), 1)
+
+
+def test_shrink_input_images_cache(tmpdir, make_nircam_image, images):
+    # Same basename as images[0] but different content
+    other = make_nircam_image(
+        str(tmpdir.mkdir('other').join(os.path.basename(images[0]))),
+        'NRCB1', dq=True)
+    inputs = [images[0], other]
+    cachedir = tmpdir.join('quipcache', 'thumbnails').strpath
+
+    outlist = shrink_input_images(inputs, new_width=100, use_dq=True,
+                                  cachedir=cachedir)
+    assert len(set(outlist)) == 2
+    for infile, outfile in zip(inputs, outlist):
+        assert os.path.dirname(os.path.dirname(outfile)) == cachedir
+        assert os.path.basename(outfile) == os.path.basename(infile)
+        assert fits.getval(outfile, 'DETECTOR') == fits.getval(
+            infile, 'DETECTOR')
+    mtimes = [os.stat(f).st_mtime_ns for f in outlist]
+
+    # Cache hit
+    assert shrink_input_images(inputs, new_width=100, use_dq=True,
+                               cachedir=cachedir) == outlist
+    assert [os.stat(f).st_mtime_ns for f in outlist] == mtimes
+
+    # Different settings are different entries, and the least recently used
+    # ones are removed when the cache is too big.
+    outlist2 = shrink_input_images(inputs, new_width=100, use_dq=True,
+                                   kernel_width=9, cachedir=cachedir,
+                                   cache_size=1)
+    assert not set(outlist2) & set(outlist)
+    assert all(os.path.isfile(f) for f in outlist2)
+    assert not any(os.path.exists(f) for f in outlist)
+    assert sorted(d for d in os.listdir(cachedir)
+                  if not d.startswith('.')) == sorted(
+        os.path.basename(os.path.dirname(f)) for f in outlist2)
+
+
+def test_segid_mosaics_thumbnail_cache(tmpdir, images):
+    outpath = tmpdir.mkdir('quipcache').strpath
+    cachedir = os.path.join(outpath, 'thumbnails')
+    _segid_mosaics(images, outpath=outpath, sw_sca_size=128, thumb_width=100,
+                   thumb_cachedir=cachedir)
+    assert not any(f.endswith('_cal.fits') for f in os.listdir(outpath))
+    entries = sorted(os.listdir(cachedir))
+
+    # THUMBNAIL mode reuses them
+    outlist = shrink_input_images(images, outpath=outpath, new_width=100,
+                                  use_dq=True, cachedir=cachedir)
+    assert sorted(os.listdir(cachedir)) == entries
+    assert [os.path.basename(f) for f in outlist] == [
+        os.path.basename(f) for f in images]
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_segid_mosaics_thumbnail_cache_evict(tmpdir, make_nircam_image,
+                                             images, n_workers):
+    # Second exposure, so mosaics are built in worker processes
+    path = tmpdir.join('inputs')
+    images = images + [make_nircam_image(
+        str(path.join(f'jw00001001001_01101_00002_{det.lower()}_cal.fits')),
+        det, dq=True) for det in DETECTORS]
+    outpath = tmpdir.mkdir('quipcache').strpath
+    cachedir = os.path.join(outpath, 'thumbnails')
+
+    # Thumbnails just made are kept even if cache is too big
+    _segid_mosaics(images, outpath=outpath, sw_sca_size=128, thumb_width=100,
+                   thumb_cachedir=cachedir, thumb_cache_size=1,
+                   n_workers=n_workers)
+    assert len([d for d in os.listdir(cachedir)
+                if not d.startswith('.')]) == len(images)
+
+
+def _run_quip_script(run='', cwd=None):
+    """Import QUIP in a fresh interpreter, then run given code.
+    Returns import time and slow modules that were imported.
+
+    """
+    script = _import_script.format(run=run, slow_modules=SLOW_MODULES)
+    out = subprocess.run([sys.executable, '-c', script], cwd=cwd,
+                         check=True, capture_output=True, text=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def test_import_time_budget():
+    # Best of a few, to not be thrown off by a busy machine
+    results = [_run_quip_script() for _ in range(3)]
+    assert results[0]['modules'] == []
+    assert min(r['time'] for r in results) < IMPORT_TIME_BUDGET
+
+
+def test_headless_recenter_no_viewer(tmpdir):
+    from wss_tools.tests.test_recenter import _make_psf_image
+
+    inpath = tmpdir.mkdir('inputs')
+    outdir = tmpdir.mkdir('out').strpath
+    opfile = qio.QUIPOpFile('MIMF', outdir)
+    opfile.input_files = [_make_psf_image(
+        str(inpath.join('psf_cal.fits')), 100, 100, imsize=256, sigma=5)]
+    xmlfile = str(inpath.join('operation_file_001.xml'))
+    opfile.write_xml(xmlfile)
+    with open(xmlfile) as f:
+        s = f.read().replace('>MIMF<', '>WAVEFRONT_MAINTENANCE<')
+    with open(xmlfile, 'w') as f:
+        f.write(s)
+
+    result = _run_quip_script(
+        run=f'main.main([{xmlfile!r}, "--nocopy"])', cwd=outdir)
+    assert 'ginga' not in result['modules']
+    assert 'stginga' not in result['modules']
+    assert result['time'] < IMPORT_TIME_BUDGET
+    assert os.path.isfile(os.path.join(outdir, 'R2017061401_quip_out.xml'))
+
+
+def _write_opfile(path, op_type, images):
+    outdir = path.join('out').strpath
+    opfile = qio.QUIPOpFile(op_type, outdir)
+    opfile.input_files = images
+    xmlfile = path.join('operation_file_001.xml').strpath
+    opfile.write_xml(xmlfile)
+    return xmlfile, os.path.join(outdir, 'R2017061401_quip_out.xml')
+
+
+def _read_quip_out(filename):
+    return [e.text for e in ET.parse(filename).iter('IMAGE_PATH')]
+
+
+@pytest.mark.parametrize('op_type', ['THUMBNAIL', 'SEGMENT_ID'])
+def test_main_headless(tmpdir, images, op_type):
+    path = tmpdir.mkdir('ops')
+    xmlfile, quipout = _write_opfile(path, op_type, images)
+    main.main([xmlfile, '--headless', '--mosaic-thumb-size=100'])
+
+    outlist = _read_quip_out(quipout)
+    cachedir = path.join('quipcache').strpath
+    if op_type == 'THUMBNAIL':
+        assert [os.path.basename(f) for f in outlist] == [
+            os.path.basename(f) for f in images]
+        for outfile in outlist:
+            assert outfile.startswith(os.path.join(cachedir, 'thumbnails'))
+            assert fits.getdata(outfile).shape == (100, 100)
+    else:
+        assert outlist == [os.path.join(
+            cachedir, 'jw00001001001_01101_00001_mosaic.fits')]
+        assert os.path.isfile(outlist[0])
+
+        # Thumbnails are also pre-baked
+        assert len(os.listdir(os.path.join(cachedir, 'thumbnails'))) > 1
+
+
+def test_main_headless_needs_viewer(tmpdir, images):
+    xmlfile, quipout = _write_opfile(tmpdir, 'MIMF', images)
+    with pytest.raises(ValueError, match='MIMF cannot run headless'):
+        main.main([xmlfile, '--headless'])
+    assert not os.path.exists(quipout)
@@ -0,0 +1,193 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.nddata import block_reduce
+
+from wss_tools.utils.recenter import (
+    _block_median_partition, _roll_into, find_psf_center, find_psf_centers,
+    recenter)
+
+
+def _gaussian_psf(yc, xc, imsize=2048, sigma=20):
+    y, x = np.mgrid[:imsize, :imsize]
+    return (1000 * np.exp(-((y - yc) ** 2 + (x - xc) ** 2) /
+                          (2 * sigma ** 2)) + 1).astype(np.float32)
+
+
+def _make_psf_image(filename, yc, xc, imsize=2048, sigma=20,
+                    overwrite=False):
+    """Write a JWST-like SCI/ERR/DQ file with a Gaussian PSF at (yc, xc)."""
+    sci = _gaussian_psf(yc, xc, imsize=imsize, sigma=sigma)
+    err = np.sqrt(sci)
+    dq = np.zeros((imsize, imsize), dtype=np.uint32)
+    dq[int(yc), int(xc)] = 4
+    hdul = fits.HDUList([fits.PrimaryHDU(),
+                         fits.ImageHDU(sci, name='SCI'),
+                         fits.ImageHDU(err, name='ERR'),
+                         fits.ImageHDU(dq, name='DQ')])
+    hdul.writeto(filename, overwrite=overwrite)
+    return filename
+
+
+@pytest.fixture
+def psf_images(tmpdir):
+    """Two off-center PSFs and one already centered."""
+    return [
+        _make_psf_image(str(tmpdir.join('off1.fits')), 1000, 1000),
+        _make_psf_image(str(tmpdir.join('ok.fits')), 1412, 464),
+        _make_psf_image(str(tmpdir.join('off2.fits')), 1300, 600)]
+
+
+@pytest.mark.parametrize(('n_workers', 'batch_size'),
+                         [(1, None), (2, None), (1, 2), (2, 2)])
+def test_recenter(tmpdir, psf_images, n_workers, batch_size):
+    outdir = tmpdir.mkdir('out').strpath
+    outlist = recenter(psf_images, outdir, n_workers=n_workers,
+                       batch_size=batch_size)
+
+    assert outlist == [os.path.join(outdir, 'off1_recenter.fits'),
+                       psf_images[1],
+                       os.path.join(outdir, 'off2_recenter.fits')]
+    assert not any(f.endswith('.png') for f in os.listdir(outdir))
+
+    for outfile in (outlist[0], outlist[2]):
+        with fits.open(outfile) as pf:
+            yc, xc = np.unravel_index(np.argmax(pf['SCI'].data),
+                                      pf['SCI'].data.shape)
+            assert abs(yc - 1412) <= 1 and abs(xc - 464) <= 1
+            assert pf['DQ'].data[yc, xc] == 4
+
+
+def test_recenter_mp_context(tmpdir, psf_images):
+    outdir = tmpdir.mkdir('out').strpath
+    assert recenter(
+        psf_images, outdir, n_workers=2,
+        mp_context=multiprocessing.get_context('spawn')) == recenter(
+            psf_images, outdir)
+
+
+@pytest.mark.parametrize('plot_in_background', [False, True])
+def test_recenter_saveplot(tmpdir, psf_images, plot_in_background):
+    import matplotlib.pyplot as plt
+
+    outdir = tmpdir.mkdir('out')
+    recenter(psf_images[:2], outdir.strpath, saveplot=True,
+             plot_in_background=plot_in_background)
+
+    assert sorted(outdir.listdir(fil='*.png')) == [
+        outdir.join('off1_recenter.png'), outdir.join('ok_recenter.png')]
+    assert plt.get_fignums() == []
+
+
+def test_recenter_doplot_saveplot(tmpdir, psf_images, monkeypatch):
+    import matplotlib.pyplot as plt
+
+    shown = []
+    monkeypatch.setattr(plt, 'show', lambda: shown.append(plt.gcf()))
+    outdir = tmpdir.mkdir('out')
+    recenter(psf_images[:2], outdir.strpath, doplot=True, saveplot=True)
+
+    # Shown and saved
+    assert len(shown) == 2
+    assert sorted(outdir.listdir(fil='*.png')) == [
+        outdir.join('off1_recenter.png'), outdir.join('ok_recenter.png')]
+    assert plt.get_fignums() == []
+
+
+def test_recenter_cache(tmpdir, psf_images):
+    outdir = tmpdir.mkdir('out').strpath
+    cachedir = tmpdir.mkdir('quipcache').strpath
+    outlist = recenter(psf_images, outdir, cachedir=cachedir)
+    assert os.path.isfile(os.path.join(cachedir, 'recenter_cache.json'))
+    mtimes = [os.stat(f).st_mtime_ns for f in outlist]
+
+    # Nothing changed, so nothing is rewritten
+    assert recenter(psf_images, outdir, cachedir=cachedir) == outlist
+    assert [os.stat(f).st_mtime_ns for f in outlist] == mtimes
+
+    # Modified input is processed again
+    _make_psf_image(psf_images[0], 1100, 1100, overwrite=True)
+    assert recenter(psf_images, outdir, cachedir=cachedir) == outlist
+    assert os.stat(outlist[0]).st_mtime_ns != mtimes[0]
+    assert os.stat(outlist[2]).st_mtime_ns == mtimes[2]
+
+    # Missing output is regenerated
+    os.remove(outlist[2])
+    assert recenter(psf_images, outdir, cachedir=cachedir) == outlist
+    assert os.path.isfile(outlist[2])
+
+
+def test_recenter_failure(tmpdir, psf_images):
+    outdir = tmpdir.mkdir('out').strpath
+    badfile = str(tmpdir.join('bad.fits'))
+    fits.PrimaryHDU().writeto(badfile)
+    images = [psf_images[1], badfile]
+
+    with pytest.warns(UserWarning, match='Failed to recenter 1 image'):
+        outlist = recenter(images, outdir, n_workers=2)
+
+    assert outlist == [psf_images[1]]
+
+    # Batch falls back to one at a time
+    with pytest.warns(UserWarning, match='Failed to recenter 1 image'):
+        outlist = recenter(images, outdir, batch_size=2)
+
+    assert outlist == [psf_images[1]]
+
+
+@pytest.mark.parametrize('shift', [(0, 0), (3, -2), (-7, 11), (20, 5)])
+def test_roll_into(shift):
+    data = np.arange(13 * 17, dtype=np.float32).reshape(13, 17)
+    out = np.empty_like(data)
+    assert _roll_into(data, shift, out) is out
+    np.testing.assert_array_equal(out, np.roll(data, shift, axis=(0, 1)))
+
+
+@pytest.mark.parametrize('method', ['median', 'partition', 'mean', 'fft'])
+def test_find_psf_center(method):
+    data = _gaussian_psf(1000.5, 700.5)
+    yc, xc = find_psf_center(data, method=method)
+    assert abs(yc - 1000.5) < 1 and abs(xc - 700.5) < 1
+
+
+@pytest.mark.parametrize('method', ['median', 'partition', 'mean', 'fft'])
+def test_find_psf_centers(method):
+    truths = [(1000.5, 700.5), (300.2, 1200.7), (1412, 464)]
+    frames = [_gaussian_psf(yc, xc, imsize=1024 + 512) for yc, xc in truths]
+    expected = [find_psf_center(f, method=method) for f in frames]
+
+    np.testing.assert_allclose(find_psf_centers(frames, method=method),
+                               expected)
+    np.testing.assert_allclose(
+        find_psf_centers(np.stack(frames), method=method), expected)
+
+
+def test_find_psf_centers_bad_shapes():
+    with pytest.raises(ValueError, match='same shape'):
+        find_psf_centers([np.ones((128, 128)), np.ones((128, 64))])
+
+
+def test_find_psf_center_invalid():
+    with pytest.raises(ValueError, match='Invalid method'):
+        find_psf_center(np.ones((128, 128)), method='foo')
+
+
+@pytest.mark.parametrize('block', [3, 8])
+def test_block_median_partition(block):
+    data = np.random.default_rng(0).random((50, 43)).astype(np.float32)
+    np.testing.assert_allclose(
+        _block_median_partition(data, block),
+        block_reduce(data, block_size=block, func=np.median), rtol=1e-6)
+
+
+@pytest.mark.parametrize('block', [3, 8])
+def test_block_median_partition_one_block_across(block):
+    data = np.random.default_rng(0).random((2 * block, block))
+    orig = data.copy()
+    np.testing.assert_allclose(
+        _block_median_partition(data, block),
+        block_reduce(data, block_size=block, func=np.median))
+    np.testing.assert_array_equal(data, orig)
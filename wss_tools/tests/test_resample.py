@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from scipy.ndimage import zoom
+
+from wss_tools.utils.resample import _area_operator, resample, zoom_shape
+
+
+@pytest.fixture
+def image():
+    rng = np.random.default_rng(0)
+    return rng.random((256, 256)).astype('>f4')  # Like FITS data
+
+
+@pytest.mark.parametrize('zoom_factor', [0.125, 100 / 256, 0.3, 1.7])
+def test_resample_area(image, zoom_factor):
+    out = resample(image, zoom_factor)
+    assert out.shape == zoom(image, zoom_factor).shape
+    assert out.shape == zoom_shape(image.shape, zoom_factor)
+    assert out.dtype == np.float32
+
+    # Flux is conserved
+    scale = np.divide(image.shape, out.shape).prod()
+    np.testing.assert_allclose(out.sum() * scale, image.sum(), rtol=1e-5)
+
+
+def test_resample_area_integer_factor(image):
+    out = resample(image, 0.125)
+    np.testing.assert_allclose(
+        out, image.reshape(32, 8, 32, 8).mean(axis=(1, 3)))
+
+    # Same answer from the operator
+    op = _area_operator(256, 32)
+    np.testing.assert_allclose(out, op @ image @ op.T, rtol=1e-6)
+
+
+def test_resample_spline(image):
+    np.testing.assert_array_equal(resample(image, 0.3, method='spline'),
+                                  zoom(image, 0.3))
+
+
+def test_resample_invalid(image):
+    with pytest.raises(ValueError, match='Invalid method'):
+        resample(image, 0.5, method='foo')
+    with pytest.raises(ValueError, match='Unsupported ndim'):
+        resample(image[0], 0.5)
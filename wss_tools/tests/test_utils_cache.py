@@ -0,0 +1,132 @@
+import os
+
+from wss_tools.utils import cache as cache_module
+from wss_tools.utils.cache import FileCache, JSONCache, file_signature
+
+
+def test_file_signature(tmpdir):
+    filename = tmpdir.join('foo.txt')
+    filename.write('content')
+    sig = file_signature(filename.strpath, content_hash=True)
+
+    assert sig['path'] == os.path.abspath(filename.strpath)
+    assert sig['size'] == 7
+    assert len(sig['sha256']) == 64
+    assert 'sha256' not in file_signature(filename.strpath)
+
+    filename.write('new content')
+    assert file_signature(filename.strpath, content_hash=True) != sig
+
+
+def test_json_cache(tmpdir, umask):
+    filename = tmpdir.join('sub', 'cache.json').strpath
+    cache = JSONCache(filename)
+    assert cache.get('a') is None
+    cache['a'] = {'b': [1, 2]}
+    assert 'a' in cache
+    assert not os.path.exists(filename)
+    cache.save()
+
+    # Another session saves its own entry without losing ours
+    cache2 = JSONCache(filename)
+    assert cache2['a'] == {'b': [1, 2]}
+    cache2['c'] = 3
+    cache['d'] = 4
+    cache2.save()
+    with cache.lock():  # Can be held while saving
+        cache.save()
+        assert dict(cache.items()) == {'a': {'b': [1, 2]}, 'c': 3, 'd': 4}
+    assert JSONCache(filename)._data == {'a': {'b': [1, 2]}, 'c': 3, 'd': 4}
+
+    # Readable by others as allowed by umask, unlike a temporary file
+    assert os.stat(filename).st_mode & 0o777 == 0o666 & ~umask
+
+    # Corrupted cache is treated as empty
+    with open(filename, 'w') as fout:
+        fout.write('{')
+    assert JSONCache(filename).get('a') is None
+
+
+def _add_entry(cache, params, size, mtime):
+    key = cache.make_key(params)
+    stagedir = cache.stage()
+    with open(os.path.join(stagedir, 'foo.fits'), 'wb') as fout:
+        fout.write(b'0' * size)
+    entry = cache.put(key, stagedir)
+    os.utime(entry, (mtime, mtime))
+    return key
+
+
+def test_file_cache(tmpdir, umask):
+    cache = FileCache(tmpdir.join('thumbs').strpath)
+    assert cache.make_key({'a': 1, 'b': (2, 3)}) == cache.make_key(
+        {'b': [2, 3], 'a': 1})
+    key = cache.make_key({'a': 1})
+    assert cache.get(key) is None
+
+    stagedir = cache.stage()
+    tmpdir.join('thumbs', os.path.basename(stagedir), 'foo.fits').write('x')
+    entry = cache.put(key, stagedir)
+    assert entry == cache.entry_dir(key)
+    assert not os.path.exists(stagedir)
+    assert cache.get(key) == entry
+    assert os.listdir(entry) == ['foo.fits']
+
+    # Entry is readable by others as allowed by umask, unlike a temporary
+    # directory
+    assert os.stat(entry).st_mode & 0o777 == 0o777 & ~umask
+
+    # Another session added the same entry first
+    stagedir = cache.stage()
+    assert cache.put(key, stagedir) == entry
+    assert not os.path.exists(stagedir)
+    assert os.listdir(entry) == ['foo.fits']
+
+    # No size limit
+    assert cache.evict() == []
+
+
+def test_file_cache_evict(tmpdir):
+    cache = FileCache(tmpdir.strpath, max_size=250)
+    keys = [_add_entry(cache, {'i': i}, 100, 1000 + i) for i in range(4)]
+    assert cache.evict(keep=keys[:1]) == keys[1:3]
+
+    # Recently used entry is kept
+    assert cache.get(keys[0]) is not None
+    keys.append(_add_entry(cache, {'i': 4}, 100, 2000))
+    assert cache.evict() == [keys[3]]
+    assert sorted(d for d in os.listdir(tmpdir.strpath)
+                  if not d.startswith('.')) == sorted([keys[0], keys[4]])
+
+    # Abandoned staging directory is removed
+    stagedir = cache.stage()
+    cache.evict()
+    assert os.path.isdir(stagedir)
+    t = os.stat(stagedir).st_mtime - cache_module._stale_stage_age - 1
+    os.utime(stagedir, (t, t))
+    cache.evict()
+    assert not os.path.exists(stagedir)
+
+
+def test_file_cache_other_account(tmpdir, monkeypatch, umask):
+    cache = FileCache(tmpdir.strpath)
+    key = _add_entry(cache, {'i': 0}, 100, 1000)
+    lockfile = tmpdir.join('.lock').strpath
+    assert os.stat(lockfile).st_mode & 0o777 == 0o666 & ~umask
+
+    # Lock file and entry made by another account, as far as we can tell
+    # without one: Lock file is read-only and entry cannot be touched.
+    os.chmod(lockfile, 0o444)
+    entry = cache.entry_dir(key)
+    utime = os.utime
+
+    def foreign_utime(path, *args, **kwargs):
+        if path == entry and not args and not kwargs:
+            raise PermissionError(1, 'Operation not permitted', path)
+        return utime(path, *args, **kwargs)
+
+    monkeypatch.setattr(cache_module.os, 'utime', foreign_utime)
+    assert cache.get(key) == entry
+    assert os.stat(entry).st_mtime == 1000
+    assert cache.put(key, cache.stage()) == entry
+    assert os.stat(entry).st_mtime == 1000
@@ -1,4 +1,8 @@
-from wss_tools.utils.io import output_xml
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from wss_tools.utils.io import convert_image_file, make_image_hdu, output_xml
 
 
 def test_output_xml(tmpdir):
@@ -12,3 +16,48 @@ def test_output_xml(tmpdir):
     assert len(lines) == 2
     assert lines[0] == '<?xml version="1.0" ?>\n'
     assert lines[1] == '<foo>bar</foo>\n'
+
+
+@pytest.mark.parametrize('quantize', ['uint8', 'int16', 'int32'])
+def test_make_image_hdu_quantize(tmpdir, quantize):
+    filename = str(tmpdir.join('quantized.fits'))
+    data = np.linspace(-10, 90, 200).reshape(10, 20)
+    data[0, 0] = np.nan
+    make_image_hdu(data, quantize=quantize).writeto(filename)
+
+    with fits.open(filename) as pf:
+        assert pf[0].header['BITPIX'] == fits.DTYPE2BITPIX[quantize]
+        outdata = pf[0].data
+
+    assert np.isnan(outdata[0, 0])
+    np.testing.assert_allclose(outdata[1:], data[1:],
+                               atol=100 / np.iinfo(quantize).max)
+    assert np.nanmin(outdata) == pytest.approx(data[0, 1])
+    assert np.nanmax(outdata) == pytest.approx(90)
+
+
+def test_make_image_hdu_invalid():
+    with pytest.raises(ValueError, match='floating point'):
+        make_image_hdu(np.zeros((2, 2)), dtype=np.int16)
+    with pytest.raises(ValueError, match='Unsupported quantize'):
+        make_image_hdu(np.zeros((2, 2)), quantize='float32')
+
+
+def test_convert_image_file(tmpdir):
+    filename = str(tmpdir.join('image.fits'))
+    data = np.arange(12, dtype=np.float64).reshape(3, 4)
+    hdu = fits.PrimaryHDU(data)
+    hdu.header['TARGNAME'] = 'FOO'
+    hdu.writeto(filename)
+
+    assert convert_image_file(filename)
+    assert not convert_image_file(filename)  # Already float32
+    with fits.open(filename) as pf:
+        assert pf[0].header['TARGNAME'] == 'FOO'
+        assert pf[0].data.dtype.name.endswith('float32')
+        np.testing.assert_array_equal(pf[0].data, data)
+
+    assert convert_image_file(filename, quantize='int16')
+    with fits.open(filename) as pf:
+        assert pf[0].header['BITPIX'] == 16
+        np.testing.assert_allclose(pf[0].data, data, atol=1e-3)
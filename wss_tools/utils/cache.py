@@ -0,0 +1,401 @@
+"""Module to handle persistent caches of intermediate products,
+e.g., in QUIP ``quipcache`` directory.
+
+"""
+
+# STDLIB
+import hashlib
+import json
+import os
+import secrets
+import shutil
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+__all__ = ['file_signature', 'JSONCache', 'FileCache']
+
+_lock_filename = '.lock'
+_stage_prefix = '.tmp'
+_stale_stage_age = 86400  # Seconds before abandoned staging dir is removed
+
+
+def _temp_names(dirname, prefix, suffix):
+    """Random names in the given directory, to try in turn."""
+    while True:
+        yield os.path.join(dirname, f'{prefix}{secrets.token_hex(8)}{suffix}')
+
+
+def _mkstemp(dirname, suffix='', prefix='tmp'):
+    """Like :func:`tempfile.mkstemp` but the file has the same permissions
+    as one created normally, i.e., following umask, instead of private,
+    so that others can read it once it is renamed into place.
+
+    Returns
+    -------
+    fd : int
+        File descriptor, open for writing.
+
+    filename : str
+        Temporary file.
+
+    """
+    for filename in _temp_names(dirname, prefix, suffix):
+        try:
+            fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o666)
+        except FileExistsError:
+            continue
+        return fd, filename
+
+
+def _mkdtemp(dirname, prefix='tmp'):
+    """Like :func:`tempfile.mkdtemp` but the directory has the same
+    permissions as one created normally, i.e., following umask.
+
+    """
+    for path in _temp_names(dirname, prefix, ''):
+        try:
+            os.mkdir(path, 0o777)
+        except FileExistsError:
+            continue
+        return path
+
+
+@contextmanager
+def _flock(filename):
+    """Context manager to hold an exclusive lock on the given file,
+    which is created if needed. It is only opened for reading, which is
+    all that locking needs, so it works even if another account
+    created it. Locking is not available on Windows.
+
+    """
+    if fcntl is None:
+        yield
+        return
+
+    fd = os.open(filename, os.O_RDONLY | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def _touch(path):
+    """Mark the given file or directory as recently used. This is skipped
+    if it belongs to another account that did not allow it.
+
+    """
+    try:
+        os.utime(path)
+    except PermissionError:
+        pass
+
+
+def file_signature(filename, content_hash=False):
+    """Identity of a file, to tell whether it has changed since
+    it was last seen.
+
+    Parameters
+    ----------
+    filename : str
+        Filename.
+
+    content_hash : bool
+        Also include SHA-256 hash of the file contents. This is more
+        robust than modification time but requires reading the whole file.
+
+    Returns
+    -------
+    sig : dict
+        Absolute path, size in bytes, and modification time in nanoseconds
+        (and ``sha256`` hex digest, if requested).
+
+    Raises
+    ------
+    OSError
+        File does not exist.
+
+    """
+    st = os.stat(filename)
+    sig = {'path': os.path.abspath(filename), 'size': st.st_size,
+           'mtime': st.st_mtime_ns}
+
+    if content_hash:
+        h = hashlib.sha256()
+        with open(filename, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(1 << 20), b''):
+                h.update(chunk)
+        sig['sha256'] = h.hexdigest()
+
+    return sig
+
+
+class JSONCache:
+    """Persistent key-value store in a JSON file.
+
+    Values must be JSON-serializable. Changes are only written out
+    by :meth:`save`, which merges them with whatever is on disk at that
+    time and replaces the file atomically, under an exclusive lock,
+    so concurrent processes sharing a cache would not corrupt it.
+
+    Parameters
+    ----------
+    filename : str
+        Cache file. It does not need to exist yet.
+
+    Examples
+    --------
+    >>> from wss_tools.utils.cache import JSONCache
+    >>> cache = JSONCache('quipcache/mycache.json')  # doctest: +SKIP
+    >>> cache['key'] = {'answer': 42}  # doctest: +SKIP
+    >>> cache.save()  # doctest: +SKIP
+
+    """
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self._data = self._load()
+        self._changed = {}
+        self._locked = False
+
+    def _load(self):
+        """Read cache from disk. Missing or corrupted file is
+        treated as empty cache.
+
+        """
+        try:
+            with open(self.filename) as fin:
+                data = json.load(fin)
+        except (OSError, ValueError):
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        return data
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, val):
+        self._data[key] = val
+        self._changed[key] = val
+
+    def get(self, key, default=None):
+        """Return cached value or the given default."""
+        return self._data.get(key, default)
+
+    def items(self):
+        """Cached keys and values, as of the last load or :meth:`save`."""
+        return self._data.items()
+
+    @contextmanager
+    def lock(self):
+        """Context manager to hold an exclusive lock on the cache, e.g.,
+        to act on what all processes saved, right after :meth:`save`,
+        before any of them saves again. Lock is held on a file next
+        to the cache file. It can be nested.
+
+        """
+        if self._locked:
+            yield
+            return
+
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        with _flock(f'{self.filename}.lock'):
+            self._locked = True
+            try:
+                yield
+            finally:
+                self._locked = False
+
+    def save(self):
+        """Write changes to disk."""
+        if not self._changed:
+            return
+
+        with self.lock():
+            data = self._load()
+            data.update(self._changed)
+
+            fd, tmpname = _mkstemp(os.path.dirname(self.filename),
+                                   suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as fout:
+                    json.dump(data, fout, indent=1)
+                os.replace(tmpname, self.filename)
+            except BaseException:
+                os.remove(tmpname)
+                raise
+
+        self._data = data
+        self._changed = {}
+
+
+class FileCache:
+    """Content-addressed store of files in a directory, with
+    least-recently-used (LRU) eviction.
+
+    Each entry is a sub-directory named by the hash of its key, which
+    should describe everything that went into making its files
+    (see :meth:`make_key`), so files from different inputs never collide
+    even if they have the same name. Entries are created atomically from
+    a staging directory, and modifications are done under an exclusive
+    lock on the cache directory, so several processes can share a cache,
+    including those of other accounts if permissions allow. Entries of
+    another account are not marked as recently used, unless it allowed
+    writing to them. Locking is not available on Windows.
+
+    Parameters
+    ----------
+    dirname : str
+        Cache directory. It is created if it does not exist yet.
+
+    max_size : int or `None`
+        Maximum total size in bytes of all entries. When exceeded,
+        :meth:`evict` removes least recently used entries first.
+        If `None`, cache grows without limit.
+
+    Examples
+    --------
+    >>> from wss_tools.utils.cache import FileCache
+    >>> cache = FileCache('quipcache/thumbnails')  # doctest: +SKIP
+    >>> key = cache.make_key({'input': 'a.fits', 'width': 500})
+    >>> entry = cache.get(key)  # doctest: +SKIP
+    >>> if entry is None:  # doctest: +SKIP
+    ...     stagedir = cache.stage()
+    ...     # Write files to stagedir here
+    ...     entry = cache.put(key, stagedir)
+    >>> cache.evict(keep=[key])  # doctest: +SKIP
+
+    """
+    def __init__(self, dirname, max_size=None):
+        self.dirname = os.path.abspath(dirname)
+        self.max_size = max_size
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname, exist_ok=True)
+
+    @staticmethod
+    def make_key(params):
+        """Cache key from the given JSON-serializable parameters.
+        Values that are not serializable are converted to string.
+
+        """
+        s = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(s.encode()).hexdigest()
+
+    @contextmanager
+    def lock(self):
+        """Context manager to hold an exclusive lock on the cache."""
+        with _flock(os.path.join(self.dirname, _lock_filename)):
+            yield
+
+    def entry_dir(self, key):
+        """Directory of the entry with the given key,
+        whether it exists or not.
+
+        """
+        return os.path.join(self.dirname, key)
+
+    def get(self, key):
+        """Directory of cached entry, marked as recently used,
+        or `None` if there is no such entry.
+
+        """
+        entry = self.entry_dir(key)
+        with self.lock():
+            if not os.path.isdir(entry):
+                return None
+            _touch(entry)
+        return entry
+
+    def stage(self):
+        """New staging directory to write files for an entry in,
+        before they are added with :meth:`put`. It has the same
+        permissions as a directory created normally, so the entry can
+        be read by other processes sharing the cache.
+
+        """
+        return _mkdtemp(self.dirname, prefix=_stage_prefix)
+
+    def put(self, key, stagedir):
+        """Add files in the given staging directory as entry for the key.
+        If another process added the same entry first, that one is kept
+        and the staging directory is removed.
+
+        Returns
+        -------
+        entry : str
+            Entry directory.
+
+        """
+        entry = self.entry_dir(key)
+        with self.lock():
+            if os.path.isdir(entry):
+                shutil.rmtree(stagedir)
+            else:
+                os.replace(stagedir, entry)
+            _touch(entry)
+        return entry
+
+    def evict(self, keep=()):
+        """Remove least recently used entries until the total size is
+        within ``max_size``. Staging directories abandoned by processes
+        that did not finish are also removed.
+
+        Parameters
+        ----------
+        keep : iterable of str
+            Keys of entries that must not be removed,
+            e.g., those still in use.
+
+        Returns
+        -------
+        removed : list of str
+            Keys of removed entries.
+
+        """
+        keep = set(keep)
+        removed = []
+
+        with self.lock():
+            entries = []
+            total = 0
+            now = time.time()
+            for de in os.scandir(self.dirname):
+                if not de.is_dir():
+                    continue
+                mtime = de.stat().st_mtime
+                if de.name.startswith(_stage_prefix):
+                    if now - mtime > _stale_stage_age:
+                        shutil.rmtree(de.path, ignore_errors=True)
+                    continue
+                size = sum(f.stat().st_size for f in os.scandir(de.path)
+                           if f.is_file())
+                entries.append((mtime, size, de.name))
+                total += size
+
+            if self.max_size is None:
+                return removed
+
+            for mtime, size, key in sorted(entries):
+                if total <= self.max_size:
+                    break
+                if key in keep:
+                    continue
+                shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+                total -= size
+                removed.append(key)
+
+        return removed
@@ -7,7 +7,11 @@ import xml.etree.ElementTree as ET
 from collections import defaultdict
 from xml.dom import minidom
 
-__all__ = ['output_xml']
+# THIRD-PARTY
+import numpy as np
+from astropy.io import fits
+
+__all__ = ['output_xml', 'make_image_hdu', 'convert_image_file']
 
 
 # --------------------- #
@@ -94,6 +98,125 @@ def output_xml(xmldict, filename):
         fout.write(reparsed.toprettyxml(indent='    '))
 
 
+# ------------------ #
+# FITS IMAGE OUTPUTS #
+# ------------------ #
+
+def make_image_hdu(data, header=None, dtype=np.float32, quantize=None,
+                   name=None):
+    """HDU of an output image with the given data type.
+
+    Parameters
+    ----------
+    data : ndarray
+        Image data.
+
+    header : `~astropy.io.fits.Header` or `None`
+        Header to use, if any.
+
+    dtype : data-type
+        Floating point data type to store, if not quantized.
+
+    quantize : {`None`, 'uint8', 'int16', 'int32'}
+        If given, store the data as this integer type instead, scaled
+        linearly between minimum and maximum finite values with
+        BSCALE/BZERO. Non-finite values are stored as BLANK, which
+        is the smallest (or largest, if unsigned) value of the integer
+        type. This is lossy and
+        only meant for preview products.
+
+    name : str or `None`
+        If given, return an image extension with this EXTNAME instead
+        of a primary HDU.
+
+    Returns
+    -------
+    hdu : `~astropy.io.fits.PrimaryHDU` or `~astropy.io.fits.ImageHDU`
+        Output HDU.
+
+    Raises
+    ------
+    ValueError
+        Invalid data type.
+
+    """
+    if quantize is None:
+        if not np.issubdtype(dtype, np.floating):
+            raise ValueError(f'Unsupported dtype ({dtype}), must be '
+                             'floating point')
+        return _new_image_hdu(np.asarray(data, dtype=dtype), header, name)
+
+    if quantize not in ('uint8', 'int16', 'int32'):
+        raise ValueError(f'Unsupported quantize ({quantize}), must be '
+                         "'uint8', 'int16', or 'int32'")
+
+    data = np.asarray(data, dtype=np.float64)
+    good = np.isfinite(data)
+    info = np.iinfo(quantize)
+    if info.min < 0:
+        blank = info.min
+        first = info.min + 1
+    else:  # BLANK of 0 is ignored by astropy
+        blank = info.max
+        first = 0
+    if np.any(good):
+        lo = data[good].min()
+        hi = data[good].max()
+    else:
+        lo = hi = 0.0
+    bscale = (hi - lo) / (info.max - info.min - 1) if hi > lo else 1.0
+    bzero = lo - bscale * first
+
+    outdata = np.full(data.shape, blank, dtype=quantize)
+    outdata[good] = np.round((data[good] - bzero) / bscale)
+
+    hdu = _new_image_hdu(outdata, header, name)
+    hdu.header['BSCALE'] = bscale
+    hdu.header['BZERO'] = bzero
+    hdu.header['BLANK'] = blank
+    return hdu
+
+
+def _new_image_hdu(data, header, name):
+    """Primary HDU, or image extension if a name is given."""
+    if name is None:
+        return fits.PrimaryHDU(data, header=header)
+    return fits.ImageHDU(data, header=header, name=name)
+
+
+def convert_image_file(filename, dtype=np.float32, quantize=None):
+    """Rewrite the data of a single-extension FITS image in place
+    with the given data type, if it is not stored that way already.
+
+    Parameters
+    ----------
+    filename : str
+        FITS file.
+
+    dtype, quantize
+        See :func:`make_image_hdu`.
+
+    Returns
+    -------
+    converted : bool
+        `True` if the file was rewritten.
+
+    """
+    bitpix = fits.DTYPE2BITPIX[np.dtype(quantize or dtype).name]
+    with fits.open(filename, memmap=False) as pf:
+        header = pf[0].header
+        if header['BITPIX'] == bitpix:
+            return False
+        data = pf[0].data
+
+    for key in ('BSCALE', 'BZERO', 'BLANK'):
+        header.remove(key, ignore_missing=True)
+
+    make_image_hdu(data, header=header, dtype=dtype,
+                   quantize=quantize).writeto(filename, overwrite=True)
+    return True
+
+
 # -------------- #
 # OUTPUTS TO WEx #
 # -------------- #
@@ -1,17 +1,33 @@
 """This module contains tools for NIRCAM image mosaic."""
 
 # STDLIB
+import copy
+import hashlib
+import json
+import multiprocessing
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # THIRD-PARTY
 import astropy
 import numpy as np
 from astropy.io import fits
 from astropy.utils.introspection import minversion
-from scipy.ndimage.interpolation import zoom
+
+# LOCAL
+from .cache import JSONCache, _mkstemp, file_signature
+from .io import make_image_hdu
+from .quicklook import quicklook_filename, write_quicklook
+from .resample import resample, zoom_shape
 
 __all__ = ['NircamMosaic']
 
+_fits_block_size = 2880  # bytes
+_cache_filename = 'mosaic_cache.json'
+_tile_cache_dirname = 'mosaic_tiles'
+
 
 class NircamMosaic:
     """
@@ -36,6 +52,66 @@ class NircamMosaic:
         in the mosaic. SCA of LONG channel will be
         automatically resized to twice this value.
 
+    n_threads : int
+        Number of threads used to read FITS headers. More than one
+        can help on slow network filesystems. Within a mosaic, this many
+        threads also read upcoming detectors while as many others resample
+        the ones already read, so that I/O and computation overlap.
+        At most twice this many detectors are held in memory at once.
+
+    resample_method : {'area', 'spline'}
+        Algorithm used to resize the detectors.
+        See :func:`~wss_tools.utils.resample.resample`.
+
+    dtype : data-type
+        Floating point data type of the mosaic.
+
+    quantize : {`None`, 'uint8', 'int16', 'int32'}
+        If given, mosaic files are written as scaled integers of this
+        type instead, which is lossy but smaller.
+        See :func:`~wss_tools.utils.io.make_image_hdu`.
+        This is not supported with ``out_of_core``.
+
+    pyramid : list of int or `None`
+        Additional SHORT SCA sizes (e.g., ``[64, 1024]``) at which to
+        also build each mosaic in the same pass, to be stored as
+        ``PYRAMID`` extensions of the mosaic file with :meth:`make_mosaic`.
+        A viewer can then load a coarse level quickly and finer ones
+        on demand. Each detector is read only once at the finest level;
+        each coarser level is resampled from the next finer one.
+        This is not supported with ``out_of_core``.
+
+    quicklook : {`None`, 'png', 'jpg', 'jpeg'}
+        If given, :meth:`make_mosaic` also writes a quicklook image of
+        each mosaic next to it, in this format, from the same worker.
+        With ``out_of_core``, it is decimated to fit the size of the
+        largest detector in the mosaic, so memory use stays bounded.
+
+    quicklook_kwargs : dict or `None`
+        Optional keywords for
+        :func:`~wss_tools.utils.quicklook.write_quicklook`,
+        e.g., ``autocut_method``.
+
+    out_of_core : bool
+        If `True`, :meth:`make_mosaic` preallocates each mosaic file on
+        disk and writes each detector directly into its memory-mapped
+        data, so that peak memory is bounded by a single detector
+        regardless of mosaic size. This is useful for mosaics at or near
+        native resolution.
+
+    cachedir : str or `None`
+        If given, enable incremental rebuilds with cache in this directory
+        (e.g., QUIP ``quipcache``). :meth:`make_mosaic` records which input
+        files and settings went into each mosaic, so that a mosaic is
+        reused if and only if none of them changed since, regardless of
+        ``clobber``. Each resampled detector is also cached, so that only
+        changed detectors are resampled again when a mosaic is rebuilt.
+
+    Raises
+    ------
+    ValueError
+        Unsupported combination of options.
+
     Examples
     --------
     >>> images = ['myimage1.fits', 'myimage2.fits', ...]
@@ -48,9 +124,30 @@ class NircamMosaic:
     _module_gap = 1250.0  # Actual gap size between modules in pixels
     _pri_ext = 'PRIMARY'
 
-    def __init__(self, data_ext=('SCI', 1), sw_sca_size=100):
+    # Primary header keywords inherited by the mosaic from its first image
+    _inherit_keys = ('ROOTNAME', 'TARGNAME', 'INSTRUME', 'FILTER', 'PUPIL',
+                     'DATE-OBS', 'TIME-OBS')
+
+    def __init__(self, data_ext=('SCI', 1), sw_sca_size=100, n_threads=1,
+                 resample_method='area', dtype=np.float32, quantize=None,
+                 pyramid=None, quicklook=None, quicklook_kwargs=None,
+                 out_of_core=False, cachedir=None):
+        if out_of_core and quantize is not None:
+            raise ValueError('quantize is not supported with out_of_core')
+        if out_of_core and pyramid:
+            raise ValueError('pyramid is not supported with out_of_core')
+
         self.data_ext = data_ext
         self.sw_sca_size = sw_sca_size  # Sets multiple attributes at once
+        self.n_threads = n_threads
+        self.resample_method = resample_method
+        self.dtype = dtype
+        self.quantize = quantize
+        self.pyramid = pyramid
+        self.quicklook = quicklook
+        self.quicklook_kwargs = quicklook_kwargs
+        self.out_of_core = out_of_core
+        self.cachedir = cachedir
 
     @property
     def sw_sca_size(self):
@@ -110,125 +207,510 @@ class NircamMosaic:
             raise ValueError(f'Undefined mosaic position for {key}')
         return pos
 
-    def _single_sw_module(self, images):
-        """Mosaic a single SHORT module."""
-        mosaic = None
+    def _read_header_info(self, filename):
+        """Read header information needed for mosaic from a single file.
 
-        for im in images:
-            with fits.open(im) as pf:
-                dat = pf[self.data_ext].data
-                detector = pf[self._pri_ext].header.get('DETECTOR', '')
+        Returns
+        -------
+        info : dict
+            Filename, DETECTOR, INSTRUME, module (``'A'`` or ``'B'``),
+            channel (``'SHORT'`` or ``'LONG'``), data shape, and primary
+            header keywords to inherit. Module, channel, and shape are
+            `None` if the file does not belong in a NIRCam mosaic.
+
+        """
+        # Only headers are loaded here, not data.
+        with fits.open(filename) as pf:
+            info = self._get_info(pf[self._pri_ext].header, None,
+                                  filename=filename)
+            if info['module'] is None:
+                return info
 
-            dat = zoom(dat, self.sw_zoom_factor)
+            try:
+                hdr = pf[self.data_ext].header
+            except KeyError:  # Not something we can mosaic
+                info['module'] = info['channel'] = None
+                return info
+
+        info['shape'] = tuple(hdr.get(f'NAXIS{i}', 0)
+                              for i in range(hdr.get('NAXIS', 0), 0, -1))
+        return info
+
+    def _get_record_info(self, record):
+        """Header information needed for mosaic from an in-memory record,
+        i.e., ``(detector, header, data)`` or HDU list. Same as
+        :meth:`_read_header_info`, except that the data are included and
+        filename is `None` unless the HDU list came from a file.
+
+        """
+        if isinstance(record, fits.HDUList):
+            prihdr = record[self._pri_ext].header
+            data = record[self.data_ext].data
+            return self._get_info(prihdr, data.shape, data=data,
+                                  filename=record.filename())
+
+        detector, header, data = record
+        if header is None:
+            header = {}
+        data = np.asarray(data)
+        return self._get_info(header, data.shape, data=data,
+                              detector=detector, instrume='NIRCAM')
+
+    def _get_info(self, prihdr, shape, filename=None, data=None,
+                  detector=None, instrume=''):
+        """Header information needed for mosaic. DETECTOR and INSTRUME
+        are from the given primary header, if available.
 
-            if mosaic is None:
-                mosaic = np.zeros((dat.shape[0] * 2 + self.sca_gap,
-                                   dat.shape[1] * 2 + self.sca_gap))
+        """
+        detector = prihdr.get('DETECTOR', detector or '').upper()
+        instrume = prihdr.get('INSTRUME', instrume).upper()
+        module = detector[3:4]
+        channel = detector[4:]
+        if channel in ('1', '2', '3', '4'):
+            channel = 'SHORT'
+        if ((instrume != 'NIRCAM') or (channel not in ('SHORT', 'LONG')) or
+                (module not in ('A', 'B'))):
+            module = None
+            channel = None
+
+        info = {'filename': filename, 'detector': detector,
+                'instrume': instrume, 'module': module, 'channel': channel,
+                'shape': shape,
+                'inherit': {key: prihdr[key] for key in self._inherit_keys
+                            if key in prihdr}}
+        if data is not None:
+            info['data'] = data
+        return info
+
+    def build_header_index(self, images):
+        """Read header information needed for mosaic from all the
+        given files in one pass, so that later stages do not need to
+        reopen the files for headers.
 
-            _insert_image(self._get_position(detector), dat, mosaic)
+        Parameters
+        ----------
+        images : list
+            List of filenames.
 
-        return mosaic
+        Returns
+        -------
+        header_index : dict
+            Mapping of filename to its header information.
 
-    def _combine_sw_lw(self, sw_mosaic, lw_image):
-        """Combine SHORT and LONG for a single module."""
-        if lw_image is None:
-            return sw_mosaic
+        """
+        if self.n_threads > 1 and len(images) > 1:
+            with ThreadPoolExecutor(self.n_threads) as executor:
+                infolist = list(executor.map(self._read_header_info, images))
+        else:
+            infolist = list(map(self._read_header_info, images))
 
-        with fits.open(lw_image) as pf:
-            lw_detector = pf[self._pri_ext].header.get('DETECTOR', '')
-            lw_data = pf[self.data_ext].data
+        return {info['filename']: info for info in infolist}
 
-        lw_data = zoom(lw_data, self.lw_zoom_factor)
+    def _module_layout(self, sw_infolist, lw_info):
+        """Layout of a single module, with SHORT at the bottom and
+        LONG at the top.
 
-        if sw_mosaic is None:
-            return lw_data
+        Returns
+        -------
+        shape : tuple of int or `None`
+            Module shape, or `None` if there is nothing to mosaic.
 
-        nx = max(sw_mosaic.shape[1], lw_data.shape[1])
-        ny = sw_mosaic.shape[0] + lw_data.shape[0] + self.module_gap
-        mosaic = np.zeros((ny, nx))
-        _insert_image(self._get_position('SHORT'), sw_mosaic, mosaic)
-        _insert_image(self._get_position(lw_detector), lw_data, mosaic)
+        tiles : list
+            List of ``(info, zoom_factor, (y1, x1))`` for each detector,
+            where ``(y1, x1)`` is its origin in the module.
 
-        return mosaic
+        """
+        shape = None
+        tiles = []
 
-    def _combine_modules(self, module_a, module_b):
-        """Combine mosaics of Modules A and B."""
-        if module_a is None:
-            return module_b
-        if module_b is None:
-            return module_a
+        if sw_infolist:
+            sca_shape = zoom_shape(sw_infolist[0]['shape'],
+                                   self.sw_zoom_factor)
+            shape = (sca_shape[0] * 2 + self.sca_gap,
+                     sca_shape[1] * 2 + self.sca_gap)
+            for info in sw_infolist:
+                tiles.append((info, self.sw_zoom_factor, _slot_origin(
+                    self._get_position(info['detector']),
+                    zoom_shape(info['shape'], self.sw_zoom_factor), shape)))
 
-        # Fast
-        if module_a.shape[0] == module_b.shape[0]:
-            gap = np.zeros((module_a.shape[0], self.module_gap))
-            mosaic = np.hstack((module_a, gap, module_b))
+        if lw_info is None:
+            return shape, tiles
 
-        # Slow
-        else:
-            nx = module_a.shape[1] + module_b.shape[1] + self.module_gap
-            ny = max(module_a.shape[0], module_b.shape[0])
-            mosaic = np.zeros((ny, nx))
+        lw_shape = zoom_shape(lw_info['shape'], self.lw_zoom_factor)
 
-            # Insert Module A
-            mosaic[:module_a.shape[0], :module_a.shape[1]] = module_a
+        if shape is None:
+            return lw_shape, [(lw_info, self.lw_zoom_factor, (0, 0))]
 
-            # Insert Module B
-            x2 = mosaic.shape[1]
-            x1 = x2 - module_b.shape[1]
-            mosaic[:module_b.shape[0], x1:x2] = module_b
+        # SHORT is at the bottom, so its tiles stay where they are.
+        shape = (shape[0] + lw_shape[0] + self.module_gap,
+                 max(shape[1], lw_shape[1]))
+        tiles.append((lw_info, self.lw_zoom_factor, _slot_origin(
+            self._get_position(lw_info['detector']), lw_shape, shape)))
 
-        return mosaic
+        return shape, tiles
 
-    def get_single_mosaic_array(self, images):
-        """Construct mosaic from images that belong to the same dataset.
+    def get_layout(self, infolist):
+        """Compute the full mosaic layout from header information alone,
+        with Module A on the left and Module B on the right.
 
         Parameters
         ----------
-        images : list
-            List of filenames from the same dataset.
+        infolist : list
+            Header information of images from the same dataset,
+            as returned by :meth:`build_header_index`.
 
         Returns
         -------
-        mosaic : ndarray
-            Mosaic image.
+        shape : tuple of int or `None`
+            Mosaic shape, or `None` if there is nothing to mosaic.
+
+        tiles : list
+            List of ``(info, zoom_factor, (y1, x1))`` for each detector,
+            where ``(y1, x1)`` is its origin in the mosaic.
 
         """
         # Separate Modules A and B, Channels SHORT and LONG
         mod_list = {}
-        for im in images:
-            hdr = fits.getheader(im, self._pri_ext)
-            detector = hdr.get('DETECTOR', '').upper()  # NRC[A/B][1-4/LONG]
-            try:
-                module = detector[3]
-                channel = detector[4:]
-            except IndexError:
+        for info in infolist:
+            if info['module'] is None:
                 continue
-            if channel in ('1', '2', '3', '4'):
-                channel = 'SHORT'
-            if ((hdr.get('INSTRUME', '').upper() != 'NIRCAM') or
-                    (channel not in ('SHORT', 'LONG')) or
-                    (module not in ('A', 'B'))):
-                continue
-            key = (channel, module)
+            key = (info['channel'], info['module'])
             if key not in mod_list:
-                mod_list[key] = [im]
+                mod_list[key] = [info]
             else:
-                mod_list[key].append(im)
+                mod_list[key].append(info)
 
-        # Module A mosaic
-        mos_a = self._combine_sw_lw(
-            self._single_sw_module(mod_list.get(('SHORT', 'A'), [])),
+        shape_a, tiles_a = self._module_layout(
+            mod_list.get(('SHORT', 'A'), []),
             mod_list.get(('LONG', 'A'), [None])[0])
-
-        # Module B mosaic
-        mos_b = self._combine_sw_lw(
-            self._single_sw_module(mod_list.get(('SHORT', 'B'), [])),
+        shape_b, tiles_b = self._module_layout(
+            mod_list.get(('SHORT', 'B'), []),
             mod_list.get(('LONG', 'B'), [None])[0])
 
-        return self._combine_modules(mos_a, mos_b)
+        if shape_a is None:
+            return shape_b, tiles_b
+        if shape_b is None:
+            return shape_a, tiles_a
+
+        shape = (max(shape_a[0], shape_b[0]),
+                 shape_a[1] + shape_b[1] + self.module_gap)
+        x_b = shape[1] - shape_b[1]
+        tiles = tiles_a + [(info, zoom_factor, (y1, x1 + x_b))
+                           for info, zoom_factor, (y1, x1) in tiles_b]
+
+        return shape, tiles
+
+    def get_single_mosaic_array(self, images, header_index=None):
+        """Construct mosaic from images that belong to the same dataset.
+
+        Parameters
+        ----------
+        images : list
+            List of filenames from the same dataset.
+
+        header_index : dict or `None`
+            Header information from :meth:`build_header_index` that
+            covers the given images. If not given, it is built here.
+
+        Returns
+        -------
+        mosaic : ndarray
+            Mosaic image, with data type given by ``dtype``.
+
+        """
+        if header_index is None:
+            header_index = self.build_header_index(images)
+
+        pyramid = self.get_mosaic_pyramid(images, header_index=header_index,
+                                          sw_sca_sizes=[self.sw_sca_size])
+        if pyramid is None:
+            return None
+        return pyramid[self.sw_sca_size]
+
+    def get_mosaic_pyramid(self, images, header_index=None,
+                           sw_sca_sizes=None):
+        """Construct mosaics at multiple resolutions in one pass from
+        images that belong to the same dataset.
+
+        Each detector is read only once and resampled to the finest level.
+        Each coarser level is then resampled from the next finer one.
+
+        Parameters
+        ----------
+        images : list
+            List of filenames from the same dataset.
+
+        header_index : dict or `None`
+            Header information from :meth:`build_header_index` that
+            covers the given images. If not given, it is built here.
+
+        sw_sca_sizes : list of int or `None`
+            SHORT SCA sizes of the mosaics. If not given, it is
+            ``sw_sca_size`` and ``pyramid``.
+
+        Returns
+        -------
+        pyramid : dict or `None`
+            Mapping of SHORT SCA size to mosaic image, from the finest
+            to the coarsest, or `None` if there is nothing to mosaic.
+
+        """
+        if header_index is None:
+            header_index = self.build_header_index(images)
+
+        return self._build_pyramid([header_index[im] for im in images],
+                                   sw_sca_sizes=sw_sca_sizes)
+
+    def get_mosaic_from_data(self, records):
+        """Construct mosaic from in-memory detector data that belong
+        to the same dataset, without any disk I/O.
+
+        Parameters
+        ----------
+        records : list
+            List of ``(detector, header, data)`` records, where
+            ``detector`` is the detector name (e.g., ``'NRCA1'``),
+            ``header`` is a primary header, dictionary, or `None` to inherit
+            keywords from (its DETECTOR and INSTRUME take precedence, if
+            any), and ``data`` is the 2D detector image. An element can
+            also be an already open `~astropy.io.fits.HDUList`, with data
+            from ``data_ext``. Tile cache does not apply here.
+
+        Returns
+        -------
+        mosaic : ndarray or `None`
+            Mosaic image, with data type given by ``dtype``, or `None`
+            if there is nothing to mosaic.
+
+        header : `~astropy.io.fits.Header` or `None`
+            Keywords inherited from the header of the first record.
+
+        Examples
+        --------
+        >>> from wss_tools.utils.mosaic import NircamMosaic
+        >>> m = NircamMosaic()
+        >>> mosaic, header = m.get_mosaic_from_data(
+        ...     [('NRCA1', {'TARGNAME': 'FOO'}, data_a1),
+        ...      ('NRCA2', {'TARGNAME': 'FOO'}, data_a2)])  # doctest: +SKIP
+
+        """
+        infolist = [self._get_record_info(r) for r in records]
+        pyramid = self._build_pyramid(infolist,
+                                      sw_sca_sizes=[self.sw_sca_size])
+        if pyramid is None:
+            return None, None
+        return pyramid[self.sw_sca_size], self._get_header(infolist)
+
+    def _get_header(self, infolist):
+        """Mosaic header, with keywords inherited from the first image."""
+        header = fits.Header()
+        if not infolist:
+            return header
+
+        # Inherit some keywords from primary header from 1st image in list
+        for key, val in infolist[0]['inherit'].items():
+            header[key] = val
+
+        # Detector names if data did not come from files
+        names = [info['filename'] or info['detector'] for info in infolist]
+        header.add_history(f"Mosaic from {','.join(names)}")
+
+        return header
+
+    def _build_pyramid(self, infolist, sw_sca_sizes=None):
+        """Mosaics at all levels from the given header information,
+        as returned by :meth:`get_mosaic_pyramid`.
+
+        """
+        levels = self._get_levels(infolist, sw_sca_sizes=sw_sca_sizes)
+        if levels is None:
+            return None
+
+        tiles, levels = levels
+        mosaics = {size: np.zeros(shape, dtype=self.dtype)
+                   for size, shape, _ in levels}
+        self._fill_mosaic(
+            [(mosaics[size], placements) for size, _, placements in levels],
+            tiles)
+        return mosaics
+
+    def _get_levels(self, infolist, sw_sca_sizes=None):
+        """Layouts of pyramid levels, from the finest to the coarsest.
+
+        Returns
+        -------
+        tiles : list
+            Tiles of the finest level, as returned by :meth:`get_layout`.
+
+        levels : list
+            List of ``(sw_sca_size, shape, placements)`` for each level,
+            where ``placements`` lists origin and shape of each tile,
+            in the same order as ``tiles``.
+
+        Returns `None` instead if there is nothing to mosaic.
+
+        """
+        if sw_sca_sizes is None:
+            sw_sca_sizes = [self.sw_sca_size] + list(self.pyramid or [])
+
+        levels = []
+        for size in sorted(set(sw_sca_sizes), reverse=True):
+            level = copy.copy(self)
+            level.sw_sca_size = size
+            shape, tiles = level.get_layout(infolist)
+            if shape is None:
+                return None
+            if not levels:
+                finest_tiles = tiles
+            levels.append((size, shape, [
+                (origin, zoom_shape(info['shape'], zoom_factor))
+                for info, zoom_factor, origin in tiles]))
+
+        return finest_tiles, levels
+
+    def _place_levels(self, levels, i, tile):
+        """Insert i-th tile into each level, from the finest to the coarsest,
+        resampling from the previous level as needed.
+
+        """
+        for mosaic, placements in levels:
+            origin, shape = placements[i]
+            if tile.shape != shape:
+                # Each axis separately, because the aspect ratio of
+                # a rounded shape is not exactly that of the detector.
+                # This gives the exact shape, see zoom_shape().
+                tile = resample(tile, (shape[0] / tile.shape[0],
+                                       shape[1] / tile.shape[1]),
+                                method=self.resample_method)
+            _place_tile(mosaic, origin, tile)
+
+    def _fill_mosaic(self, levels, tiles):
+        """Resample each detector straight into its final place
+        in the given mosaic arrays, given as ``(mosaic, placements)``
+        for each level as returned by :meth:`_get_levels`.
+
+        With multiple threads, this is a pipeline where reader threads
+        prefetch detectors into a bounded queue while worker threads
+        resample the ones already read.
+
+        """
+        if self.n_threads < 2 or len(tiles) < 2:
+            for i, (info, zoom_factor, _) in enumerate(tiles):
+                self._place_levels(levels, i,
+                                   self._get_tile(info, zoom_factor))
+            return
+
+        tiles = enumerate(tiles)
+        reading = deque()
+        resampling = deque()
+
+        def prefetch():
+            item = next(tiles, None)
+            if item is not None:
+                i, (info, zoom_factor, _) = item
+                reading.append((i, info, zoom_factor, readers.submit(
+                    self._read_tile, info, zoom_factor)))
+
+        def place(i, info, zoom_factor, tile, data):
+            if tile is None:
+                tile = self._make_tile(info, zoom_factor, data)
+            self._place_levels(levels, i, tile)
+
+        with ThreadPoolExecutor(self.n_threads) as readers, \
+                ThreadPoolExecutor(self.n_threads) as workers:
+            for _ in range(self.n_threads):
+                prefetch()
+
+            while reading:
+                i, info, zoom_factor, future = reading.popleft()
+                tile, data = future.result()
+                prefetch()
+
+                # Do not let read data pile up if resampling is slower.
+                if len(resampling) >= self.n_threads:
+                    resampling.popleft().result()
+                resampling.append(workers.submit(
+                    place, i, info, zoom_factor, tile, data))
+
+            while resampling:
+                resampling.popleft().result()
+
+    def _tile_filename(self, info, zoom_factor):
+        """Tile cache filename for the given detector, or `None`.
+        In-memory data are never cached because they might differ from
+        the file they came from.
+
+        """
+        filename = info['filename']
+        if self.cachedir is None or filename is None or 'data' in info:
+            return None
+
+        # Tiles are addressed by everything that goes into them.
+        key = hashlib.sha256(json.dumps(
+            [file_signature(filename), _jsonify(self.data_ext),
+             zoom_factor, self.resample_method]).encode()).hexdigest()
+        return os.path.join(self.cachedir, _tile_cache_dirname, f'{key}.npy')
+
+    def _read_tile(self, info, zoom_factor):
+        """Read resampled detector from tile cache if available,
+        otherwise read its data to be resampled.
+
+        Returns
+        -------
+        tile, data : ndarray or `None`
+            Only one of them is given.
+
+        """
+        if 'data' in info:
+            return None, info['data']
+
+        tilename = self._tile_filename(info, zoom_factor)
+        if tilename is not None:
+            try:
+                return np.load(tilename), None
+            except (OSError, ValueError):
+                pass
+
+        return None, self._read_data(info)
+
+    def _read_data(self, info):
+        """Read detector data from file. Subclasses may override this to
+        make other products from the same read.
+
+        """
+        return fits.getdata(info['filename'], self.data_ext)
+
+    def _make_tile(self, info, zoom_factor, data):
+        """Resample detector data and store it in tile cache, if enabled."""
+        tile = resample(data, zoom_factor, method=self.resample_method)
+
+        tilename = self._tile_filename(info, zoom_factor)
+        if tilename is None:
+            return tile
+
+        tiledir = os.path.dirname(tilename)
+        os.makedirs(tiledir, exist_ok=True)
+        fd, tmpname = _mkstemp(tiledir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                np.save(fout, tile)
+            os.replace(tmpname, tilename)
+        except BaseException:
+            os.remove(tmpname)
+            raise
+
+        return tile
+
+    def _get_tile(self, info, zoom_factor):
+        """Resampled detector, from tile cache if available."""
+        tile, data = self._read_tile(info, zoom_factor)
+        if tile is None:
+            tile = self._make_tile(info, zoom_factor, data)
+        return tile
 
     def make_mosaic(self, images, outpath='', outsuffix='mosaic',
-                    clobber=False, debug=False):
+                    clobber=False, debug=False, n_workers=1,
+                    mp_context=None):
         """Construct one mosaic for each dataset, for multiple datasets.
 
         Images are sorted into datasets by JWST naming convention,
@@ -238,6 +720,10 @@ class NircamMosaic:
         Each mosaic is saved as ``ROOTNAME_<outsuffix>.fits``,
         a single-extension FITS image.
 
+        This returns only when all the mosaics are done.
+        To process each mosaic as soon as it is done, use
+        :meth:`iter_mosaics` instead.
+
         Parameters
         ----------
         images : list
@@ -251,16 +737,65 @@ class NircamMosaic:
             Output suffix.
 
         clobber : bool
-            If `True`, overwrite existing mosaic file(s).
+            If `True`, overwrite existing mosaic file(s). This does not
+            apply when ``cachedir`` is set; Then, a mosaic is only reused
+            if it is in cache and up to date, otherwise it is rebuilt.
 
         debug : bool
             If `True`, print extra information to screen.
 
+        n_workers : int or `None`
+            Number of worker processes to build the mosaics of different
+            datasets concurrently. If `None`, it is set to the number of
+            available CPU cores or the number of datasets, whichever is
+            smaller.
+
+        mp_context : `multiprocessing` context or `None`
+            Context to start worker processes with, e.g.,
+            ``multiprocessing.get_context('spawn')`` when called from
+            a thread. If not given, the default context is used.
+
         Returns
         -------
         mosaiclist : list
             List of mosaic filenames.
 
+        """
+        return sorted(outname for _, outname in self.iter_mosaics(
+            images, outpath=outpath, outsuffix=outsuffix, clobber=clobber,
+            debug=debug, n_workers=n_workers, mp_context=mp_context,
+            ordered=False) if outname)
+
+    def iter_mosaics(self, images, outpath='', outsuffix='mosaic',
+                     clobber=False, debug=False, n_workers=1,
+                     mp_context=None, ordered=True):
+        """Like :meth:`make_mosaic` but yield each mosaic as soon as
+        it is done, so that the caller can use it or report progress
+        while the rest are still being built.
+
+        If the generator is closed early, outstanding work is cancelled.
+        If a dataset fails, the mosaics that are already done are kept
+        (and cached, if enabled) before the error is raised.
+
+        Parameters
+        ----------
+        images, outpath, outsuffix, clobber, debug, n_workers, mp_context
+            See :meth:`make_mosaic`.
+
+        ordered : bool
+            If `True`, mosaics are yielded in the order of the datasets as
+            they first appear in ``images``. Otherwise, they are yielded
+            as soon as each is done, which keeps multiple workers busy.
+
+        Yields
+        ------
+        rootname : str
+            Dataset ROOTNAME.
+
+        outname : str
+            Mosaic filename, or empty string if there is no mosaic
+            for that dataset.
+
         """
         # Separate different datasets
         root_list = {}
@@ -271,72 +806,284 @@ class NircamMosaic:
             else:
                 root_list[rootname].append(im)
 
-        # Process each dataset
-        def _mosaic_one(rootname):
-            imlist = root_list[rootname]
-            outname = os.path.join(
-                outpath, f'{rootname}_{outsuffix}.fits')
-
-            # Avoid regenerating mosaic if already exist.
-            # This also avoids crashing at the very end.
-            if not clobber and os.path.exists(outname):
-                if debug:
-                    print(f'Using existing {outname}')
-                return outname
+        if n_workers is None:
+            n_workers = min(multiprocessing.cpu_count(), len(root_list))
 
-            mosaic = self.get_single_mosaic_array(imlist)
-            if mosaic is None:
+        if self.cachedir is None:
+            cache = None
+        else:
+            cache = JSONCache(os.path.join(self.cachedir, _cache_filename))
+
+        # Only read headers for mosaics that need to be built.
+        cached = {}
+        todo = {}
+        for rootname, imlist in root_list.items():
+            outname = _output_filename(outpath, rootname, outsuffix)
+            up_to_date = self._get_cached(cache, outname, imlist)
+            if up_to_date is None:
+                # Existing file not built with cache might be stale.
+                todo[rootname] = clobber or cache is not None
+            elif up_to_date:
                 if debug:
-                    print(f'No mosaic for {imlist}')
-                return ''
-
-            hdu = fits.PrimaryHDU(mosaic)
-
-            # Inherit some keywords from primary header from 1st image in list
-            prihdr = fits.getheader(imlist[0])
-            for key in ('ROOTNAME', 'TARGNAME', 'INSTRUME',
-                        'FILTER', 'PUPIL', 'DATE-OBS', 'TIME-OBS'):
-                if key not in prihdr:
-                    continue
-                hdu.header[key] = prihdr[key]
-
-            hdu.header.add_history(f"Mosaic from {','.join(imlist)}")
-            if minversion(astropy, '1.3'):
-                hdu.writeto(outname, overwrite=clobber)
+                    print(f'Using cached {outname}')
+                cached[rootname] = outname
+            else:  # Stale
+                todo[rootname] = True
+
+        header_index = self.build_header_index(
+            [im for rootname in todo for im in root_list[rootname]])
+        header_index_of = {rootname: {im: header_index[im]
+                                      for im in root_list[rootname]}
+                           for rootname in todo}
+        datasets = [(rootname, header_index_of[rootname], todo_clobber)
+                    for rootname, todo_clobber in todo.items()]
+
+        # Process each dataset
+        func = partial(self._mosaic_one, outpath, outsuffix, debug)
+
+        if n_workers < 2 or len(datasets) < 2:  # No multiprocessing
+            pool = None
+            results = map(func, datasets)
+        else:
+            if mp_context is None:
+                mp_context = multiprocessing.get_context()
+            pool = mp_context.Pool(n_workers)
+            if ordered:
+                results = pool.imap(func, datasets)
             else:
-                hdu.writeto(outname, clobber=clobber)
-            return outname
+                results = pool.imap_unordered(func, datasets)
+
+        stale_tiles = set()
+        try:
+            if not ordered:
+                yield from cached.items()
+
+            for rootname in root_list:
+                if ordered and rootname in cached:
+                    yield rootname, cached[rootname]
+                elif rootname in todo:
+                    done_rootname, outname = next(results)
+                    if outname and cache is not None:
+                        stale_tiles.update(self._set_cached(
+                            cache, outname, header_index_of[done_rootname]))
+                    yield done_rootname, outname
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if cache is not None:
+                with cache.lock():
+                    cache.save()
+                    _remove_unused_tiles(cache, stale_tiles)
+
+    def _cache_params(self):
+        """Settings that affect mosaic content, as stored in cache."""
+        return {'data_ext': _jsonify(self.data_ext),
+                'sw_sca_size': self.sw_sca_size,
+                'resample_method': self.resample_method,
+                'dtype': np.dtype(self.dtype).name,
+                'quantize': self.quantize,
+                'pyramid': sorted(self.pyramid or []),
+                'quicklook': self.quicklook}
+
+    def _get_cached(self, cache, outname, imlist):
+        """Return `True` if the mosaic in cache is up to date, `False` if
+        it is stale, or `None` if it is not in cache.
+
+        """
+        if cache is None:
+            return None
+
+        entry = cache.get(os.path.abspath(outname))
+        if entry is None:
+            return None
 
-        mosaiclist = sorted(map(_mosaic_one, list(root_list.keys())))
-        return [m for m in mosaiclist if m]
+        try:
+            return (entry['params'] == self._cache_params() and
+                    entry['inputs'] == [file_signature(im) for im in imlist]
+                    and entry['output'] == file_signature(outname))
+        except (KeyError, OSError):
+            return False
 
+    def _set_cached(self, cache, outname, header_index):
+        """Record the inputs and settings of a mosaic in the cache,
+        given the header index of its inputs. Return cached tiles of its
+        previous version that it no longer uses.
 
-def _insert_image(position, dat, mosaic):
-    """Insert data into appropriate position in mosaic,
-    which is modified in-place.
+        """
+        key = os.path.abspath(outname)
+        tilenames = self._tile_filenames(list(header_index.values()))
+        old_entry = cache.get(key) or {}
+        cache[key] = {
+            'params': self._cache_params(),
+            'inputs': [file_signature(im) for im in header_index],
+            'output': file_signature(outname),
+            'tiles': tilenames}
+        return set(old_entry.get('tiles', [])) - set(tilenames)
+
+    def _tile_filenames(self, infolist):
+        """Tile cache filenames of all detectors of a mosaic."""
+        levels = self._get_levels(infolist)
+        if levels is None:
+            return []
+        tilenames = [self._tile_filename(info, zoom_factor)
+                     for info, zoom_factor, _ in levels[0]]
+        return [f for f in tilenames if f is not None]
+
+    # Iterable (dataset) must be last argument.
+    def _mosaic_one(self, outpath, outsuffix, debug, dataset):
+        """Construct and write mosaic for a single dataset, given as
+        ``(rootname, header_index, clobber)``. Return rootname and mosaic
+        filename, or empty string if there is no mosaic.
+
+        """
+        rootname, header_index, clobber = dataset
+        imlist = list(header_index)
+        outname = _output_filename(outpath, rootname, outsuffix)
+
+        # Avoid regenerating mosaic if already exist.
+        # This also avoids crashing at the very end.
+        if not clobber and os.path.exists(outname):
+            if debug:
+                print(f'Using existing {outname}')
+            return rootname, outname
+
+        levels = self._get_levels(list(header_index.values()))
+        if levels is None:
+            if debug:
+                print(f'No mosaic for {imlist}')
+            return rootname, ''
+
+        header = self._get_header(list(header_index.values()))
+        tiles, levels = levels
+
+        if self.out_of_core:
+            _, shape, placements = levels[0]
+            self._write_mosaic_out_of_core(outname, shape, tiles, placements,
+                                           header)
+            return rootname, outname
+
+        mosaics = {size: np.zeros(shape, dtype=self.dtype)
+                   for size, shape, _ in levels}
+        self._fill_mosaic(
+            [(mosaics[size], placements) for size, _, placements in levels],
+            tiles)
+
+        mosaic = mosaics.pop(self.sw_sca_size)
+        hdul = fits.HDUList([make_image_hdu(
+            mosaic, header=header, dtype=self.dtype, quantize=self.quantize)])
+
+        # Other levels from the coarsest to the finest
+        for i, size in enumerate(sorted(mosaics), start=1):
+            hdu = make_image_hdu(mosaics[size], dtype=self.dtype,
+                                 quantize=self.quantize, name='PYRAMID')
+            hdu.ver = i
+            hdu.header['SCASIZE'] = (size, 'SHORT SCA size in pixels')
+            hdul.append(hdu)
+
+        if minversion(astropy, '1.3'):
+            hdul.writeto(outname, overwrite=clobber)
+        else:
+            hdul.writeto(outname, clobber=clobber)
+
+        self._write_quicklook(outname, mosaic)
+        return rootname, outname
+
+    def _write_quicklook(self, outname, mosaic, max_size=None):
+        """Write quicklook image of the mosaic, if requested."""
+        if not self.quicklook:
+            return
+        write_quicklook(mosaic,
+                        quicklook_filename(outname, fmt=self.quicklook),
+                        **{'max_size': max_size,
+                           **(self.quicklook_kwargs or {})})
+
+    def _write_mosaic_out_of_core(self, outname, shape, tiles, placements,
+                                  header):
+        """Preallocate mosaic file with the given shape and header,
+        then fill it through memory-mapped data.
+
+        The mosaic is built in a temporary file that replaces the output
+        file only when complete, so an interrupted run does not leave
+        a partial mosaic to be reused later.
+
+        """
+        dtype = np.dtype(self.dtype)
+        hdr = fits.PrimaryHDU(
+            data=np.zeros((1, 1), dtype=dtype), header=header).header
+        hdr['NAXIS1'] = shape[1]
+        hdr['NAXIS2'] = shape[0]
+
+        # Data section is padded to a multiple of FITS block size.
+        # Unwritten parts of the file, i.e., gaps, read back as zeros.
+        datasize = shape[0] * shape[1] * dtype.itemsize
+        datasize = -(-datasize // _fits_block_size) * _fits_block_size
+
+        fd, tmpname = _mkstemp(
+            os.path.dirname(os.path.abspath(outname)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                hdr.tofile(fout)
+                fout.seek(datasize - 1, os.SEEK_CUR)
+                fout.write(b'\0')
+
+            with fits.open(tmpname, mode='update', memmap=True) as pf:
+                self._fill_mosaic([(pf[0].data, placements)], tiles)
+                self._write_quicklook(
+                    outname, pf[0].data,
+                    max_size=max(max(s) for _, s in placements))
+
+            os.replace(tmpname, outname)
+        except BaseException:
+            os.remove(tmpname)
+            raise
+
+
+def _remove_unused_tiles(cache, tilenames):
+    """Remove the given cached tiles, except those still used by any
+    mosaic in the cache, including those of other processes sharing it.
+    Cache must be locked and just saved, so it is up to date.
+
+    """
+    in_use = set()
+    for _, entry in cache.items():
+        in_use.update(entry.get('tiles', []))
+
+    for tilename in set(tilenames) - in_use:
+        try:
+            os.remove(tilename)
+        except OSError:
+            pass
+
+
+def _place_tile(mosaic, origin, tile):
+    """Insert tile into mosaic at the given ``(y1, x1)`` origin."""
+    y1, x1 = origin
+    mosaic[y1:y1 + tile.shape[0], x1:x1 + tile.shape[1]] = tile
+
+
+def _output_filename(outpath, rootname, outsuffix):
+    """Mosaic filename for the given dataset."""
+    return os.path.join(outpath, f'{rootname}_{outsuffix}.fits')
+
+
+def _jsonify(ext):
+    """FITS extension as it would be after JSON round trip."""
+    return list(ext) if isinstance(ext, tuple) else ext
+
+
+def _slot_origin(position, shape, mosaic_shape):
+    """Origin ``(y1, x1)`` of an image with the given shape
+    in the given position of a mosaic.
 
     """
     if position in ('lower_left', 'bottom', 'left'):
-        x1 = 0
-        x2 = dat.shape[1]
-        y1 = 0
-        y2 = dat.shape[0]
+        return 0, 0
     elif position in ('lower_right', 'right'):
-        x2 = mosaic.shape[1]
-        x1 = x2 - dat.shape[1]
-        y1 = 0
-        y2 = dat.shape[0]
+        return 0, mosaic_shape[1] - shape[1]
     elif position in ('upper_left', 'top'):
-        x1 = 0
-        x2 = dat.shape[1]
-        y2 = mosaic.shape[0]
-        y1 = y2 - dat.shape[0]
+        return mosaic_shape[0] - shape[0], 0
     elif position in ('upper_right',):
-        x2 = mosaic.shape[1]
-        x1 = x2 - dat.shape[1]
-        y2 = mosaic.shape[0]
-        y1 = y2 - dat.shape[0]
+        return mosaic_shape[0] - shape[0], mosaic_shape[1] - shape[1]
     else:
         raise ValueError(f'Invalid position ({position})')
-
-    mosaic[y1:y2, x1:x2] = dat
@@ -0,0 +1,127 @@
+"""This module contains tools to write quicklook images of FITS products."""
+
+# STDLIB
+import logging
+import os
+
+# THIRD-PARTY
+import numpy as np
+
+__all__ = ['quicklook_filename', 'write_quicklook']
+
+_quicklook_formats = {'png': 'PNG', 'jpg': 'JPEG', 'jpeg': 'JPEG'}
+_chunk_rows = 512  # Rows to scale at once
+
+
+def quicklook_filename(filename, fmt='png'):
+    """Quicklook filename next to the given FITS file.
+
+    Parameters
+    ----------
+    filename : str
+        FITS filename.
+
+    fmt : {'png', 'jpg', 'jpeg'}
+        Quicklook format, which is also the file extension.
+
+    Returns
+    -------
+    outfile : str
+        Quicklook filename.
+
+    """
+    root, ext = os.path.splitext(filename)
+    if ext.lower() not in ('.fits', '.fit', '.fts'):
+        root = filename
+    return f'{root}.{fmt}'
+
+
+def write_quicklook(data, outfile, autocut_method='histogram',
+                    autocut_params=None, quality=90, max_size=None):
+    """Write 8-bit grayscale quicklook image of the given data.
+
+    Cut levels are calculated by Ginga, as for a channel with the same
+    ``autocut_method`` (e.g., in QUIP channel configuration), and
+    data is linearly stretched between them. The image is written with
+    origin at lower left, as it would be displayed in Ginga.
+
+    Parameters
+    ----------
+    data : ndarray
+        2D image. This can be memory-mapped; it is processed in chunks.
+
+    outfile : str
+        Output filename. Format is from the extension, which must be
+        ``.png`` (lossless) or ``.jpg``/``.jpeg`` (lossy).
+
+    autocut_method : str
+        Ginga auto-cuts algorithm, e.g., ``'histogram'`` or ``'zscale'``.
+
+    autocut_params : dict or `None`
+        Parameters for the auto-cuts algorithm. If not given,
+        Ginga defaults are used, except that data are sampled in a
+        grid pattern across the image instead of a crop from the middle,
+        which can fall in a gap of a mosaic.
+
+    quality : int
+        JPEG quality, from 1 (worst) to 95 (best).
+
+    max_size : int or `None`
+        If given, data larger than this along either axis are decimated
+        by taking every n-th pixel along both axes, with the smallest n
+        that fits, so that memory use is bounded by this size instead of
+        that of the data.
+
+    Returns
+    -------
+    cuts : tuple of float
+        Low and high cut levels used.
+
+    Raises
+    ------
+    ValueError
+        Invalid data or output format.
+
+    """
+    from ginga import AutoCuts
+    from PIL import Image
+
+    fmt = _quicklook_formats.get(os.path.splitext(outfile)[1][1:].lower())
+    if fmt is None:
+        raise ValueError(f'Unsupported quicklook format for {outfile}, must '
+                         f'be one of {tuple(_quicklook_formats)}')
+
+    if data.ndim != 2:
+        raise ValueError(f'Unsupported ndim={data.ndim}')
+
+    if max_size is not None:
+        step = -(-max(data.shape) // max_size)
+        if step > 1:
+            data = data[::step, ::step]
+
+    autocuts_class = AutoCuts.get_autocuts(autocut_method)
+    if autocut_params is None:
+        autocut_params = {}
+        if 'sample' in [p.name for p in autocuts_class.get_params_metadata()]:
+            autocut_params['sample'] = 'grid'
+
+    autocuts = autocuts_class(logging.getLogger(__name__), **autocut_params)
+    loval, hival = autocuts.calc_cut_levels_data(data)
+
+    # Stretch in chunks, so a large memory-mapped mosaic is never
+    # converted to floating point all at once.
+    outdata = np.zeros(data.shape, dtype=np.uint8)
+    delta = hival - loval
+    if delta > 0:
+        for i in range(0, data.shape[0], _chunk_rows):
+            chunk = np.asarray(data[i:i + _chunk_rows], dtype=np.float32)
+            chunk = np.nan_to_num((chunk - loval) * (255 / delta), nan=0)
+            outdata[i:i + _chunk_rows] = np.clip(chunk, 0, 255)
+
+    if fmt == 'PNG':
+        kwargs = {'optimize': True}
+    else:
+        kwargs = {'quality': quality}
+    Image.fromarray(outdata[::-1]).save(outfile, format=fmt, **kwargs)
+
+    return loval, hival
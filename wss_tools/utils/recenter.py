@@ -1,17 +1,37 @@
 ''' Module to recenter images '''
 
 # STDLIB
+import multiprocessing
 import os
+import shutil
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from itertools import chain
+
 from astropy.io import fits
-from astropy.nddata import block_reduce
-import matplotlib.pyplot as plt
 import numpy as np
 from scipy import ndimage
 
-__all__ = ['recenter']
+from .cache import JSONCache, file_signature
+
+__all__ = ['recenter', 'find_psf_center', 'find_psf_centers']
+
+# Recenter the image to 464, 1412 instead to match the WAS expectations
+_xcntr = 464
+_ycntr = 1412
 
+# Stride used to subsample full-frame images for diagnostic plots
+_plot_stride = 4
 
-def recenter(images, outputdir, doplot=False):
+# Cache file for measured PSF centers, in the given cache directory
+_cache_filename = 'recenter_cache.json'
+
+
+def recenter(images, outputdir, doplot=False, n_workers=1, method='median',
+             saveplot=False, plot_in_background=False, cachedir=None,
+             batch_size=None, mp_context=None):
     """Recenter images based on NIRCam XY (464,1412) if offset > 10px
 
     Parameters
@@ -22,113 +42,739 @@ def recenter(images, outputdir, doplot=False):
         Working directory where QUIP will write the files to.
     doplot : bool
         Show plots to the user via a popup.
+        This forces the images to be processed serially.
+    n_workers : int or `None`
+        Number of worker processes to use. If `None`, it is set to
+        the number of available CPU cores or the number of images
+        to process, whichever is smaller.
+    method : str
+        Centroid algorithm. See :func:`find_psf_center`.
+    saveplot : bool
+        Save diagnostic plot for each image as
+        ``<rootname>_recenter.png`` in ``outputdir``, in addition to
+        showing it if ``doplot=True``. Otherwise, plots are rendered
+        with the Agg backend, so no display is needed.
+    plot_in_background : bool
+        Render saved plots in a background thread, so that processing
+        of the next images does not wait for them.
+        This is ignored if ``doplot=True``.
+    cachedir : str or `None`
+        If given, measured PSF centers and whether a shift was needed are
+        cached in this directory (e.g., QUIP ``quipcache``). An image is
+        skipped, and its previous output reused, if the input file,
+        the existing output file, and the centroid method are unchanged
+        since it was cached. Plots are not regenerated for skipped images.
+    batch_size : int or `None`
+        If given, images are sent to the workers in batches of this size,
+        and PSF centers are found for each batch at once using
+        :func:`find_psf_centers`. This is ignored if plots are requested.
+    mp_context : `multiprocessing` context or `None`
+        Context to start worker processes with, e.g.,
+        ``multiprocessing.get_context('spawn')`` when called from
+        a thread. If not given, the default context is used.
 
     Returns
     -------
     output_images : list
-        Output images that have been read and/or modified.
+        Output images that have been read and/or modified, in the
+        same order as the input. Images that could not be processed
+        are excluded and reported in a warning instead.
+
+    Raises
+    ------
+    ValueError
+        Invalid centroid method.
 
     """
+    if method not in _centroid_methods:
+        raise ValueError(f'Invalid method ({method}), must be one of '
+                         f'{tuple(_centroid_methods)}')
 
+    if saveplot and plot_in_background and not doplot:
+        plot_executor = ThreadPoolExecutor(max_workers=1)
+    else:
+        plot_executor = None
+
+    if cachedir is None:
+        cache = None
+    else:
+        cache = JSONCache(os.path.join(cachedir, _cache_filename))
+
+    cached = [_get_cached(cache, im_fn, outputdir, method)
+              for im_fn in images]
+    todo = [im_fn for im_fn, hit in zip(images, cached) if hit is None]
+
+    if batch_size and not (doplot or saveplot):
+        func = partial(_recenter_batch, outputdir, method)
+        tasks = [todo[i:i + batch_size]
+                 for i in range(0, len(todo), batch_size)]
+    else:
+        func = partial(_recenter_one, outputdir, method, doplot or saveplot)
+        tasks = todo
+
+    if n_workers is None:
+        n_workers = min(multiprocessing.cpu_count(), len(tasks))
+    if doplot:
+        n_workers = 1
+
+    pool_results = _imap(func, tasks, n_workers, mp_context=mp_context)
+    if tasks is todo:
+        processed = pool_results
+    else:
+        processed = chain.from_iterable(pool_results)
     output_images = []
-    for im_fn in images:
-        # Open fits
-        with fits.open(im_fn) as hdul:
-            data = hdul[1].data
-
-            # Rebin image with very big pixels to find the approximate location
-            size = 32
-            rebindata = block_reduce(data, block_size=64, func=np.median)
-
-            # Remove background
-            rebindata -= np.median(rebindata)
-
-            margin_left = 1.5
-            margin_right = 2.5
-            margin_top = 2.5
-            margin_bttm = 1.5
-            imsize = 2048
-
-            # Find the center of mass and cut a box around: we should see the
-            # whole PSF with about 1-2 PSF wide margins
-            com = ndimage.center_of_mass(rebindata)
-            subdata = data[int((com[0] - margin_left) * imsize / size):
-                           int((com[0] + margin_right) * imsize / size),
-                           int((com[1] - margin_bttm) * imsize / size):
-                           int((com[1] + margin_top) * imsize / size)]
-
-            # Rebin again
-            rebinsubdata = block_reduce(subdata, block_size=8, func=np.median)
-
-            # Remove background
-            rebinsubdata -= np.median(rebinsubdata)
-
-            # Find the center of mass and cut a box around:
-            # should see the inside of the PSF
-            com1 = ndimage.center_of_mass(rebinsubdata)
-            margin_left2 = 0.5
-            margin_right2 = 1.5
-            margin_bttm2 = 0.5
-            margin_top2 = 1.5
-            subdata2 = subdata[int((com1[0]-margin_left2)*imsize/size*4/size):
-                               int((com1[0]+margin_right2)*imsize/size*4/size),
-                               int((com1[1]-margin_bttm2)*imsize/size*4/size):
-                               int((com1[1]+margin_top2)*imsize/size*4/size)]
-
-            # Find the center of mass
-            com2 = ndimage.center_of_mass(subdata2)
-
-            xcntr = 464
-            ycntr = 1412
-
-            # Recenter the image to 464, 1412 instead to match the WAS
-            # expectations
-            xcpsf = (com2[0]+int((com1[0]-margin_left2)*imsize/size*4/size)
-                     + int((com[0]-margin_left)*imsize/size))
-            ycpsf = (com2[1]+int((com1[1]-margin_bttm2)*imsize/size*4/size)
-                     + int((com[1]-margin_bttm)*imsize/size))
-            offsetdata = np.roll(data, (xcntr - int(ycpsf),
-                                        ycntr - int(xcpsf)),
-                                 axis=(1, 0))
-
-            # Save back image into file
-            if abs(xcntr - ycpsf) > 10 or abs(ycntr - xcpsf) > 10:
-                # Do the same for the ERR and the DQ
-                hdul[2].data = np.roll(hdul[2].data,
-                                       (xcntr-int(ycpsf), ycntr-int(xcpsf)),
-                                       axis=(1, 0))
-                hdul[3].data = np.roll(hdul[3].data,
-                                       (xcntr-int(ycpsf), ycntr-int(xcpsf)),
-                                       axis=(1, 0))
-                hdul[1].data = offsetdata
-                filename = os.path.basename(im_fn).replace('.fits',
-                                                           '_recenter.fits')
-                hdul.writeto(os.path.join(outputdir, filename), overwrite=True)
-                output_images.append(os.path.join(outputdir, filename))
+    failed = []
+    plot_jobs = []
+
+    try:
+        for im_fn, hit in zip(images, cached):
+            if hit is not None:
+                output_images.append(hit)
+                continue
+
+            outfile, err, plotinfo, center = next(processed)
+            if err:
+                failed.append(f'{im_fn}: {err}')
+                continue
+
+            output_images.append(outfile)
+            _set_cached(cache, im_fn, outfile, method, center)
+
+            if plotinfo is None:
+                continue
+            if saveplot:
+                plotfile = os.path.join(outputdir, _plot_filename(im_fn))
             else:
-                output_images.append(im_fn)
+                plotfile = None
+            if plot_executor is None:
+                _plot_recenter(plotinfo, filename=plotfile, show=doplot)
+            else:
+                plot_jobs.append(
+                    (im_fn, plot_executor.submit(_plot_recenter, plotinfo,
+                                                 filename=plotfile)))
+    finally:
+        pool_results.close()
+        if cache is not None:
+            cache.save()
+
+    if plot_executor is not None:
+        plot_executor.shutdown(wait=True)
+        for im_fn, job in plot_jobs:
+            if job.exception() is not None:
+                warnings.warn(f'Failed to plot {im_fn}: {job.exception()}',
+                              UserWarning)
+
+    if failed:
+        warnings.warn(f'Failed to recenter {len(failed)} image(s):\n' +
+                      '\n'.join(failed), UserWarning)
+
+    return output_images
+
+
+def _imap(func, iterable, n_workers, mp_context=None):
+    """Lazily map ``func`` over ``iterable``, in order,
+    using a process pool from the given context if there are
+    at least 2 workers.
+
+    """
+    if n_workers < 2:  # No multiprocessing
+        yield from map(func, iterable)
+    else:
+        if mp_context is None:
+            mp_context = multiprocessing.get_context()
+        with mp_context.Pool(n_workers) as p:
+            yield from p.imap(func, iterable)
 
-        # Plot
 
-        fig, ((ax1, ax2),
-              (ax3, ax4),
-              (ax5, ax6)) = plt.subplots(3, 2, figsize=(12, 9))
-        fig.tight_layout(pad=.3)
-        ax1.imshow(data, origin='lower')
-        ax2.imshow(rebindata, origin='lower')
+# Iterable (im_fn) must be last argument.
+def _recenter_one(outputdir, method, makeplot, im_fn):
+    """Recenter a single image, catching any failure so that
+    it does not abort the rest of the batch.
 
-        ax3.imshow(subdata, origin='lower')
-        ax4.imshow(rebinsubdata, origin='lower')
+    Returns
+    -------
+    outfile : str
+        Output image, which is the input image if no shift is needed,
+        or empty string if processing failed.
+
+    err : str
+        Error message, or empty string if processing succeeded.
+
+    plotinfo : dict or `None`
+        Data for :func:`_plot_recenter`, if requested.
+
+    center : tuple of float or `None`
+        Measured PSF center as ``(y, x)``.
+
+    """
+    try:
+        outfile, plotinfo, center = _do_recenter(im_fn, outputdir, method,
+                                                 makeplot)
+    except Exception as e:
+        return '', f'{e.__class__.__name__}: {e}', None, None
+    return outfile, '', plotinfo, center
+
+
+def _do_recenter(im_fn, outputdir, method, makeplot):
+    """Recenter a single image and return the image to use,
+    along with data needed for plotting, if requested, and
+    the measured PSF center.
 
-        ax5.imshow(subdata2, origin='lower')
-        ax5.plot([com2[1], com2[1]], [0, imsize/size*4/size*2-1], 'r')
-        ax5.plot([0, imsize/size*4/size*2-1], [com2[0], com2[0]], 'r')
+    """
+    # Open fits. SCI is memory-mapped; ERR and DQ are not read at all
+    # unless a shift turns out to be needed.
+    with fits.open(im_fn, memmap=True) as hdul:
+        data = hdul[1].data
+        center, stages = find_psf_center(data, method=method,
+                                         return_stages=True)
 
-        ax6.imshow(offsetdata, origin='lower')
-        ax6.plot([xcntr, xcntr], [0, imsize-1], 'r')
-        ax6.plot([0, imsize-1], [ycntr, ycntr], 'r')
-        if doplot:
-            plt.show()
+        if makeplot:
+            plotinfo = _get_plotinfo(data, stages, _get_shift(center)[0])
         else:
-            plt.savefig(os.path.join(outputdir, 'plot.png'))
-    return output_images
+            plotinfo = None
+
+    return _save_recentered(im_fn, outputdir, center), plotinfo, center
+
+
+# Iterable (chunk) must be last argument.
+def _recenter_batch(outputdir, method, chunk):
+    """Recenter a batch of images with vectorized centroiding.
+    If the batch cannot be processed together (e.g., shapes differ),
+    images are processed one at a time instead.
+
+    Returns
+    -------
+    results : list
+        Results as returned by :func:`_recenter_one` for each image,
+        without plotting data.
+
+    """
+    try:
+        with ExitStack() as stack:
+            hduls = [stack.enter_context(fits.open(im_fn, memmap=True))
+                     for im_fn in chunk]
+            centers = find_psf_centers([pf[1].data for pf in hduls],
+                                       method=method)
+    except Exception:
+        return [_recenter_one(outputdir, method, False, im_fn)
+                for im_fn in chunk]
+
+    results = []
+    for im_fn, center in zip(chunk, centers):
+        center = tuple(center)
+        try:
+            outfile = _save_recentered(im_fn, outputdir, center)
+        except Exception as e:
+            results.append(('', f'{e.__class__.__name__}: {e}', None, None))
+        else:
+            results.append((outfile, '', None, center))
+    return results
+
+
+def _get_shift(center):
+    """Shift, as ``(dy, dx)``, to move the PSF center to the expected
+    position, and whether the offset is large enough to need it.
+
+    """
+    yc, xc = center
+    shift = (_ycntr - int(yc), _xcntr - int(xc))
+    needs_shift = abs(_xcntr - xc) > 10 or abs(_ycntr - yc) > 10
+    return shift, needs_shift
+
+
+def _save_recentered(im_fn, outputdir, center):
+    """Save shifted image into file, if needed, and return
+    the image to use.
+
+    """
+    shift, needs_shift = _get_shift(center)
+    if not needs_shift:
+        return im_fn
+
+    outfile = os.path.join(outputdir, _output_filename(im_fn))
+    _write_shifted(im_fn, outfile, shift)
+    return outfile
+
+
+def _output_filename(im_fn):
+    """Recentered image filename for the given image."""
+    return os.path.basename(im_fn).replace('.fits', '_recenter.fits')
+
+
+# ------- #
+# CACHING #
+# ------- #
+
+def _get_cached(cache, im_fn, outputdir, method):
+    """Return the image to use from a previous run, if the input file,
+    the output file, and the settings have not changed since.
+    Otherwise, return `None`.
+
+    """
+    if cache is None:
+        return None
+
+    entry = cache.get(os.path.abspath(im_fn))
+    if entry is None:
+        return None
+
+    try:
+        if (entry['input'] != file_signature(im_fn) or
+                entry['method'] != method or
+                entry['target'] != [_ycntr, _xcntr]):
+            return None
+
+        if not entry['needs_shift']:
+            return im_fn
+
+        outfile = os.path.join(outputdir, _output_filename(im_fn))
+        if entry['output'] != file_signature(outfile):
+            return None
+    except (KeyError, OSError):
+        return None
+
+    return outfile
+
+
+def _set_cached(cache, im_fn, outfile, method, center):
+    """Record result for a processed image in the cache."""
+    if cache is None:
+        return
+
+    needs_shift = outfile != im_fn
+    cache[os.path.abspath(im_fn)] = {
+        'input': file_signature(im_fn),
+        'output': file_signature(outfile) if needs_shift else None,
+        'method': method,
+        'target': [_ycntr, _xcntr],
+        'center': [float(c) for c in center],
+        'needs_shift': needs_shift}
+
+
+# -------- #
+# PLOTTING #
+# -------- #
+
+def _plot_filename(im_fn):
+    """Diagnostic plot filename for the given image."""
+    return os.path.splitext(os.path.basename(im_fn))[0] + '_recenter.png'
+
+
+def _get_plotinfo(data, stages, shift):
+    """Collect small arrays needed for diagnostic plot.
+    Full-frame images, before and after shifting, are subsampled.
+
+    """
+    ny, nx = data.shape
+    iy = np.arange(0, ny, _plot_stride)
+    ix = np.arange(0, nx, _plot_stride)
+    # Copy because some stages are views into memory-mapped data.
+    plotinfo = {key: np.array(stages[key]) for key in (
+        'rebindata', 'subdata', 'rebinsubdata', 'subdata2', 'com2')}
+    plotinfo['data'] = np.array(data[::_plot_stride, ::_plot_stride])
+    plotinfo['offsetdata'] = np.array(
+        data[((iy - shift[0]) % ny)[:, None], (ix - shift[1]) % nx])
+    plotinfo['extent'] = (-0.5, nx - 0.5, -0.5, ny - 0.5)
+    plotinfo['imsize'] = (ny, nx)
+    return plotinfo
+
+
+def _plot_recenter(plotinfo, filename=None, show=False):
+    """Plot recentering diagnostics.
+
+    If ``filename`` is given, plot is saved to it. If ``show=True``,
+    it is also shown to the user via a popup. If only saved, plot is
+    rendered with Agg backend without going through
+    :mod:`matplotlib.pyplot`, so nothing is left open.
+
+    """
+    if show:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=(12, 9))
+    else:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=(12, 9))
+        FigureCanvasAgg(fig)
+
+    ((ax1, ax2),
+     (ax3, ax4),
+     (ax5, ax6)) = fig.subplots(3, 2)
+    fig.tight_layout(pad=.3)
+    ny, nx = plotinfo['imsize']
+    subsize = sum(_fine_margins) * _fine_block
+    com2 = plotinfo['com2']
+
+    ax1.imshow(plotinfo['data'], origin='lower', extent=plotinfo['extent'])
+    ax2.imshow(plotinfo['rebindata'], origin='lower')
+
+    ax3.imshow(plotinfo['subdata'], origin='lower')
+    ax4.imshow(plotinfo['rebinsubdata'], origin='lower')
+
+    ax5.imshow(plotinfo['subdata2'], origin='lower')
+    ax5.plot([com2[1], com2[1]], [0, subsize - 1], 'r')
+    ax5.plot([0, subsize - 1], [com2[0], com2[0]], 'r')
+
+    ax6.imshow(plotinfo['offsetdata'], origin='lower',
+               extent=plotinfo['extent'])
+    ax6.plot([_xcntr, _xcntr], [0, ny - 1], 'r')
+    ax6.plot([0, nx - 1], [_ycntr, _ycntr], 'r')
+
+    if filename is not None:
+        fig.savefig(filename)
+    if show:
+        plt.show()
+        plt.close(fig)
+
+
+# ---------------- #
+# CENTROID ENGINES #
+# ---------------- #
+
+# Block sizes (in pixels) for the coarse and fine searches, and the box
+# (in binned pixels, before and after the center of mass) to cut around
+# the PSF found in each search.
+_coarse_block = 64
+_coarse_margins = (1.5, 2.5)
+_fine_block = 8
+_fine_margins = (0.5, 1.5)
+
+
+def find_psf_center(data, method='median', return_stages=False):
+    """Find the center of a single PSF in the given image.
+
+    The image is first binned with very big pixels to find the approximate
+    location of the PSF. A box around that location, where we should see
+    the whole PSF with about 1-2 PSF wide margins, is binned again with
+    smaller pixels to locate the inside of the PSF. Finally, center of mass
+    is calculated in a small box at full resolution.
+
+    Parameters
+    ----------
+    data : ndarray
+        2D image.
+
+    method : {'median', 'partition', 'mean', 'fft'}
+        Algorithm used for the coarse and fine searches:
+
+        * ``'median'`` - Block median using
+          :func:`astropy.nddata.block_reduce` and center of mass.
+          This is the original algorithm.
+        * ``'partition'`` - Same as ``'median'`` but with a faster
+          partition-based block median.
+        * ``'mean'`` - Block mean by reshaping the image, and center of mass.
+        * ``'fft'`` - Block mean, but the PSF is located by FFT
+          cross-correlation of the binned image with its point reflection,
+          which finds the center of symmetry instead of the center of mass.
+
+    return_stages : bool
+        Also return intermediate results, e.g., for plotting.
+
+    Returns
+    -------
+    center : tuple of float
+        PSF center in pixels, as ``(y, x)``.
+
+    stages : dict
+        Intermediate images and centers from the searches.
+        Only returned if ``return_stages=True``.
+
+    Raises
+    ------
+    ValueError
+        Invalid method.
+
+    """
+    if method not in _centroid_methods:
+        raise ValueError(f'Invalid method ({method}), must be one of '
+                         f'{tuple(_centroid_methods)}')
+    binfunc, locate, _ = _centroid_methods[method]
+
+    # Rebin image with very big pixels to find the approximate location
+    rebindata = binfunc(data, _coarse_block)
+
+    # Remove background
+    rebindata -= np.median(rebindata)
+
+    # Find the PSF and cut a box around: we should see the
+    # whole PSF with about 1-2 PSF wide margins
+    com = locate(rebindata)
+    subdata, start = _cut_box(data, com, _coarse_block, _coarse_margins)
+
+    # Rebin again
+    rebinsubdata = binfunc(subdata, _fine_block)
+
+    # Remove background
+    rebinsubdata -= np.median(rebinsubdata)
+
+    # Find the PSF and cut a box around: should see the inside of the PSF
+    com1 = locate(rebinsubdata)
+    subdata2, start1 = _cut_box(subdata, com1, _fine_block, _fine_margins)
+
+    # Find the center of mass
+    com2 = ndimage.center_of_mass(subdata2)
+
+    center = (com2[0] + start1[0] + start[0],
+              com2[1] + start1[1] + start[1])
+
+    if not return_stages:
+        return center
+
+    stages = {'rebindata': rebindata, 'com': com, 'subdata': subdata,
+              'rebinsubdata': rebinsubdata, 'com1': com1,
+              'subdata2': subdata2, 'com2': com2}
+    return center, stages
+
+
+def _cut_box(data, com, block, margins):
+    """Cut a box around the position found in data binned by ``block``.
+    Also return the starting indices of the box in ``data``.
+
+    """
+    start = [max(0, int((c - margins[0]) * block)) for c in com]
+    stop = [int((c + margins[1]) * block) for c in com]
+    return data[start[0]:stop[0], start[1]:stop[1]], start
+
+
+def _block_view(data, block):
+    """Reshape data of shape ``(..., ny, nx)`` into
+    ``(..., ny // block, block, nx // block, block)`` without copying.
+    Data are trimmed from the end if not divisible by block size,
+    as in :func:`astropy.nddata.block_reduce`.
+
+    """
+    ny = data.shape[-2] // block
+    nx = data.shape[-1] // block
+    return data[..., :ny * block, :nx * block].reshape(
+        data.shape[:-2] + (ny, block, nx, block))
+
+
+def _block_median_astropy(data, block):
+    """Block median of the last two axes with
+    :func:`astropy.nddata.block_reduce`.
+
+    """
+    from astropy.nddata import block_reduce  # Slow to import
+
+    block_size = (1, ) * (data.ndim - 2) + (block, block)
+    return block_reduce(data, block_size=block_size, func=np.median)
+
+
+def _block_median_partition(data, block):
+    """Block median of the last two axes using :func:`numpy.partition`
+    on only the middle element(s) of each block, instead of a full median.
+
+    """
+    blocks = _block_view(data, block)
+    n = block * block
+    k = n // 2
+    # Reshape is a view when there is only one block across,
+    # so partition a copy to leave input data alone.
+    blocks = blocks.swapaxes(-3, -2).reshape(
+        blocks.shape[:-3] + (blocks.shape[-2], n))
+
+    if n % 2:
+        return np.partition(blocks, k, axis=-1)[..., k]
+
+    blocks = np.partition(blocks, (k - 1, k), axis=-1)
+    return 0.5 * (blocks[..., k - 1] + blocks[..., k])
+
+
+def _block_mean(data, block):
+    """Block mean of the last two axes by reshaping."""
+    return _block_view(data, block).mean(axis=(-3, -1))
+
+
+def _center_of_mass_stack(images):
+    """Same as :func:`scipy.ndimage.center_of_mass` for each image in
+    a stack of shape ``(n, ny, nx)``, computed in one pass.
+
+    """
+    images = np.asarray(images, dtype=np.float64)
+    total = images.sum(axis=(1, 2))
+    cy = np.einsum('nij,i->n', images, np.arange(images.shape[1])) / total
+    cx = np.einsum('nij,j->n', images, np.arange(images.shape[2])) / total
+    return np.stack([cy, cx], axis=1)
+
+
+def _fft_locate_stack(images):
+    """Locate center of symmetry of the positive signal in each image
+    in a stack of shape ``(n, ny, nx)``.
+
+    Cross-correlating the image with its point reflection is the same as
+    convolving it with itself, which peaks at twice the center of symmetry.
+    The peak is refined to sub-pixel with a parabola along each axis.
+
+    """
+    images = np.clip(images, 0, None)
+    n = images.shape[0]
+    shape = tuple(2 * k for k in images.shape[1:])  # Zero-pad; no wrapping
+    ft = np.fft.rfft2(images, shape)
+    corr = np.fft.irfft2(ft * ft, shape)
+    peak = np.stack(np.unravel_index(
+        corr.reshape(n, -1).argmax(axis=1), shape), axis=1)
+
+    frame = np.arange(n)
+    center = np.empty((n, 2))
+    for axis in range(2):
+        p = peak[:, axis]
+        inside = (p > 0) & (p < shape[axis] - 1)
+        vals = []
+        for offset in (-1, 0, 1):
+            idx = [frame, peak[:, 0], peak[:, 1]]
+            idx[axis + 1] = np.clip(p + offset, 0, shape[axis] - 1)
+            vals.append(corr[tuple(idx)])
+        denom = vals[0] - 2 * vals[1] + vals[2]
+        ok = inside & (denom != 0)
+        delta = np.zeros(n)
+        delta[ok] = 0.5 * (vals[0] - vals[2])[ok] / denom[ok]
+        center[:, axis] = (p + delta) / 2
+
+    return center
+
+
+def _fft_locate(image):
+    """Locate center of symmetry of the positive signal in the image.
+    See :func:`_fft_locate_stack`.
+
+    """
+    return tuple(_fft_locate_stack(image[np.newaxis])[0])
+
+
+# Binning function and locators (single image and stack)
+# for the coarse and fine searches.
+_centroid_methods = {
+    'median': (_block_median_astropy, ndimage.center_of_mass,
+               _center_of_mass_stack),
+    'partition': (_block_median_partition, ndimage.center_of_mass,
+                  _center_of_mass_stack),
+    'mean': (_block_mean, ndimage.center_of_mass, _center_of_mass_stack),
+    'fft': (_block_mean, _fft_locate, _fft_locate_stack)}
+
+
+def find_psf_centers(frames, method='median'):
+    """Find the center of a single PSF in each of the given images,
+    which must all have the same shape.
+
+    This is a vectorized version of :func:`find_psf_center`, where each
+    search is done for the whole stack at once to amortize the overhead
+    when many images are processed together.
+    Unlike :func:`find_psf_center`, the boxes cut around the PSF are
+    moved to stay inside the image instead of being truncated,
+    so results can differ for a PSF near the edges.
+
+    Parameters
+    ----------
+    frames : ndarray or list of ndarray
+        Images as a 3D array of shape ``(n, ny, nx)``, or a sequence of
+        2D arrays of the same shape (e.g., memory-mapped from different
+        files). For the latter, only the binned images and the boxes
+        around the PSF are stacked, not the full images.
+
+    method : {'median', 'partition', 'mean', 'fft'}
+        See :func:`find_psf_center`.
+
+    Returns
+    -------
+    centers : ndarray
+        PSF centers in pixels, with shape ``(n, 2)`` as ``(y, x)``
+        for each image.
+
+    Raises
+    ------
+    ValueError
+        Invalid method or images do not all have the same shape.
+
+    """
+    if method not in _centroid_methods:
+        raise ValueError(f'Invalid method ({method}), must be one of '
+                         f'{tuple(_centroid_methods)}')
+    binfunc, _, locate = _centroid_methods[method]
+
+    if isinstance(frames, np.ndarray):
+        if frames.ndim != 3:
+            raise ValueError(f'Expected 3D array, got {frames.ndim}D')
+        rebindata = binfunc(frames, _coarse_block)
+    else:
+        if len(set(f.shape for f in frames)) > 1:
+            raise ValueError('Images do not all have the same shape')
+        rebindata = np.stack([binfunc(f, _coarse_block) for f in frames])
+
+    # Coarse search
+    rebindata -= np.median(rebindata, axis=(1, 2), keepdims=True)
+    com = locate(rebindata)
+    subdata, start = _cut_boxes(frames, com, _coarse_block, _coarse_margins)
+
+    # Fine search
+    rebinsubdata = binfunc(subdata, _fine_block)
+    rebinsubdata -= np.median(rebinsubdata, axis=(1, 2), keepdims=True)
+    com1 = locate(rebinsubdata)
+    subdata2, start1 = _cut_boxes(subdata, com1, _fine_block, _fine_margins)
+
+    # Find the center of mass
+    com2 = _center_of_mass_stack(subdata2)
+
+    return com2 + start1 + start
+
+
+def _cut_boxes(frames, coms, block, margins):
+    """Cut same-size boxes, which are kept inside the images, around the
+    positions found in the binned images. Also return the starting indices
+    of the boxes in the images.
+
+    """
+    size = int(sum(margins) * block)
+    limit = np.array(frames[0].shape) - size
+    start = np.clip(np.floor((coms - margins[0]) * block).astype(int),
+                    0, limit)
+
+    if isinstance(frames, np.ndarray):
+        iy = start[:, 0, np.newaxis, np.newaxis] + np.arange(size)[:, None]
+        ix = start[:, 1, np.newaxis, np.newaxis] + np.arange(size)
+        boxes = frames[np.arange(len(frames))[:, None, None], iy, ix]
+    else:
+        boxes = np.stack([f[y:y + size, x:x + size]
+                          for f, (y, x) in zip(frames, start)])
+
+    return boxes, start
+
+
+# -------- #
+# SHIFTING #
+# -------- #
+
+def _write_shifted(infile, outfile, shift, exts=(1, 2, 3)):
+    """Write a copy of ``infile`` to ``outfile`` with the given
+    extensions (SCI, ERR, and DQ by default) rolled by ``shift``.
+
+    The output file is first copied byte-for-byte and then updated
+    through memory map, so each plane is streamed from input to output
+    without intermediate full-frame copies. Shifting only moves pixels
+    around, so it is done on the raw stored values without applying
+    BSCALE/BZERO (e.g., for unsigned DQ).
+
+    """
+    shutil.copyfile(infile, outfile)
+    open_kw = {'memmap': True, 'do_not_scale_image_data': True}
+
+    with fits.open(infile, **open_kw) as pf_in, \
+            fits.open(outfile, mode='update', **open_kw) as pf_out:
+        for ext in exts:
+            _roll_into(pf_in[ext].data, shift, pf_out[ext].data)
+
+
+def _roll_into(data, shift, out):
+    """Same as ``np.roll(data, shift, axis=(0, 1))`` for 2D data,
+    but written into the given ``out`` array, which must have the same
+    shape as ``data`` and not overlap it.
+
+    """
+    ny, nx = data.shape
+    dy = shift[0] % ny
+    dx = shift[1] % nx
+    for ys, yd in ((slice(0, ny - dy), slice(dy, ny)),
+                   (slice(ny - dy, ny), slice(0, dy))):
+        for xs, xd in ((slice(0, nx - dx), slice(dx, nx)),
+                       (slice(nx - dx, nx), slice(0, dx))):
+            out[yd, xd] = data[ys, xs]
+    return out
@@ -0,0 +1,125 @@
+"""This module contains tools to resample images to a different size."""
+
+# STDLIB
+from functools import lru_cache
+
+# THIRD-PARTY
+import numpy as np
+from scipy import sparse
+from scipy.ndimage import zoom
+
+__all__ = ['resample', 'zoom_shape']
+
+_resample_methods = ('area', 'spline')
+
+
+def zoom_shape(shape, zoom_factor):
+    """Output shape after zooming by the given factor,
+    same as :func:`scipy.ndimage.zoom`.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Input shape.
+
+    zoom_factor : float or tuple of float
+        Zoom factor along all axes, or along each axis.
+
+    Returns
+    -------
+    out_shape : tuple of int
+        Output shape.
+
+    """
+    if np.isscalar(zoom_factor):
+        zoom_factor = (zoom_factor, ) * len(shape)
+    return tuple(int(round(n * z)) for n, z in zip(shape, zoom_factor))
+
+
+def resample(data, zoom_factor, method='area'):
+    """Resample 2D image by the given zoom factor.
+
+    Parameters
+    ----------
+    data : ndarray
+        2D image.
+
+    zoom_factor : float or tuple of float
+        Zoom factor along both axes, or ``(y, x)`` factors to get an exact
+        output shape when aspect ratio cannot be kept exactly.
+        Output shape is given by :func:`zoom_shape`.
+
+    method : {'area', 'spline'}
+        Resampling algorithm:
+
+        * ``'area'`` - Each output pixel is the average of the input
+          pixels it covers, weighted by overlapping area. This conserves
+          flux and is the appropriate choice for shrinking images.
+          If the output shape divides the input shape, this is done as
+          a simple block mean. Otherwise, separable resampling operators
+          are applied along each axis; they are cached, so they are only
+          computed once for all images of the same shape.
+        * ``'spline'`` - Cubic spline interpolation using
+          :func:`scipy.ndimage.zoom`. This is much slower when shrinking
+          by large factors.
+
+    Returns
+    -------
+    outdata : ndarray
+        Resampled image. For ``'area'``, the data type is floating point
+        with at least single precision.
+
+    Raises
+    ------
+    ValueError
+        Invalid method or data.
+
+    """
+    if method not in _resample_methods:
+        raise ValueError(f'Invalid method ({method}), must be one of '
+                         f'{_resample_methods}')
+
+    if data.ndim != 2:
+        raise ValueError(f'Unsupported ndim={data.ndim}')
+
+    if method == 'spline':
+        return zoom(data, zoom_factor)
+
+    # Native byte order float, as needed by sparse matrix product.
+    data = np.asarray(data, dtype=np.result_type(data.dtype, np.float32))
+    ny, nx = data.shape
+    my, mx = zoom_shape(data.shape, zoom_factor)
+
+    # Fast path for integer factor.
+    if ny % my == 0 and nx % mx == 0:
+        return data.reshape(my, ny // my, mx, nx // mx).mean(axis=(1, 3))
+
+    wy = _area_operator(ny, my)
+    wx = _area_operator(nx, mx)
+    outdata = (wx @ (wy @ data).T).T
+    return outdata.astype(data.dtype, copy=False)
+
+
+@lru_cache(maxsize=32)
+def _area_operator(n_in, n_out):
+    """Sparse matrix of shape ``(n_out, n_in)`` that averages input pixels
+    over the footprint of each output pixel, weighted by overlap.
+
+    """
+    scale = n_in / n_out
+    rows = []
+    cols = []
+    vals = []
+
+    for j in range(n_out):
+        lo = j * scale
+        hi = (j + 1) * scale
+        i = np.arange(int(np.floor(lo)), min(int(np.ceil(hi)), n_in))
+        overlap = np.minimum(i + 1, hi) - np.maximum(i, lo)
+        rows.append(np.full(i.size, j))
+        cols.append(i)
+        vals.append(overlap / scale)
+
+    return sparse.csr_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n_out, n_in))